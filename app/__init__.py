@@ -1,7 +1,21 @@
+import logging
+
 from flask import Flask
 from flask_cors import CORS
 from app.config import load_configurations, configure_logging
+from .commands import register_commands
 from .views import webhook_blueprint
+from .services.message_queue import message_queue
+from .services.broadcast import broadcasts
+from .utils.db import WADatabase
+from .utils.dedup import deduplicator
+from .services.status_ingest import status_ingest
+from .services.media_pipeline import media_pipeline
+from .services.faq import faq_responder
+from .services.openai_service import load_assistant
+from .services.survey_sessions import survey_sessions
+from .utils.metrics import metrics
+from .utils.whatsapp_utils import process_whatsapp_message, send_template_message, fetch_media_data, notify_user
 
 
 def create_app():
@@ -10,9 +24,32 @@ def create_app():
 
     # Load configurations and logging settings
     load_configurations(app)
-    configure_logging()
+    configure_logging(app)
 
     # Import and register blueprints, if any
     app.register_blueprint(webhook_blueprint)
+    register_commands(app)
+
+    # connects on the first query; the schema is created by `flask init-db`
+    database = WADatabase.from_config(app.config)
+    app.extensions["database"] = database
+
+    broadcasts.init_app(app, database, send_template_message)
+    deduplicator.init_app(app, database)
+    status_ingest.init_app(app, database)
+    media_pipeline.init_app(app, database, fetch_media_data, notify_user)
+    faq_responder.init_app(app)
+    survey_sessions.init_app(app, database)
+    metrics.init_app(app)
+
+    if app.config["AI_FALLBACK"]:
+        try:
+            load_assistant()
+        except Exception as e:
+            # retried on the first AI answer
+            logging.error("Error while loading the OpenAI assistant: %s", e)
+
+    if app.config["WEBHOOK_ASYNC"]:
+        message_queue.init_app(app, process_whatsapp_message)
 
-    return app
\ No newline at end of file
+    return app
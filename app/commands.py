@@ -0,0 +1,47 @@
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .utils.db import get_database
+from .utils.faq_index import build_index, extract_pairs, read_pdf_text
+
+
+@click.command("init-db")
+@with_appcontext
+def init_db_command():
+    '''
+    Applies the pending schema migrations (tables, indexes, triggers). Safe to run on every deploy.
+    '''
+    for migration in get_database().create_tables():
+        click.echo(f"Applied migration {migration.version}: {migration.name}")
+    click.echo("Database schema is up to date.")
+
+
+@click.command("build-faq-index")
+@click.argument("pdfs", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option("--output", default=None, help="defaults to FAQ_INDEX_PATH")
+@with_appcontext
+def build_faq_index_command(pdfs, output):
+    '''
+    Extracts the Q/A pairs of the FAQ PDFs (FAQ_SOURCES by default) into the FAQ index. Needs pypdf.
+    '''
+    output = output or current_app.config["FAQ_INDEX_PATH"]
+    pairs = []
+    for path in pdfs or current_app.config["FAQ_SOURCES"]:
+        found = extract_pairs(read_pdf_text(path))
+        click.echo(f"{path}: {len(found)} answers")
+        pairs.extend(found)
+    data = build_index(pairs)
+    # written next to the old index and renamed, running workers keep their mapping of the old file
+    tmp_path = output + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, output)
+    click.echo(f"Wrote {len(pairs)} answers to {output} ({len(data)} bytes)")
+
+
+def register_commands(app):
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(build_faq_index_command)
@@ -1,7 +1,26 @@
 import sys
 import os
+import atexit
+import queue
 from dotenv import load_dotenv
 import logging
+import logging.handlers
+
+from app.utils.log_handlers import JsonFormatter, NonBlockingQueueHandler, RedactingFilter, SamplingFilter
+
+
+def _env_bool(name, default=False):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return int(value)
 
 
 def load_configurations(app):
@@ -14,11 +33,149 @@ def load_configurations(app):
     app.config["VERSION"] = os.getenv("VERSION")
     app.config["PHONE_NUMBER_ID"] = os.getenv("PHONE_NUMBER_ID")
     app.config["VERIFY_TOKEN"] = os.getenv("VERIFY_TOKEN")
+    # Postgres, connected on first use (the schema is created by `flask init-db`)
+    app.config["DB_CONFIG"] = {
+        'host': os.getenv("DBHOST"),
+        'database': os.getenv("DBNAME"),
+        'user': os.getenv("DBUSER"),
+        'password': os.getenv("DBPASSWORD"),
+        'port': os.getenv("DBPORT")
+    }
+    app.config["DB_POOL_MIN"] = _env_int("DB_POOL_MIN", 1)
+    app.config["DB_POOL_MAX"] = _env_int("DB_POOL_MAX", 10)
+    app.config["VACANCY_CACHE_TTL"] = _env_int("VACANCY_CACHE_TTL", 300)
+    # prepare the frequent statements once per connection; turn off behind pgbouncer in transaction mode
+    app.config["DB_PREPARE"] = _env_bool("DB_PREPARE", True)
+    # Check X-Hub-Signature-256 of every webhook against APP_SECRET
+    app.config["VERIFY_WEBHOOK_SIGNATURE"] = _env_bool("VERIFY_WEBHOOK_SIGNATURE")
+
+    # Logging, see configure_logging
+    app.config["LOG_LEVEL"] = os.getenv("LOG_LEVEL", "INFO").upper()
+    app.config["LOG_FORMAT"] = os.getenv("LOG_FORMAT", "text")
+    app.config["LOG_ASYNC"] = _env_bool("LOG_ASYNC")
+    app.config["LOG_SAMPLE_RATES"] = _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "body=1,headers=1,response=1"))
+
+    # Pooled keep-alive client for graph.facebook.com
+    app.config["GRAPH_API_URL"] = os.getenv("GRAPH_API_URL", "https://graph.facebook.com")
+    app.config["GRAPH_POOL_SIZE"] = _env_int("GRAPH_POOL_SIZE", 20)
+    app.config["GRAPH_CONNECT_TIMEOUT"] = float(os.getenv("GRAPH_CONNECT_TIMEOUT") or 3.05)
+    app.config["GRAPH_READ_TIMEOUT"] = float(os.getenv("GRAPH_READ_TIMEOUT") or 10)
+    # Outbound messages per second of this process (the Cloud API tier is per phone number,
+    # so divide it by the number of worker processes)
+    app.config["GRAPH_RATE_LIMIT"] = float(os.getenv("GRAPH_RATE_LIMIT") or 80)
+    app.config["GRAPH_RATE_BURST"] = float(os.getenv("GRAPH_RATE_BURST") or 0) or None
+    app.config["GRAPH_BROADCAST_SHARE"] = float(os.getenv("GRAPH_BROADCAST_SHARE") or 0.8)
+    app.config["GRAPH_MAX_RETRIES"] = _env_int("GRAPH_MAX_RETRIES", 3)
+    # seconds a send waits for the rate limiter before it fails
+    app.config["GRAPH_ACQUIRE_TIMEOUT"] = float(os.getenv("GRAPH_ACQUIRE_TIMEOUT") or 60)
+
+    # Number of template messages sent in parallel by a /send_messages broadcast
+    app.config["BROADCAST_CONCURRENCY"] = _env_int("BROADCAST_CONCURRENCY", 8)
+
+    # Delivery/read statuses are written in batches of this size or after this many seconds
+    app.config["STATUS_BATCH_SIZE"] = _env_int("STATUS_BATCH_SIZE", 500)
+    app.config["STATUS_FLUSH_INTERVAL"] = float(os.getenv("STATUS_FLUSH_INTERVAL") or 2)
+    app.config["STATUS_BUFFER_MAX"] = _env_int("STATUS_BUFFER_MAX", 50000)
+
+    # Webhook redeliveries are dropped by message id: "memory" (per process) or "postgres" (shared)
+    app.config["DEDUP_BACKEND"] = os.getenv("DEDUP_BACKEND", "memory")
+    app.config["DEDUP_MAX_SIZE"] = _env_int("DEDUP_MAX_SIZE", 10000)
+    app.config["DEDUP_TTL"] = _env_int("DEDUP_TTL", 24 * 60 * 60)
+
+    # Documents sent by users are downloaded in the background into MEDIA_ROOT, stored once per sha256
+    app.config["MEDIA_ROOT"] = os.getenv("MEDIA_ROOT", "downloads")
+    app.config["MEDIA_MAX_BYTES"] = _env_int("MEDIA_MAX_BYTES", 25 * 1024 * 1024)
+    app.config["MEDIA_WORKERS"] = _env_int("MEDIA_WORKERS", 2)
+    app.config["MEDIA_QUEUE_SIZE"] = _env_int("MEDIA_QUEUE_SIZE", 100)
+
+    # Answers from the local FAQ index (flask build-faq-index) of the curated HR PDFs in FAQ_SOURCES.
+    # A match needs FAQ_MIN_TERMS known words of the question, a BM25 score of FAQ_MIN_SCORE and a
+    # confidence (0..1) of FAQ_MIN_CONFIDENCE; other questions go to the OpenAI assistant if
+    # AI_FALLBACK is on, else get the greeting template
+    app.config["FAQ_SOURCES"] = [
+        path.strip() for path in os.getenv("FAQ_SOURCES", "data/HR_information.pdf").split(",") if path.strip()
+    ]
+    app.config["FAQ_INDEX_PATH"] = os.getenv("FAQ_INDEX_PATH", "data/faq.idx")
+    app.config["FAQ_MIN_CONFIDENCE"] = float(os.getenv("FAQ_MIN_CONFIDENCE") or 0.5)
+    app.config["FAQ_MIN_SCORE"] = float(os.getenv("FAQ_MIN_SCORE") or 3.0)
+    app.config["FAQ_MIN_TERMS"] = _env_int("FAQ_MIN_TERMS", 2)
+    app.config["AI_FALLBACK"] = _env_bool("AI_FALLBACK")
+
+    # Survey state cache: seconds to keep a user's state in memory (0 = always read it from Postgres).
+    # Only safe when all messages of a user reach the same process, e.g. a single gunicorn worker.
+    app.config["SESSION_CACHE_TTL"] = _env_int("SESSION_CACHE_TTL", 0)
+    app.config["SESSION_CACHE_SIZE"] = _env_int("SESSION_CACHE_SIZE", 10000)
+    # batch survey writes and save them every SESSION_FLUSH_INTERVAL seconds (needs the cache)
+    app.config["SESSION_WRITE_BEHIND"] = _env_bool("SESSION_WRITE_BEHIND")
+    app.config["SESSION_FLUSH_INTERVAL"] = float(os.getenv("SESSION_FLUSH_INTERVAL") or 1)
+
+    # Acknowledge webhooks right away and process messages on a worker pool
+    app.config["WEBHOOK_ASYNC"] = _env_bool("WEBHOOK_ASYNC")
+    app.config["WEBHOOK_WORKERS"] = _env_int("WEBHOOK_WORKERS", 4)
+    app.config["WEBHOOK_QUEUE_SIZE"] = _env_int("WEBHOOK_QUEUE_SIZE", 1000)
+
+    # GET /metrics (Prometheus). With several worker processes set METRICS_DIR, where they share their
+    # numbers; it must be emptied on every service start. Unset, each process only reports its own.
+    # METRICS_TOKEN, if set, is required as a bearer token
+    app.config["METRICS_DIR"] = os.getenv("METRICS_DIR", "")
+    app.config["METRICS_FLUSH_INTERVAL"] = float(os.getenv("METRICS_FLUSH_INTERVAL") or 5)
+    app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN", "")
+
+
+def _parse_sample_rates(value):
+    '''
+    "body=0.01,headers=0.1" -> {"body": 0.01, "headers": 0.1}
+    '''
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            category, rate = item.split("=", 1)
+            rates[category.strip()] = float(rate)
+    return rates
+
+
+_log_listener = None
+
+
+def _stop_log_listener():
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+# registered once; it stops whichever listener the last configure_logging started
+atexit.register(_stop_log_listener)
+
+
+def configure_logging(app=None):
+    '''
+    Logs go to stdout, as text or JSON lines (LOG_FORMAT). With LOG_ASYNC the request threads only
+    put records on a queue and a background thread formats and writes them. Records logged with
+    extra={"category": ...} are sampled by LOG_SAMPLE_RATES and tokens are redacted.
+    '''
+    global _log_listener
+    config = app.config if app is not None else {}
+    level = config.get("LOG_LEVEL", "INFO")
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if config.get("LOG_FORMAT") == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    stream_handler.addFilter(RedactingFilter())
 
+    previous_listener = _log_listener
+    if config.get("LOG_ASYNC"):
+        log_queue = queue.SimpleQueue()
+        handler = NonBlockingQueueHandler(log_queue)
+        _log_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _log_listener.start()
+    else:
+        handler = stream_handler
+        _log_listener = None
+    # sampling runs before anything is formatted or queued
+    handler.addFilter(SamplingFilter(config.get("LOG_SAMPLE_RATES", {})))
 
-def configure_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        stream=sys.stdout,
-    )
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+    # after the switch, so it still writes out what was queued before
+    if previous_listener is not None:
+        previous_listener.stop()
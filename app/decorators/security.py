@@ -1,25 +1,51 @@
-from functools import wraps
-from flask import current_app, jsonify, request
+from functools import lru_cache, wraps
+from flask import current_app, g, jsonify, request
 import logging
 import hashlib
 import hmac
 
+from app.utils.fastjson import loads
+
+
+@lru_cache(maxsize=4)
+def _hmac_template(app_secret):
+    # keyed once per secret, every request only copies the prepared state
+    return hmac.new(bytes(app_secret, "latin-1"), digestmod=hashlib.sha256)
+
 
 def validate_signature(payload, signature):
     """
-    Validate the incoming payload's signature against our expected signature
+    Validate the incoming payload's signature against our expected signature.
+    The payload is the raw request body (bytes), so it is hashed exactly as it was received.
     """
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+
     # Use the App Secret to hash the payload
-    expected_signature = hmac.new(
-        bytes(current_app.config["APP_SECRET"], "latin-1"),
-        msg=payload.encode("utf-8"),
-        digestmod=hashlib.sha256,
-    ).hexdigest()
+    mac = _hmac_template(current_app.config["APP_SECRET"]).copy()
+    mac.update(payload)
+    expected_signature = mac.hexdigest()
 
     # Check if the signature matches
     return hmac.compare_digest(expected_signature, signature)
 
 
+def _check_signature(payload):
+    '''
+    Returns an error response if the X-Hub-Signature-256 header does not match the payload
+    '''
+    signature = request.headers.get("X-Hub-Signature-256", "")
+    if signature.startswith("sha256="):
+        signature = signature[7:]  # Remove 'sha256='
+    else:
+        logging.info("Signature format invalid!")
+        return jsonify({"status": "error", "message": "Invalid signature format"}), 403
+    if not validate_signature(payload, signature):
+        logging.info("Signature verification failed!")
+        return jsonify({"status": "error", "message": "Invalid signature"}), 403
+    return None
+
+
 def signature_required(f):
     """
     Decorator to ensure that the incoming requests to our webhook are valid and signed with the correct signature.
@@ -27,15 +53,37 @@ def signature_required(f):
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        signature = request.headers.get("X-Hub-Signature-256", "")
-        if signature.startswith("sha256="):
-            signature = signature[7:]  # Remove 'sha256='
-        else:
-            logging.info("Signature format invalid!")
-            return jsonify({"status": "error", "message": "Invalid signature format"}), 403
-        if not validate_signature(request.data.decode("utf-8"), signature):
-            logging.info("Signature verification failed!")
-            return jsonify({"status": "error", "message": "Invalid signature"}), 403
+        error = _check_signature(request.get_data(cache=True))
+        if error is not None:
+            return error
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def webhook_payload(f):
+    """
+    Decorator for the webhook ingest path: verifies the signature over the raw body bytes
+    (if VERIFY_WEBHOOK_SIGNATURE is enabled) and parses the JSON exactly once into `g.webhook_body`
+    for the handlers downstream.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        payload = request.get_data(cache=True)
+        if current_app.config["VERIFY_WEBHOOK_SIGNATURE"]:
+            error = _check_signature(payload)
+            if error is not None:
+                return error
+        try:
+            body = loads(payload)
+        except ValueError:  # JSONDecodeError, or UnicodeDecodeError for bytes that are not UTF-8
+            logging.error("Failed to decode JSON")
+            return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
+        if not isinstance(body, dict):
+            logging.error("Webhook body is not a JSON object")
+            return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
+        g.webhook_body = body
         return f(*args, **kwargs)
 
     return decorated_function
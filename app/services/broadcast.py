@@ -0,0 +1,217 @@
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils.rate_limiter import BROADCAST
+
+# E.164: at most 15 digits, no leading zero
+_PHONE = re.compile(r"[1-9]\d{6,14}")
+_PHONE_SEPARATORS = re.compile(r"[\s()+.-]")
+
+
+def normalize_phone(value):
+    '''
+    "+7 (701) 234-56-78" -> "77012345678"; None if it is not a phone number
+    '''
+    if not isinstance(value, (str, int)) or isinstance(value, bool):
+        return None
+    number = _PHONE_SEPARATORS.sub("", str(value))
+    return number if _PHONE.fullmatch(number) else None
+
+
+class BroadcastJob:
+    '''
+    Progress of one /send_messages request.
+    '''
+
+    # a running job whose progress wasn't saved for this long belonged to a worker that stopped
+    STALE_AFTER = 60
+
+    def __init__(self, phones, template_name, code, rejected=0):
+        self.id = uuid.uuid4().hex
+        self.phones = phones
+        self.template_name = template_name
+        self.code = code
+        self.status = "queued"
+        self.error = None
+        # contacts without a valid number count as skipped
+        self.total = len(phones) + rejected
+        self.sent = 0
+        self.failed = 0
+        self.skipped = rejected
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_saved(cls, saved):
+        '''
+        A read-only job from WADatabase.get_broadcast_job, for jobs of other worker processes
+        '''
+        job = cls([], saved["template_name"], None)
+        job.id = saved["id"]
+        for key in ("status", "error", "total", "sent", "failed", "skipped", "created_at", "started_at", "finished_at"):
+            setattr(job, key, saved[key])
+        if job.status in ("queued", "running") and saved["seconds_since_update"] > cls.STALE_AFTER:
+            job.status = "interrupted"
+            job.error = "the worker process running the broadcast stopped"
+        return job
+
+    def count(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def progress(self):
+        '''
+        The columns of broadcast_jobs
+        '''
+        with self._lock:
+            sent, failed, skipped = self.sent, self.failed, self.skipped
+        return {
+            "id": self.id, "template_name": self.template_name, "status": self.status, "error": self.error,
+            "total": self.total, "sent": sent, "failed": failed, "skipped": skipped,
+            "created_at": self.created_at, "started_at": self.started_at, "finished_at": self.finished_at,
+        }
+
+    def to_dict(self):
+        with self._lock:
+            sent, failed, skipped = self.sent, self.failed, self.skipped
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "template": self.template_name,
+            "total": self.total,
+            "sent": sent,
+            "failed": failed,
+            "skipped": skipped,
+            "pending": self.total - sent - failed - skipped,
+            "elapsed_seconds": round(elapsed, 3) if elapsed is not None else None,
+            "messages_per_second": round((sent + failed) / elapsed, 2) if elapsed else 0.0,
+        }
+
+
+class BroadcastManager:
+    """
+    Runs template broadcasts in the background.
+
+    Users are created and opted-out numbers filtered with one set-based query each, then the
+    templates are sent concurrently by a bounded pool of threads. The job runs in the worker process
+    that got the request; its progress is saved to broadcast_jobs every SAVE_INTERVAL seconds, so
+    GET /send_messages/<job_id> works whichever worker answers it and after restarts.
+    """
+
+    SAVE_INTERVAL = 2.0
+
+    def __init__(self, max_jobs=100):
+        self.app = None
+        self.database = None
+        self.send = None
+        self.concurrency = 8
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, database, send):
+        '''
+        send(wa_id, template_name, code, lane=..., broadcast_id=...) must return the Graph API response
+        '''
+        self.app = app
+        self.database = database
+        self.send = send
+        self.concurrency = app.config["BROADCAST_CONCURRENCY"]
+
+    def submit(self, contacts, template_name, code):
+        phones = []
+        rejected = 0
+        for contact in contacts:
+            # one bad number must not fail create_users for the whole broadcast
+            number = normalize_phone(contact.get("phone") if isinstance(contact, dict) else None)
+            if number:
+                phones.append(number)
+            else:
+                rejected += 1
+        if rejected:
+            logging.warning("Broadcast: skipping %s contacts without a valid phone number", rejected)
+        # the same number listed twice should get the message once
+        phones = list(dict.fromkeys(phones))
+
+        job = BroadcastJob(phones, template_name, code, rejected=rejected)
+        with self._lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self._save(job)
+        threading.Thread(target=self._run, args=(job,), name=f"broadcast-{job.id[:8]}", daemon=True).start()
+        logging.info("Broadcast %s queued: %s numbers, template %s", job.id, job.total, template_name)
+        return job
+
+    def get(self, job_id):
+        '''
+        The job, from memory if this process runs it (most recent numbers), else from broadcast_jobs
+        '''
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        saved = self.database.get_broadcast_job(job_id)
+        return BroadcastJob.from_saved(saved) if saved is not None else None
+
+    def _save(self, job):
+        try:
+            self.database.save_broadcast_job(job)
+        except Exception as e:
+            # the broadcast goes on, only its progress is not visible to other workers for now
+            logging.error("Error while saving the progress of broadcast %s: %s", job.id, e)
+
+    def _run(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        self._save(job)
+        try:
+            self.database.create_users(job.phones)
+            notifiable = self.database.filter_notifiable(job.phones)
+            recipients = [phone for phone in job.phones if phone in notifiable]
+            job.skipped = job.total - len(recipients)
+
+            saved_at = time.monotonic()
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="broadcast-send") as executor:
+                for outcome in executor.map(lambda phone: self._send_one(job, phone), recipients):
+                    job.count(outcome)
+                    if time.monotonic() - saved_at >= self.SAVE_INTERVAL:
+                        self._save(job)
+                        saved_at = time.monotonic()
+            job.status = "done"
+        except Exception as e:
+            logging.exception("Broadcast %s failed: %s", job.id, e)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            job.phones = None
+            self._save(job)
+            logging.info("Broadcast %s finished: %s", job.id, job.to_dict())
+
+    def _send_one(self, job, phone):
+        try:
+            with self.app.app_context():
+                # the broadcast lane never takes throughput away from live conversations
+                response = self.send(phone, job.template_name, job.code, lane=BROADCAST, broadcast_id=job.id)
+        except Exception as e:
+            logging.error("Error sending %s to %s: %s", job.template_name, phone, e)
+            return "failed"
+        # the send helpers return an error tuple instead of a response when the request fails
+        if getattr(response, "ok", False):
+            return "sent"
+        return "failed"
+
+
+broadcasts = BroadcastManager()
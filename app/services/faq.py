@@ -0,0 +1,102 @@
+import logging
+import os
+import re
+import threading
+import time
+
+from app.utils.faq_index import FaqIndex
+
+# messages made only of these words get the greeting template with its buttons, never an FAQ answer
+GREETING_WORDS = {
+    "здравствуйте", "здравствуй", "привет", "приветствую", "добрый", "доброе", "день", "утро", "вечер",
+    "салем", "сәлем", "салам", "hello", "hi", "hey",
+}
+
+
+def is_greeting(text):
+    words = re.findall(r"\w+", text.lower().replace("ё", "е"))
+    return bool(words) and all(word in GREETING_WORDS for word in words)
+
+
+class FaqResponder:
+    """
+    Answers common questions from the local FAQ index (built by `flask build-faq-index`)
+    without an LLM call. A match must contain at least FAQ_MIN_TERMS words of the question and
+    reach a BM25 score of FAQ_MIN_SCORE and a confidence of FAQ_MIN_CONFIDENCE, so a single word
+    ("резюме") is never enough; the caller falls back to the assistant or the greeting template otherwise.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.min_confidence = 0.5
+        self.min_score = 3.0
+        self.min_terms = 2
+        self._lock = threading.Lock()
+        self._stats = {"queries": 0, "answered": 0, "low_confidence": 0, "no_match": 0, "ai_fallbacks": 0,
+                       "template_fallbacks": 0, "search_seconds_total": 0.0}
+
+    def init_app(self, app):
+        self.min_confidence = app.config["FAQ_MIN_CONFIDENCE"]
+        self.min_score = app.config["FAQ_MIN_SCORE"]
+        self.min_terms = app.config["FAQ_MIN_TERMS"]
+        path = app.config["FAQ_INDEX_PATH"]
+        if not os.path.exists(path):
+            logging.warning("FAQ index %s not found, FAQ answers are disabled", path)
+            return
+        try:
+            self.index = FaqIndex(path)
+        except (OSError, ValueError) as e:
+            logging.error("Error while loading the FAQ index %s: %s", path, e)
+            return
+        logging.info("Loaded FAQ index %s: %s answers", path, self.index.n_docs)
+
+    @property
+    def enabled(self):
+        return self.index is not None
+
+    def answer(self, text):
+        '''
+        The FAQ answer for the message, or None if there is no confident match
+        '''
+        if self.index is None:
+            return None
+        started = time.perf_counter()
+        results = self.index.search(text)
+        took = time.perf_counter() - started
+        if not results:
+            outcome, answer = "no_match", None
+        else:
+            match = results[0]
+            answer = match.answer
+            if (match.matched_terms >= self.min_terms and match.score >= self.min_score
+                    and match.confidence >= self.min_confidence):
+                outcome = "answered"
+                logging.info("FAQ match %.2f (score %.2f) for %r: %s", match.confidence, match.score, text, match.question)
+            else:
+                outcome, answer = "low_confidence", None
+        with self._lock:
+            self._stats["queries"] += 1
+            self._stats[outcome] += 1
+            self._stats["search_seconds_total"] += took
+        return answer
+
+    def record_fallback(self, to_ai):
+        with self._lock:
+            self._stats["ai_fallbacks" if to_ai else "template_fallbacks"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        queries = stats.pop("queries")
+        search_seconds = stats.pop("search_seconds_total")
+        stats.update({
+            "enabled": self.enabled,
+            "answers": self.index.n_docs if self.index is not None else 0,
+            "queries": queries,
+            "hit_rate": round(stats["answered"] / queries, 4) if queries else 0.0,
+            "search_us_avg": round(1e6 * search_seconds / queries, 1) if queries else 0.0,
+        })
+        return stats
+
+
+faq_responder = FaqResponder()
@@ -0,0 +1,190 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlparse
+
+from app.utils.graph_client import get_graph_client
+from app.utils.media_store import MediaStore, MediaTooLarge
+
+
+class MediaPipeline:
+    """
+    Downloads media sent by users (resumes) in the background, so the webhook never waits for it.
+
+    A bounded queue is drained by MEDIA_WORKERS threads. Each download is streamed into the
+    content-addressed MediaStore under MEDIA_ROOT, files over MEDIA_MAX_BYTES are rejected, and a
+    file we already have (by the sha256 from the media metadata) is not downloaded again.
+    Media metadata is cached until its download URL expires.
+    """
+
+    URL_TTL = 5 * 60  # download URLs are valid for 5 minutes unless the URL says otherwise
+    CACHE_SIZE = 1000
+
+    def __init__(self):
+        self.app = None
+        self.database = None
+        self.store = None
+        self.fetch_info = None
+        self.notify = None
+        self.queue = None
+        self.num_workers = 0
+        self.workers = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._info = OrderedDict()  # media_id -> (expires_at, metadata)
+        self._stats = {
+            "submitted": 0, "rejected": 0, "stored": 0, "deduplicated": 0, "too_large": 0, "failed": 0,
+            "bytes": 0, "info_hits": 0, "info_misses": 0,
+        }
+
+    def init_app(self, app, database, fetch_info, notify):
+        '''
+        fetch_info(media_id) returns the Graph media metadata, notify(wa_id, text) messages the user
+        '''
+        self.app = app
+        self.database = database
+        self.fetch_info = fetch_info
+        self.notify = notify
+        self.store = MediaStore(app.config["MEDIA_ROOT"], app.config["MEDIA_MAX_BYTES"])
+        self.num_workers = app.config["MEDIA_WORKERS"]
+        self.queue = queue.Queue(maxsize=app.config["MEDIA_QUEUE_SIZE"])
+        atexit.register(self.stop)
+
+    def _ensure_started(self):
+        # threads do not survive a fork, start them in the serving process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.workers = []
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._work, name=f"media-worker-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            self._pid = os.getpid()
+
+    def submit(self, wa_id, media_id, filename=None, survey_key=None):
+        '''
+        Queues a download. Returns False if the queue is full.
+        With survey_key the stored file is also saved as that answer of the user's survey.
+        '''
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((wa_id, media_id, filename, survey_key))
+        except queue.Full:
+            self._count("rejected")
+            return False
+        self._count("submitted")
+        return True
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            wa_id, media_id, filename, survey_key = item
+            with self.app.app_context():
+                try:
+                    self.download(wa_id, media_id, filename, survey_key)
+                except MediaTooLarge as e:
+                    self._count("too_large")
+                    logging.warning("Media %s from %s rejected: %s", media_id, wa_id, e)
+                    megabytes = round(self.store.max_bytes / (1024 * 1024), 1)
+                    self._notify(wa_id, f'Файл слишком большой, максимальный размер {megabytes:g} МБ.')
+                except Exception as e:
+                    self._count("failed")
+                    # the details are for the log only, they may name hosts, paths or tokens
+                    logging.exception("Error while downloading media %s: %s", media_id, e)
+                    self._notify(wa_id, 'Не удалось обработать отправленный документ, пожалуйста, отправьте его ещё раз.')
+            self.queue.task_done()
+
+    def _notify(self, wa_id, text):
+        try:
+            self.notify(wa_id, text)
+        except Exception as e:
+            logging.error("Error while notifying %s: %s", wa_id, e)
+
+    def media_info(self, media_id):
+        '''
+        Graph metadata of the media (url, mime_type, sha256, file_size), cached until the url expires
+        '''
+        now = time.time()
+        with self._lock:
+            cached = self._info.get(media_id)
+            if cached is not None and cached[0] > now:
+                self._stats["info_hits"] += 1
+                return cached[1]
+            self._stats["info_misses"] += 1
+        info = self.fetch_info(media_id)
+        expires_at = self._url_expiry(info.get("url", ""), now)
+        with self._lock:
+            self._info[media_id] = (expires_at, info)
+            self._info.move_to_end(media_id)
+            while len(self._info) > self.CACHE_SIZE:
+                self._info.popitem(last=False)
+        return info
+
+    def _url_expiry(self, url, now):
+        # lookaside URLs carry their expiry as the unix time in `ext`
+        try:
+            expires_at = float(parse_qs(urlparse(url).query)["ext"][0])
+        except (KeyError, IndexError, ValueError):
+            expires_at = now + self.URL_TTL
+        return min(expires_at, now + self.URL_TTL) - 10  # a little before, so the download doesn't race it
+
+    def download(self, wa_id, media_id, filename=None, survey_key=None):
+        '''
+        Stores one media file and records it for the user, returns its path
+        '''
+        info = self.media_info(media_id)
+        size = info.get("file_size")
+        if size and int(size) > self.store.max_bytes:
+            raise MediaTooLarge(int(size), self.store.max_bytes)
+        ext = self.store.extension(info.get("mime_type"), filename)
+
+        path = self.store.find(info.get("sha256"), ext)
+        if path is not None:
+            sha256 = info["sha256"].lower()
+            self._count("deduplicated")
+        else:
+            with get_graph_client().download(info["url"]) as response:
+                response.raise_for_status()
+                sha256, path, size = self.store.save(response.iter_content(chunk_size=64 * 1024), ext)
+            if info.get("sha256") and info["sha256"].lower() != sha256:
+                logging.warning("Media %s: sha256 %s differs from the metadata", media_id, sha256)
+            self._count("stored")
+            self._count("bytes", size)
+        self.database.save_media_file(wa_id, sha256, filename, info.get("mime_type"), int(size or 0), path)
+        if survey_key is not None:
+            self.database.save_survey_results(wa_id, survey_key, path)
+        logging.info("Stored media %s from %s as %s", media_id, wa_id, path)
+        return path
+
+    def stop(self, timeout=10):
+        if self._pid != os.getpid():
+            return
+        for _ in self.workers:
+            self.queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        self._pid = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.queue.qsize() if self.queue is not None else 0
+        return stats
+
+
+media_pipeline = MediaPipeline()
@@ -0,0 +1,142 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+
+class MessageQueue:
+    """
+    Bounded in-process queue of parsed webhook events drained by a pool of worker threads.
+
+    The webhook only validates and enqueues the event, so Meta gets its 200 right away.
+    Workers run the handler inside an application context because the send helpers
+    read their settings from `current_app`.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.handler = None
+        self.queue = None
+        self.num_workers = 0
+        self.workers = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "processed": 0,
+            "failed": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "processing_seconds_total": 0.0,
+            "processing_seconds_max": 0.0,
+        }
+
+    def init_app(self, app, handler):
+        self.app = app
+        self.handler = handler
+        self.num_workers = app.config["WEBHOOK_WORKERS"]
+        self.queue = queue.Queue(maxsize=app.config["WEBHOOK_QUEUE_SIZE"])
+        atexit.register(self.stop)
+
+    @property
+    def enabled(self):
+        return self.app is not None
+
+    def _ensure_started(self):
+        # Worker threads do not survive a fork, so (re)start them lazily in the serving process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.workers = []
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._work, name=f"webhook-worker-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            self._pid = os.getpid()
+            logging.info("Started %s webhook workers", self.num_workers)
+
+    def submit(self, body):
+        '''
+        Enqueue a webhook event. Returns False if the queue is full.
+        '''
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((time.monotonic(), body))
+        except queue.Full:
+            with self._lock:
+                self._stats["rejected"] += 1
+            return False
+        with self._lock:
+            self._stats["enqueued"] += 1
+        return True
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            enqueued_at, body = item
+            started_at = time.monotonic()
+            failed = False
+            try:
+                with self.app.app_context():
+                    self.handler(body)
+            except Exception as e:
+                failed = True
+                logging.exception("Error while processing queued message: %s", e)
+            finished_at = time.monotonic()
+            self._record(started_at - enqueued_at, finished_at - started_at, failed)
+            self.queue.task_done()
+
+    def _record(self, waited, took, failed):
+        with self._lock:
+            stats = self._stats
+            stats["failed" if failed else "processed"] += 1
+            stats["wait_seconds_total"] += waited
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+            stats["processing_seconds_total"] += took
+            stats["processing_seconds_max"] = max(stats["processing_seconds_max"], took)
+
+    def stop(self, timeout=10):
+        '''
+        Let the workers drain what is already queued and exit.
+        '''
+        if self._pid != os.getpid():
+            return
+        for _ in self.workers:
+            self.queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        self._pid = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        done = stats["processed"] + stats["failed"]
+        return {
+            "enabled": self.enabled,
+            "workers": self.num_workers,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "queue_size": self.queue.maxsize if self.queue is not None else 0,
+            "enqueued": stats["enqueued"],
+            "rejected": stats["rejected"],
+            "processed": stats["processed"],
+            "failed": stats["failed"],
+            "wait_ms_avg": round(1000 * stats["wait_seconds_total"] / done, 3) if done else 0.0,
+            "wait_ms_max": round(1000 * stats["wait_seconds_max"], 3),
+            "processing_ms_avg": round(1000 * stats["processing_seconds_total"] / done, 3) if done else 0.0,
+            "processing_ms_max": round(1000 * stats["processing_seconds_max"], 3),
+        }
+
+
+message_queue = MessageQueue()
@@ -1,19 +1,58 @@
-from openai import OpenAI
-import shelve
-from dotenv import load_dotenv
 import os
+import threading
 import time
 import logging
+from collections import OrderedDict
 
-load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")
-client = OpenAI(api_key=OPENAI_API_KEY)
+from app.utils.db import get_database
+
+# OPENAI_API_KEY and OPENAI_ASSISTANT_ID are read on use, .env is loaded once by load_configurations
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    '''
+    The OpenAI client, created on first use so that importing this module doesn't import openai.
+    '''
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+
+                _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
+
+
+class _LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+# wa_id -> thread_id; a mapping never changes once created, so entries don't need to expire
+_threads = _LRUCache(10000)
 
 
 def upload_file(path):
     # Upload a file with an "assistants" purpose
-    file = client.files.create(
+    file = get_client().files.create(
         file=open("../../data/airbnb-faq.pdf", "rb"), purpose="assistants"
     )
 
@@ -22,7 +61,7 @@ def create_assistant(file):
     """
     You currently cannot set the temperature for Assistant via the API.
     """
-    assistant = client.beta.assistants.create(
+    assistant = get_client().beta.assistants.create(
         name="WhatsApp AirBnb Assistant",
         instructions="You're a helpful WhatsApp assistant that can assist guests that are staying in our Paris AirBnb. Use your knowledge base to best respond to customer queries. If you don't know the answer, say simply that you cannot help with question and advice to contact the host directly. Be friendly and funny.",
         tools=[{"type": "retrieval"}],
@@ -32,66 +71,183 @@ def create_assistant(file):
     return assistant
 
 
-# Use context manager to ensure the shelf file is closed properly
 def check_if_thread_exists(wa_id):
-    with shelve.open("threads_db") as threads_shelf:
-        return threads_shelf.get(wa_id, None)
-
-
-def store_thread(wa_id, thread_id):
-    with shelve.open("threads_db", writeback=True) as threads_shelf:
-        threads_shelf[wa_id] = thread_id
-
-
-def run_assistant(thread, name):
-    # Retrieve the Assistant
-    assistant = client.beta.assistants.retrieve(OPENAI_ASSISTANT_ID)
-
-    # Run the assistant
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant.id,
-        # instructions=f"You are having a conversation with {name}",
+    '''
+    Thread id of the user or None, from the in-process cache or the assistant_threads table
+    '''
+    thread_id = _threads.get(wa_id)
+    if thread_id is None:
+        thread_id = get_database().get_thread_id(wa_id)
+        if thread_id is not None:
+            _threads.put(wa_id, thread_id)
+    return thread_id
+
+
+def get_or_create_thread(wa_id):
+    '''
+    Thread id of the user, creating the OpenAI thread on the first message. The thread is created
+    before touching the database, so no connection waits for OpenAI; if a concurrent first message
+    saved its thread first, that one is used and ours is deleted. Returns (thread_id, created).
+    '''
+    thread_id = check_if_thread_exists(wa_id)
+    if thread_id is not None:
+        return thread_id, False
+    new_thread_id = get_client().beta.threads.create().id
+    thread_id, created = get_database().save_thread_id(wa_id, new_thread_id)
+    if not created:
+        try:
+            get_client().beta.threads.delete(new_thread_id)
+        except Exception as e:
+            logging.warning("Could not delete the unused thread %s: %s", new_thread_id, e)
+    _threads.put(wa_id, thread_id)
+    return thread_id, created
+
+
+class AssistantRunError(Exception):
+    '''
+    The run ended without an answer: failed, expired, cancelled or over the deadline.
+    '''
+
+    def __init__(self, status, detail=None):
+        super().__init__(f"assistant run {status}" + (f": {detail}" if detail else ""))
+        self.status = status
+
+
+_assistant = None
+_assistant_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"runs": 0, "completed": 0, "failed": 0, "first_tokens": 0, "ttft_seconds_total": 0.0,
+          "run_seconds_total": 0.0, "run_seconds_max": 0.0}
+
+_TERMINAL_EVENTS = {
+    "thread.run.failed": "failed",
+    "thread.run.expired": "expired",
+    "thread.run.cancelled": "cancelled",
+    "thread.run.incomplete": "incomplete",
+    # the assistant has no tools of ours to call, so it can't continue
+    "thread.run.requires_action": "requires_action",
+}
+
+
+def load_assistant():
+    '''
+    Retrieves the assistant object. Called once by the app factory when AI_FALLBACK is on.
+    '''
+    global _assistant
+    client = get_client()  # before the lock, get_client takes _client_lock itself
+    with _assistant_lock:
+        if _assistant is None:
+            _assistant = client.beta.assistants.retrieve(os.getenv("OPENAI_ASSISTANT_ID"))
+    return _assistant
+
+
+def get_assistant():
+    '''
+    The assistant loaded at startup, or retrieved now if that failed.
+    '''
+    return _assistant if _assistant is not None else load_assistant()
+
+
+def _record_run(completed, ttft, took):
+    with _stats_lock:
+        _stats["runs"] += 1
+        _stats["completed" if completed else "failed"] += 1
+        if ttft is not None:
+            _stats["first_tokens"] += 1
+            _stats["ttft_seconds_total"] += ttft
+        _stats["run_seconds_total"] += took
+        _stats["run_seconds_max"] = max(_stats["run_seconds_max"], took)
+
+
+def run_assistant(thread_id, name, timeout=None):
+    '''
+    Runs the assistant on the thread and returns its answer, reading the run as a stream of events
+    instead of polling. Gives up (and cancels the run) after `timeout` seconds, OPENAI_RUN_TIMEOUT by default.
+    '''
+    timeout = timeout or float(os.getenv("OPENAI_RUN_TIMEOUT") or 30)
+    started = time.monotonic()
+    deadline = started + timeout
+    ttft = None
+    run_id = None
+    parts = []
+    answer = None
+    completed = False
+    try:
+        with get_client().beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=get_assistant().id,
+            # instructions=f"You are having a conversation with {name}",
+            timeout=timeout,
+        ) as stream:
+            for event in stream:
+                if event.event == "thread.run.created":
+                    run_id = event.data.id
+                elif event.event == "thread.message.delta":
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                    for block in event.data.delta.content or []:
+                        if block.type == "text" and block.text and block.text.value:
+                            parts.append(block.text.value)
+                elif event.event == "thread.message.completed":
+                    texts = [block.text.value for block in event.data.content if block.type == "text"]
+                    answer = "".join(texts) or answer
+                elif event.event == "thread.run.completed":
+                    completed = True
+                elif event.event in _TERMINAL_EVENTS:
+                    last_error = getattr(event.data, "last_error", None)
+                    raise AssistantRunError(_TERMINAL_EVENTS[event.event], last_error.message if last_error else None)
+                if time.monotonic() > deadline:
+                    raise AssistantRunError("timed_out", f"no answer after {timeout} s")
+        if not completed:
+            raise AssistantRunError("interrupted", "the event stream ended before the run completed")
+    except Exception as e:
+        took = time.monotonic() - started
+        _record_run(False, ttft, took)
+        if run_id is not None and getattr(e, "status", None) in ("timed_out", "requires_action"):
+            try:
+                get_client().beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+            except Exception as cancel_error:
+                logging.warning("Could not cancel run %s: %s", run_id, cancel_error)
+        logging.error("Assistant run for %s failed after %.2f s: %s", name, took, e)
+        raise
+
+    took = time.monotonic() - started
+    _record_run(True, ttft, took)
+    new_message = answer if answer is not None else "".join(parts)
+    logging.info(
+        "Generated message in %.2f s (first token after %s s): %s",
+        took, f"{ttft:.2f}" if ttft is not None else "-", new_message,
     )
-
-    # Wait for completion
-    # https://platform.openai.com/docs/assistants/how-it-works/runs-and-run-steps#:~:text=under%20failed_at.-,Polling%20for%20updates,-In%20order%20to
-    while run.status != "completed":
-        # Be nice to the API
-        time.sleep(0.5)
-        run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-
-    # Retrieve the Messages
-    messages = client.beta.threads.messages.list(thread_id=thread.id)
-    new_message = messages.data[0].content[0].text.value
-    logging.info(f"Generated message: {new_message}")
     return new_message
 
 
-def generate_ai_response(message_body, wa_id, name):
-    # Check if there is already a thread_id for the wa_id
-    thread_id = check_if_thread_exists(wa_id)
+def stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    runs, first_tokens = stats["runs"], stats["first_tokens"]
+    return {
+        "runs": runs,
+        "completed": stats["completed"],
+        "failed": stats["failed"],
+        "ttft_ms_avg": round(1000 * stats["ttft_seconds_total"] / first_tokens, 3) if first_tokens else 0.0,
+        "run_ms_avg": round(1000 * stats["run_seconds_total"] / runs, 3) if runs else 0.0,
+        "run_ms_max": round(1000 * stats["run_seconds_max"], 3),
+    }
 
-    # If a thread doesn't exist, create one and store it
-    if thread_id is None:
-        logging.info(f"Creating new thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.create()
-        store_thread(wa_id, thread.id)
-        thread_id = thread.id
 
-    # Otherwise, retrieve the existing thread
-    else:
-        logging.info(f"Retrieving existing thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.retrieve(thread_id)
+def generate_ai_response(message_body, wa_id, name):
+    # the id is all the next calls need, the thread itself is never retrieved
+    thread_id, created = get_or_create_thread(wa_id)
+    logging.info("%s thread for %s with wa_id %s", "Created new" if created else "Using existing", name, wa_id)
 
     # Add message to thread
-    message = client.beta.threads.messages.create(
+    get_client().beta.threads.messages.create(
         thread_id=thread_id,
         role="user",
         content=message_body,
     )
 
     # Run the assistant and get the new message
-    new_message = run_assistant(thread, name)
+    new_message = run_assistant(thread_id, name)
 
     return new_message
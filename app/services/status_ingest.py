@@ -0,0 +1,173 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+from app.utils.db import TRANSIENT_ERRORS, save_one_by_one
+
+
+class StatusIngest:
+    """
+    Buffers delivery/read status callbacks and the ids of sent templates in memory and writes
+    them to Postgres in batches, when STATUS_BATCH_SIZE events are waiting or every
+    STATUS_FLUSH_INTERVAL seconds, whichever comes first.
+    """
+
+    def __init__(self):
+        self.database = None
+        self.batch_size = 500
+        self.flush_interval = 2.0
+        self.max_buffered = 50000
+        self._statuses = []
+        self._outbound = []
+        self._cond = threading.Condition()
+        self._pid = None
+        self._stats = {"received": 0, "outbound": 0, "flushed": 0, "batches": 0, "failures": 0, "dropped": 0}
+
+    def init_app(self, app, database):
+        self.database = database
+        self.batch_size = app.config["STATUS_BATCH_SIZE"]
+        self.flush_interval = app.config["STATUS_FLUSH_INTERVAL"]
+        self.max_buffered = app.config["STATUS_BUFFER_MAX"]
+        atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return self.database is not None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="status-ingest", daemon=True).start()
+            self._pid = os.getpid()
+
+    def add_statuses(self, statuses):
+        '''
+        statuses - the value.statuses list of a webhook payload
+        '''
+        rows = []
+        for status in statuses if isinstance(statuses, list) else []:
+            row = self._parse_status(status)
+            if row is not None:
+                rows.append(row)
+        self._add(self._statuses, rows, "received")
+
+    @staticmethod
+    def _parse_status(status):
+        '''
+        A message_statuses row, or None for an entry without a message id or status.
+        A malformed timestamp or error code is stored as NULL.
+        '''
+        if not isinstance(status, dict) or not status.get("id") or not status.get("status"):
+            logging.warning("Skipping a malformed status: %.200r", status)
+            return None
+        timestamp = _to_int(status.get("timestamp"))
+        if status.get("timestamp") and timestamp is None:
+            logging.warning("Status of %s has an invalid timestamp: %.50r", status["id"], status["timestamp"])
+        errors = status.get("errors")
+        error = errors[0] if isinstance(errors, list) and errors and isinstance(errors[0], dict) else {}
+        return (
+            str(status["id"]),
+            status.get("recipient_id"),
+            str(status["status"]),
+            timestamp,
+            _to_int(error.get("code")),
+        )
+
+    def add_outbound(self, message_id, recipient_id, template_name, broadcast_id=None):
+        '''
+        Remembers which template (and broadcast) a sent message id belongs to, for the summaries.
+        '''
+        self._add(self._outbound, [(message_id, recipient_id, template_name, broadcast_id)], "outbound")
+
+    def _add(self, buffer, rows, counter):
+        if not self.enabled or not rows:
+            return
+        self._ensure_started()
+        with self._cond:
+            buffer.extend(rows)
+            self._stats[counter] += len(rows)
+            overflow = len(buffer) - self.max_buffered
+            if overflow > 0:
+                # the database has been unavailable for a while, keep the newest events
+                del buffer[:overflow]
+                self._stats["dropped"] += overflow
+            if len(self._statuses) + len(self._outbound) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: len(self._statuses) + len(self._outbound) >= self.batch_size, timeout=self.flush_interval
+                )
+            self.flush()
+
+    def flush(self):
+        with self._cond:
+            statuses, self._statuses = self._statuses, []
+            outbound, self._outbound = self._outbound, []
+        if not statuses and not outbound:
+            return
+        try:
+            # outbound first, so the summary can join the statuses that arrive right after
+            if outbound:
+                self.database.save_outbound_messages(outbound)
+                self._count_flushed(len(outbound))
+                outbound = []
+            if statuses:
+                self.database.save_message_statuses(statuses)
+                self._count_flushed(len(statuses))
+        except Exception as e:
+            logging.error("Error while saving %s statuses: %s", len(statuses), e)
+            with self._cond:
+                self._stats["failures"] += 1
+            if not isinstance(e, TRANSIENT_ERRORS):
+                # a row the database rejects would fail every batch it is in
+                outbound = self._save_one_by_one(self.database.save_outbound_messages, outbound, "the outbound message")
+                statuses = self._save_one_by_one(self.database.save_message_statuses, statuses, "the status of message")
+            with self._cond:
+                # put them back in front of whatever arrived meanwhile, _add trims the overflow
+                self._statuses[:0] = statuses
+                self._outbound[:0] = outbound
+            if statuses or outbound:
+                time.sleep(1)
+            return
+        with self._cond:
+            self._stats["batches"] += 1
+
+    def _count_flushed(self, rows):
+        with self._cond:
+            self._stats["flushed"] += rows
+
+    def _save_one_by_one(self, save, rows, description):
+        '''
+        Returns the rows to try again later
+        '''
+        dropped, retry = save_one_by_one(save, rows, description)
+        self._count_flushed(len(rows) - len(dropped) - len(retry))
+        with self._cond:
+            self._stats["dropped"] += len(dropped)
+        return retry
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._statuses) + len(self._outbound)
+        return stats
+
+
+def _to_int(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+status_ingest = StatusIngest()
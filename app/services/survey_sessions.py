@@ -0,0 +1,193 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.utils.db import TRANSIENT_ERRORS, save_one_by_one
+from app.utils.metrics import metrics
+
+
+class SurveySessions:
+    """
+    Survey state (survey_mode, current_step, ...) of the users who are talking to the bot right now.
+
+    Every answer is one transition (new step, survey mode, answers) written in a single transaction,
+    see WADatabase.apply_survey_transitions. With SESSION_CACHE_TTL > 0 the state is also kept in a
+    bounded in-memory map, so reading it costs no query; with SESSION_WRITE_BEHIND the transitions
+    are additionally batched and written every SESSION_FLUSH_INTERVAL seconds.
+
+    The cache is only correct if all messages of a user reach the same process, i.e. a single
+    worker process (gunicorn -w 1 with threads) or sticky routing; it is off by default.
+    """
+
+    USER_FIELDS = ("survey_mode", "current_step", "wants_notifications")
+
+    def __init__(self):
+        self.database = None
+        self.ttl = 0
+        self.max_size = 10000
+        self.write_behind = False
+        self.flush_interval = 1.0
+        self._sessions = OrderedDict()  # phone -> (expires_at, UserState)
+        self._pending = {}  # phone -> merged transition not written yet
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {"hits": 0, "misses": 0, "transitions": 0, "writes": 0, "batches": 0, "failures": 0,
+                       "dropped": 0}
+
+    def init_app(self, app, database):
+        self.database = database
+        self.ttl = app.config["SESSION_CACHE_TTL"]
+        self.max_size = app.config["SESSION_CACHE_SIZE"]
+        # without the cache a read would not see the transitions still waiting to be written
+        self.write_behind = app.config["SESSION_WRITE_BEHIND"] and self.ttl > 0
+        self.flush_interval = app.config["SESSION_FLUSH_INTERVAL"]
+        if self.write_behind:
+            atexit.register(self.flush)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="survey-sessions", daemon=True).start()
+            self._pid = os.getpid()
+
+    def get(self, phone):
+        '''
+        UserState of the user, creating the user on first contact
+        '''
+        if self.ttl > 0:
+            now = time.monotonic()
+            with self._lock:
+                cached = self._sessions.get(phone)
+                if cached is not None and cached[0] > now:
+                    self._sessions.move_to_end(phone)
+                    self._stats["hits"] += 1
+                    return cached[1]
+                self._stats["misses"] += 1
+                pending = phone in self._pending
+            if pending:
+                self.flush()  # evicted before its transitions were written
+        state = self.database.touch_user(phone)
+        self._remember(phone, state)
+        return state
+
+    def _remember(self, phone, state):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._sessions[phone] = (time.monotonic() + self.ttl, state)
+            self._sessions.move_to_end(phone)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+
+    def transition(self, phone, survey_mode=None, current_step=None, completed=None, wants_notifications=None,
+                   survey=None):
+        '''
+        Applies one step of the survey at once: any of the new survey_mode, current_step,
+        completed flag, wants_notifications and survey answers ({column: value}).
+        '''
+        change = {
+            key: value for key, value in (
+                ("survey_mode", survey_mode), ("current_step", current_step), ("completed", completed),
+                ("wants_notifications", wants_notifications),
+            ) if value is not None
+        }
+        if survey:
+            change["survey"] = dict(survey)
+        if completed:
+            metrics.inc("wahr_survey_transitions_total", step="completed")
+        elif current_step is not None:
+            metrics.inc("wahr_survey_transitions_total", step=current_step)
+
+        with self._lock:
+            self._stats["transitions"] += 1
+            cached = self._sessions.get(phone)
+            if cached is not None:
+                state = cached[1]._replace(**{key: change[key] for key in self.USER_FIELDS if key in change})
+                if survey and survey.get("vacancy") is not None:
+                    state = state._replace(vacancy_filled=True)
+                self._sessions[phone] = (cached[0], state)
+            if self.write_behind:
+                self._merge(phone, change)
+        if self.write_behind:
+            self._ensure_started()
+            return
+        try:
+            self.database.apply_survey_transitions([(phone, change)])
+        except Exception:
+            # the cached state may be ahead of the database now
+            self.forget(phone)
+            raise
+        with self._lock:
+            self._stats["writes"] += 1
+
+    def _merge(self, phone, change):
+        pending = self._pending.setdefault(phone, {})
+        survey = pending.get("survey", {})
+        pending.update(change)
+        if "survey" in change:
+            pending["survey"] = {**survey, **change["survey"]}
+
+    def forget(self, phone):
+        with self._lock:
+            self._sessions.pop(phone, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        transitions = list(pending.items())
+        try:
+            self.database.apply_survey_transitions(transitions)
+        except Exception as e:
+            logging.error("Error while saving %s survey transitions: %s", len(transitions), e)
+            with self._lock:
+                self._stats["failures"] += 1
+            retry = transitions
+            if not isinstance(e, TRANSIENT_ERRORS):
+                # a row the database rejects would fail every batch it is in
+                dropped, retry = save_one_by_one(self.database.apply_survey_transitions, transitions,
+                                                 "the survey transition of")
+                for phone, _ in dropped:
+                    self.forget(phone)  # the cached state has the dropped change
+                with self._lock:
+                    self._stats["dropped"] += len(dropped)
+                    self._stats["writes"] += len(transitions) - len(dropped) - len(retry)
+            self._requeue(retry)
+            return
+        with self._lock:
+            self._stats["writes"] += len(transitions)
+            self._stats["batches"] += 1
+
+    def _requeue(self, transitions):
+        with self._lock:
+            # newer transitions that arrived meanwhile win over the failed ones
+            for phone, change in transitions:
+                newer = self._pending.get(phone)
+                self._pending[phone] = change
+                if newer is not None:
+                    self._merge(phone, newer)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._sessions)
+            stats["pending"] = len(self._pending)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["write_behind"] = self.write_behind
+        return stats
+
+
+survey_sessions = SurveySessions()
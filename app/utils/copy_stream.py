@@ -0,0 +1,108 @@
+import queue
+import threading
+
+
+class StreamClosed(Exception):
+    '''
+    The client went away, raised inside COPY to abort it.
+    '''
+
+
+# put after the last chunk by wait_consumed, the consumer reaches it once that chunk was sent
+_CONSUMED = object()
+
+
+class _QueueWriter:
+    '''
+    File-like object for cursor.copy_expert that hands ~chunk_size pieces to the response generator.
+    '''
+
+    def __init__(self, chunks, closed, consumed, chunk_size):
+        self.chunks = chunks
+        self.closed = closed
+        self.consumed = consumed
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = b"".join(self.buffer)  # psycopg2 writes bytes to non-text files
+        self.buffer, self.buffered = [], 0
+        self._put(chunk)
+
+    def _put(self, item):
+        # a full queue means a slow client, wait for it instead of buffering the whole table
+        while True:
+            if self.closed.is_set():
+                raise StreamClosed()
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def wait_consumed(self):
+        '''
+        Blocks until everything written so far was handed to the server and the consumer asked for
+        more, i.e. the response body is complete. Raises StreamClosed if the client went away first.
+        Meant to be called before committing changes that depend on the client getting the data.
+        '''
+        self.flush()
+        self._put(_CONSUMED)
+        while not self.consumed.wait(timeout=1):
+            if self.closed.is_set():
+                raise StreamClosed()
+
+
+def iter_copy(copy, *args, chunk_size=64 * 1024, max_chunks=16, **kwargs):
+    """
+    Runs copy(out, *args, **kwargs) (e.g. WADatabase.copy_unsent_surveys) in a thread and yields what it
+    writes to `out`, so a COPY ... TO STDOUT can be streamed as a response body with bounded memory.
+
+    An error in the copy is re-raised in the consumer; closing the generator aborts the copy.
+    `out.wait_consumed()` lets the copy wait for the consumer before it commits.
+    """
+    chunks = queue.Queue(maxsize=max_chunks)
+    closed = threading.Event()
+    consumed = threading.Event()
+    done = object()
+    failure = []
+
+    def run():
+        writer = _QueueWriter(chunks, closed, consumed, chunk_size)
+        try:
+            copy(writer, *args, **kwargs)
+            writer.flush()
+        except StreamClosed:
+            return
+        except Exception as e:
+            failure.append(e)
+        while not closed.is_set():
+            try:
+                chunks.put(done, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    threading.Thread(target=run, name="copy-stream", daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _CONSUMED:
+                consumed.set()
+                continue
+            if chunk is done:
+                break
+            yield chunk
+        if failure:
+            raise failure[0]
+    finally:
+        closed.set()
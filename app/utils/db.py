@@ -1,253 +1,733 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from collections import namedtuple
+from functools import wraps
+
 import psycopg2
-import pandas as pd
+from flask import current_app
+from psycopg2 import pool
+from psycopg2.extras import execute_values
+
+from .metrics import metrics
+from .migrations import migrate
+from .statements import PreparingConnection, StalePlan, StatementRegistry
+from .vacancy_catalog import VacancyCatalog
+
+
+class ConnectionDropped(psycopg2.OperationalError):
+    '''
+    The pooled connection was closed by the server before the transaction was committed.
+    '''
+
+
+def reconnecting(method):
+    '''
+    Runs the method once more on a fresh connection if the pooled one turned out to be dropped,
+    or if a prepared statement went stale after a migration (see statements.py).
+    Nothing was committed in either case, so repeating the transaction is safe.
+    The duration of every call (retries included) goes to /metrics.
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        except ConnectionDropped as e:
+            logging.warning("Database connection dropped, reconnecting: %s", e)
+            return method(self, *args, **kwargs)
+        except StalePlan as e:
+            logging.warning("Prepared statement %s is stale after a schema change, repeating the transaction", e)
+            return method(self, *args, **kwargs)
+        finally:
+            metrics.observe("wahr_db_query_duration_seconds", time.perf_counter() - started, method=method.__name__)
+
+    return wrapper
+
+
+# the database is unreachable, as opposed to rejecting the data
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def save_one_by_one(save, rows, description):
+    '''
+    Retries the rows of a failed batch one at a time with save([row]), so one row the database
+    rejects (too long, constraint) doesn't hold back the others. Rejected rows are logged and dropped.
+    Returns (dropped rows, rows not tried because the database became unreachable).
+    '''
+    dropped = []
+    for i, row in enumerate(rows):
+        try:
+            save([row])
+        except TRANSIENT_ERRORS:
+            return dropped, rows[i:]
+        except Exception as e:
+            logging.error("Dropping %s %s: %s", description, row[0], e)
+            dropped.append(row)
+    return dropped, []
+
+
+# survey columns the bot may write, the rest are managed by the database
+SURVEY_ANSWER_COLUMNS = ('age', 'production_experience', 'name', 'vacancy', 'sent', 'resume')
+SURVEY_WRITABLE_COLUMNS = SURVEY_ANSWER_COLUMNS + ('completed_survey',)
+
+SURVEY_COLUMNS = ['id', 'phone', 'age', 'production_experience', 'completed_survey', 'name', 'vacancy', 'sent', 'resume']
+
+_lock = threading.Lock()
+
+UserState = namedtuple("UserState", ["survey_mode", "current_step", "vacancy_filled", "wants_notifications"])
+
 
 class WADatabase():
     #### create tables users and surveys for now ###
 
-    def __init__(self, db_config):
-        self.conn = self.create_connection(db_config)
-        self.create_tables()
+    def __init__(self, db_config, minconn=1, maxconn=10, vacancy_cache_ttl=300, listen_for_changes=True,
+                 prepare=True):
+        self.db_config = db_config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        # ThreadedConnectionPool raises instead of waiting when exhausted, so callers queue here
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._pool_lock = threading.Lock()
+        # nothing connects here: the pool is opened by the first query and the schema
+        # is created explicitly with `flask init-db` (create_tables)
+        self.pool = None
+        # the queries of the message path are prepared once per connection, see statements.py
+        self.statements = StatementRegistry(prepare=prepare)
+        # every vacancy read is served from here, see vacancy_catalog.py
+        self.vacancies = VacancyCatalog(
+            self._load_vacancies, db_config, ttl=vacancy_cache_ttl, listen=listen_for_changes
+        )
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config["DB_CONFIG"],
+            minconn=config["DB_POOL_MIN"],
+            maxconn=config["DB_POOL_MAX"],
+            vacancy_cache_ttl=config["VACANCY_CACHE_TTL"],
+            prepare=config["DB_PREPARE"],
+        )
 
-    def create_connection(self, db_config):
+    def _get_pool(self):
+        # opened on first use; if the database is unreachable the next checkout tries again
+        if self.pool is None:
+            with self._pool_lock:
+                if self.pool is None:
+                    self.pool = pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, connection_factory=PreparingConnection, **self.db_config
+                    )
+        return self.pool
+
+    @contextmanager
+    def connection(self):
+        '''
+        Checks out a pooled connection for one transaction.
+        Commits on success, rolls back on error and discards connections that were dropped.
+        '''
+        with self._slots:
+            conn_pool = self._get_pool()
+            conn = conn_pool.getconn()
+            if conn.closed:
+                conn_pool.putconn(conn, close=True)
+                conn = conn_pool.getconn()
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if conn.closed:
+                    conn_pool.putconn(conn, close=True)
+                    raise ConnectionDropped(str(e)) from e
+                self._rollback(conn)
+                conn_pool.putconn(conn, close=bool(conn.closed))
+                raise
+            except BaseException:
+                self._rollback(conn)
+                conn_pool.putconn(conn, close=bool(conn.closed))
+                raise
+            try:
+                conn.commit()
+            finally:
+                conn_pool.putconn(conn, close=bool(conn.closed))
+
+    @staticmethod
+    def _rollback(conn):
+        if conn.closed:
+            return
         try:
-            conn = psycopg2.connect(**db_config)
-            return conn
-        except Exception as e:
-            print(f"Error connecting to the database: {e}")
-            return None
-        
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+
+    @contextmanager
+    def cursor(self, **kwargs):
+        with self.connection() as conn:
+            with conn.cursor(**kwargs) as cur:
+                yield cur
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+
     def create_tables(self):
-        with self.conn.cursor() as cur:
-            cur.execute("""CREATE TABLE IF NOT EXISTS users (
-                        id SERIAL PRIMARY KEY,
-                        phone VARCHAR(32) UNIQUE NOT NULL,
-                        current_step INTEGER DEFAULT 0,
-                        survey_mode BOOLEAN DEFAULT FALSE,
-                        has_completed_survey BOOLEAN DEFAULT FALSE,
-                        wants_notifications BOOLEAN DEFAULT TRUE
-                        );""")
-            
-            cur.execute("""CREATE TABLE IF NOT EXISTS surveys (
-                        id SERIAL PRIMARY KEY,
-                        phone VARCHAR(16) UNIQUE NOT NULL REFERENCES users(phone),
-                        age VARCHAR(32),
-                        production_experience VARCHAR(32),
-                        completed_survey BOOLEAN DEFAULT FALSE,
-                        name VARCHAR(50),
-                        vacancy VARCHAR(32),
-                        sent BOOLEAN DEFAULT FALSE,
-                        resume VARCHAR(32) DEFAULT 'Не указан'
-                        );""")
-
-            create_table_query = '''
-                        CREATE TABLE IF NOT EXISTS vacancies (
-                        id SERIAL PRIMARY KEY,
-                        title VARCHAR(255) NOT NULL,
-                        requirements TEXT,
-                        details TEXT,
-                        tasks TEXT,
-                        salary VARCHAR(32) DEFAULT 'Не указано'
-                        );'''
-            cur.execute(create_table_query)
-
-            self.conn.commit()
+        '''
+        Brings the schema up to date, see migrations.py. Returns the migrations that were applied.
+        '''
+        return migrate(self)
 
+    @reconnecting
     def get_user(self, phone):
-        with self.conn.cursor() as cur:
-            cur.execute(
-                """
-                    SELECT phone from users WHERE phone = %s
-                """, (phone,)
-            )
+        with self.cursor() as cur:
+            self.statements.execute(cur, "get_user", "SELECT phone FROM users WHERE phone = $1", (phone,))
             user  = cur.fetchone() # fetch phone number
-            cur.close()
         
         if user is None:
             return False
         return True
     
+    @reconnecting
     def create_user(self, phone):
-        with self.conn.cursor() as cur:
-            try:
+        try:
+            with self.cursor() as cur:
                 cur.execute("INSERT INTO users (phone) VALUES (%s) ON CONFLICT (phone) DO NOTHING", (phone,))
                 cur.execute("INSERT INTO surveys (phone, completed_survey) VALUES (%s, FALSE) ON CONFLICT (phone) DO NOTHING", (phone,))
-                self.conn.commit()
-            except Exception as e:
-                self.conn.rollback()
-                print(f"Error inserting user: {e}")
-                # logging.info(f'Error inserting a user: {e}')
+        except ConnectionDropped:
+            raise
+        except Exception as e:
+            logging.error('Error inserting a user: %s', e)
 
-    def save_survey_results(self, phone, key, text):
-        with self.conn.cursor() as cur:
-            # First try to update the record
-            cur.execute(
+    @reconnecting
+    def touch_user(self, phone):
+        '''
+        Creates the user (and the empty survey) if needed and returns its UserState in one round trip.
+        Replaces get_user + create_user + filling_a_survey + vacancy_filled on the message path.
+        '''
+        with self.cursor() as cur:
+            # rows inserted by the CTEs are not visible to the rest of the statement,
+            # so a new user comes from new_user and an existing one from users
+            self.statements.execute(
+                cur, "touch_user",
                 """
-                UPDATE surveys SET 
-                {key} = %s
-                WHERE phone = %s;
-                """.format(key=key), (text, phone,)
+                WITH new_user AS (
+                    INSERT INTO users (phone) VALUES ($1)
+                    ON CONFLICT (phone) DO NOTHING
+                    RETURNING phone, survey_mode, current_step, wants_notifications
+                ), new_survey AS (
+                    INSERT INTO surveys (phone, completed_survey)
+                    SELECT phone, FALSE FROM new_user
+                    ON CONFLICT (phone) DO NOTHING
+                ), u AS (
+                    SELECT phone, survey_mode, current_step, wants_notifications FROM new_user
+                    UNION ALL
+                    SELECT phone, survey_mode, current_step, wants_notifications FROM users WHERE phone = $1
+                )
+                SELECT u.survey_mode, u.current_step, s.vacancy IS NOT NULL, u.wants_notifications
+                FROM u LEFT JOIN surveys s ON s.phone = u.phone
+                LIMIT 1
+                """, (phone,)
             )
-
-            # Check if the record was updated
-            if cur.rowcount == 0:
-                # If no rows were updated, insert a new record
-                cur.execute(
+            row = cur.fetchone()
+            if row is None:
+                # a concurrent transaction inserted the user after our snapshot was taken
+                self.statements.execute(
+                    cur, "get_user_state",
                     """
-                    INSERT INTO surveys (phone, {key})
-                    VALUES (%s, %s)
-                    """.format(key=key), (phone, text,)
+                    SELECT u.survey_mode, u.current_step, s.vacancy IS NOT NULL, u.wants_notifications
+                    FROM users u LEFT JOIN surveys s ON s.phone = u.phone
+                    WHERE u.phone = $1
+                    """, (phone,)
                 )
+                row = cur.fetchone()
+        return UserState(*row)
 
-            # Commit the transaction
-            self.conn.commit()
+    @reconnecting
+    def create_users(self, phones):
+        '''
+        create_user for a whole list of phones in one statement per table
+        '''
+        with self.cursor() as cur:
+            cur.execute(
+                "INSERT INTO users (phone) SELECT unnest(%s::varchar[]) ON CONFLICT (phone) DO NOTHING", (phones,)
+            )
+            cur.execute(
+                """
+                INSERT INTO surveys (phone, completed_survey)
+                SELECT unnest(%s::varchar[]), FALSE
+                ON CONFLICT (phone) DO NOTHING
+                """, (phones,)
+            )
 
-    def save_vacancy(self, phone, vacancy_name):
-        with self.conn.cursor() as cur:
-            # First try to update the record
+    @reconnecting
+    def filter_notifiable(self, phones):
+        '''
+        returns the set of phones from the list that have not opted out of notifications
+        '''
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "filter_notifiable",
+                "SELECT phone FROM users WHERE phone = ANY($1::varchar[]) AND wants_notifications", (list(phones),)
+            )
+            return {phone for (phone,) in cur.fetchall()}
+
+    @reconnecting
+    def get_users_page(self, after_id=0, limit=100):
+        '''
+        keyset pagination: the next page starts after the last id of the previous one
+        '''
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "get_users_page",
+                "SELECT id, phone, wants_notifications FROM users WHERE id > $1 ORDER BY id LIMIT $2",
+                (after_id, limit)
+            )
+            return cur.fetchall()
+
+    def iter_users(self, itersize=2000):
+        '''
+        Yields (id, phone, wants_notifications) for every user through a server-side cursor,
+        so only `itersize` rows are held in memory at a time.
+        '''
+        with self.connection() as conn:
+            with conn.cursor(name="users_export") as cur:
+                cur.itersize = itersize
+                cur.execute("SELECT id, phone, wants_notifications FROM users ORDER BY id")
+                for row in cur:
+                    yield row
+
+    @reconnecting
+    def claim_message(self, message_id, ttl):
+        '''
+        Returns True if this process is the first to see the message id within ttl seconds
+        '''
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "claim_message",
+                """
+                INSERT INTO processed_messages (message_id) VALUES ($1)
+                ON CONFLICT (message_id) DO UPDATE SET received_at = now()
+                WHERE processed_messages.received_at < now() - make_interval(secs => $2)
+                RETURNING 1
+                """, (message_id, ttl)
+            )
+            return cur.fetchone() is not None
+
+    @reconnecting
+    def release_message(self, message_id):
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "release_message", "DELETE FROM processed_messages WHERE message_id = $1", (message_id,)
+            )
+
+    @reconnecting
+    def purge_processed_messages(self, ttl):
+        with self.cursor() as cur:
+            cur.execute(
+                "DELETE FROM processed_messages WHERE received_at < now() - make_interval(secs => %s)", (ttl,)
+            )
+            return cur.rowcount
+
+    ######## MESSAGE STATUSES ##############
+
+    @reconnecting
+    def save_message_statuses(self, rows):
+        '''
+        rows - (message_id, recipient_id, status, unix timestamp, error_code) tuples, one multi-row INSERT per page
+        '''
+        with self.cursor() as cur:
+            execute_values(
+                cur,
+                "INSERT INTO message_statuses (message_id, recipient_id, status, status_at, error_code) VALUES %s",
+                rows,
+                template="(%s, %s, %s, to_timestamp(%s), %s)",
+                page_size=1000,
+            )
+
+    @reconnecting
+    def save_outbound_messages(self, rows):
+        '''
+        rows - (message_id, recipient_id, template_name, broadcast_id) tuples
+        '''
+        with self.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                INSERT INTO outbound_messages (message_id, recipient_id, template_name, broadcast_id) VALUES %s
+                ON CONFLICT (message_id) DO NOTHING
+                """,
+                rows,
+                page_size=1000,
+            )
+
+    @reconnecting
+    def get_thread_id(self, phone):
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "get_thread_id", "SELECT thread_id FROM assistant_threads WHERE phone = $1", (phone,)
+            )
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    @reconnecting
+    def save_thread_id(self, phone, thread_id):
+        '''
+        Saves the user's thread id unless one was saved first (by a concurrent first message, in any
+        process). Returns (the saved thread id, whether it is this one).
+        '''
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "save_thread_id",
+                "INSERT INTO assistant_threads (phone, thread_id) VALUES ($1, $2) ON CONFLICT (phone) DO NOTHING RETURNING thread_id",
+                (phone, thread_id)
+            )
+            if cur.fetchone() is not None:
+                return thread_id, True
+            self.statements.execute(
+                cur, "get_thread_id", "SELECT thread_id FROM assistant_threads WHERE phone = $1", (phone,)
+            )
+            return cur.fetchone()[0], False
+
+    @reconnecting
+    def save_media_file(self, phone, sha256, filename, mime_type, size, path):
+        '''
+        Records that the user sent this file and returns the row id; sending the same file again only updates the name and time
+        '''
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "save_media_file",
+                """
+                INSERT INTO media_files (phone, sha256, filename, mime_type, size, path) VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (phone, sha256) DO UPDATE SET filename = EXCLUDED.filename, received_at = now()
+                RETURNING id
+                """, (phone, sha256, filename, mime_type, size, path)
+            )
+            return cur.fetchone()[0]
+
+    @reconnecting
+    def save_broadcast_job(self, job):
+        '''
+        Inserts or updates the progress of a BroadcastJob
+        '''
+        with self.cursor() as cur:
             cur.execute(
                 """
-                UPDATE surveys SET 
-                vacancy = %s
-                WHERE phone = %s;
-                """, (vacancy_name, phone,)
+                INSERT INTO broadcast_jobs (id, template_name, status, error, total, sent, failed, skipped,
+                                            created_at, started_at, finished_at)
+                VALUES (%(id)s, %(template_name)s, %(status)s, %(error)s, %(total)s, %(sent)s, %(failed)s, %(skipped)s,
+                        to_timestamp(%(created_at)s), to_timestamp(%(started_at)s), to_timestamp(%(finished_at)s))
+                ON CONFLICT (id) DO UPDATE SET
+                    status = EXCLUDED.status, error = EXCLUDED.error, sent = EXCLUDED.sent, failed = EXCLUDED.failed,
+                    skipped = EXCLUDED.skipped, started_at = EXCLUDED.started_at,
+                    finished_at = EXCLUDED.finished_at, updated_at = now()
+                """, job.progress()
             )
 
-            if cur.rowcount == 0:
-                # If no rows were updated, insert a new record
-                cur.execute(
-                    """
-                    INSERT INTO surveys (phone, vacancy)
-                    VALUES (%s, %s)
-                    """, (phone, vacancy_name,)
-                )
+    @reconnecting
+    def get_broadcast_job(self, job_id):
+        '''
+        The saved progress of a broadcast as a dict (times as unix timestamps), or None
+        '''
+        with self.cursor() as cur:
+            cur.execute(
+                """
+                SELECT id, template_name, status, error, total, sent, failed, skipped,
+                       extract(epoch FROM created_at)::float8, extract(epoch FROM started_at)::float8,
+                       extract(epoch FROM finished_at)::float8, extract(epoch FROM now() - updated_at)::float8
+                FROM broadcast_jobs WHERE id = %s
+                """, (job_id,)
+            )
+            row = cur.fetchone()
+        if row is None:
+            return None
+        columns = ("id", "template_name", "status", "error", "total", "sent", "failed", "skipped",
+                   "created_at", "started_at", "finished_at", "seconds_since_update")
+        return dict(zip(columns, row))
+
+    @reconnecting
+    def get_status_summary(self, broadcast_id=None, template_name=None):
+        '''
+        Number of sent messages per template/broadcast and how many of them reached each status
+        '''
+        with self.cursor() as cur:
+            cur.execute(
+                """
+                SELECT o.template_name, o.broadcast_id, count(*),
+                       count(*) FILTER (WHERE 'sent' = ANY(s.statuses)),
+                       count(*) FILTER (WHERE 'delivered' = ANY(s.statuses)),
+                       count(*) FILTER (WHERE 'read' = ANY(s.statuses)),
+                       count(*) FILTER (WHERE 'failed' = ANY(s.statuses))
+                FROM outbound_messages o
+                LEFT JOIN LATERAL (
+                    SELECT array_agg(DISTINCT status) AS statuses FROM message_statuses WHERE message_id = o.message_id
+                ) s ON TRUE
+                WHERE (%(broadcast_id)s::varchar IS NULL OR o.broadcast_id = %(broadcast_id)s)
+                  AND (%(template_name)s::varchar IS NULL OR o.template_name = %(template_name)s)
+                GROUP BY o.template_name, o.broadcast_id
+                ORDER BY min(o.sent_at) DESC
+                """, {"broadcast_id": broadcast_id, "template_name": template_name}
+            )
+            columns = ("template", "broadcast_id", "messages", "sent", "delivered", "read", "failed")
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def _upsert_survey(self, cur, phone, values):
+        '''
+        Writes {column: value} into the user's survey, creating it if needed. Column names come from
+        the allow-list only; each set of columns is its own prepared statement.
+        '''
+        columns = [column for column in SURVEY_WRITABLE_COLUMNS if column in values]
+        if len(columns) != len(values):
+            raise ValueError(f"unknown survey columns: {sorted(set(values) - set(columns))}")
+        placeholders = ", ".join(f"${i}" for i in range(2, len(columns) + 2))
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns)
+        self.statements.execute(
+            cur, "survey_set_" + "_".join(columns),
+            f"INSERT INTO surveys (phone, {', '.join(columns)}) VALUES ($1, {placeholders}) "
+            f"ON CONFLICT (phone) DO UPDATE SET {updates}",
+            (phone, *(values[column] for column in columns)),
+        )
+
+    @reconnecting
+    def save_survey_results(self, phone, key, text):
+        if key not in SURVEY_ANSWER_COLUMNS:
+            raise ValueError(f"unknown survey column: {key!r}")
+        with self.cursor() as cur:
+            self._upsert_survey(cur, phone, {key: text})
+
+    @reconnecting
+    def save_vacancy(self, phone, vacancy_name):
+        with self.cursor() as cur:
+            self._upsert_survey(cur, phone, {"vacancy": vacancy_name})
 
-            # Commit the transaction
-            self.conn.commit()
+    @reconnecting
     def vacancy_filled(self, phone):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT vacancy FROM surveys WHERE phone = %s", (phone,))
+        with self.cursor() as cur:
+            self.statements.execute(cur, "vacancy_filled", "SELECT vacancy FROM surveys WHERE phone = $1", (phone,))
             result = cur.fetchone()
             return result is not None
         
+    @reconnecting
     def has_completed_survey(self, phone):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT has_completed_survey FROM users WHERE phone = %s", (phone,))
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "has_completed_survey", "SELECT has_completed_survey FROM users WHERE phone = $1", (phone,)
+            )
             result = cur.fetchone()
             return result[0]
         
+    @reconnecting
     def filling_a_survey(self, phone):
         '''
         returns state and step
         '''
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT survey_mode, current_step FROM users WHERE phone = %s", (phone,))
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "filling_a_survey", "SELECT survey_mode, current_step FROM users WHERE phone = $1", (phone,)
+            )
             isSurveying, step = cur.fetchone()
             return isSurveying, step
         
+    @reconnecting
     def increment_step(self, phone):
-        with self.conn.cursor() as cur:
-            cur.execute("UPDATE users SET current_step = current_step + 1 WHERE phone = %s;", (phone,))
-            self.conn.commit()
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "increment_step", "UPDATE users SET current_step = current_step + 1 WHERE phone = $1", (phone,)
+            )
 
+    @reconnecting
     def set_step(self, phone):
-        with self.conn.cursor() as cur:
-            cur.execute("UPDATE users SET current_step =  1 WHERE phone = %s;", (phone,))
-            self.conn.commit()
+        with self.cursor() as cur:
+            self.statements.execute(cur, "set_step", "UPDATE users SET current_step = 1 WHERE phone = $1", (phone,))
 
+    @reconnecting
     def set_survey_mode(self, phone, value):
         ''' value is True or False'''
-        with self.conn.cursor() as cur:
-            cur.execute("UPDATE users SET survey_mode = %s WHERE phone = %s;", (value, phone,))
-            self.conn.commit()  # Commit the transaction            
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "set_survey_mode", "UPDATE users SET survey_mode = $2 WHERE phone = $1", (phone, value)
+            )
 
+    @reconnecting
+    def apply_survey_transitions(self, transitions):
+        '''
+        transitions - (phone, change) pairs, written in one transaction. A change may hold survey_mode,
+        current_step, wants_notifications, completed (users and surveys) and survey ({column: value}).
+        '''
+        with self.cursor() as cur:
+            # same row lock order in every batch, so two batches can't deadlock
+            for phone, change in sorted(transitions, key=lambda item: item[0]):
+                survey = dict(change.get("survey") or {})
+                unknown = set(survey) - set(SURVEY_ANSWER_COLUMNS)
+                if unknown:
+                    raise ValueError(f"unknown survey columns: {sorted(unknown)}")
+                users = [change.get(key) for key in ("survey_mode", "current_step", "wants_notifications", "completed")]
+                if any(value is not None for value in users):
+                    # NULL keeps the current value, so every transition is the same statement
+                    self.statements.execute(
+                        cur, "survey_transition",
+                        """
+                        UPDATE users SET survey_mode = COALESCE($2, survey_mode),
+                            current_step = COALESCE($3, current_step),
+                            wants_notifications = COALESCE($4, wants_notifications),
+                            has_completed_survey = COALESCE($5, has_completed_survey)
+                        WHERE phone = $1
+                        """, (phone, *users)
+                    )
+                if "completed" in change:
+                    survey["completed_survey"] = change["completed"]
+                if survey:
+                    self._upsert_survey(cur, phone, survey)
+
+    @reconnecting
     def mark_survey_as_completed_or_incompleted(self, phone, isCompleted):
         ''' value is True or False'''
-        with self.conn.cursor() as cur:
-            cur.execute("UPDATE users SET has_completed_survey = %s WHERE phone = %s;", (isCompleted, phone,))
-            cur.execute("UPDATE surveys SET completed_survey = %s WHERE phone = %s;", (isCompleted, phone,))
-            self.conn.commit()  # Commit the transaction 
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "set_user_completed", "UPDATE users SET has_completed_survey = $2 WHERE phone = $1",
+                (phone, isCompleted)
+            )
+            self.statements.execute(
+                cur, "set_survey_completed", "UPDATE surveys SET completed_survey = $2 WHERE phone = $1",
+                (phone, isCompleted)
+            )
 
     ######## VACANCIES ##############
 
-    def get_vacancies(self):
-        with self.conn.cursor() as cursor:
-            cursor.execute("SELECT id, title FROM vacancies")
+    @reconnecting
+    def _load_vacancies(self):
+        with self.cursor() as cursor:
+            cursor.execute("SELECT id, title, requirements, details, tasks, salary FROM vacancies ORDER BY id")
             return cursor.fetchall()
+
+    def get_vacancies(self):
+        return [(vac.id, vac.title) for vac in self.vacancies.snapshot().rows]
         
     def get_vacancies_with_details(self):
-        with self.conn.cursor() as cursor:
-            cursor.execute("SELECT id, title, salary FROM vacancies")
-            return cursor.fetchall()
+        return [(vac.id, vac.title, vac.salary) for vac in self.vacancies.snapshot().rows]
         
     def get_vacancies_full(self):
-        with self.conn.cursor() as cursor:
-            cursor.execute("SELECT * FROM vacancies")
-            return cursor.fetchall()
+        return [tuple(vac) for vac in self.vacancies.snapshot().rows]
 
     def get_vacancy_details(self, vacancy_id):
         '''
             used in forming the interactive message
         '''
-
-        with self.conn.cursor() as cursor:
-            cursor.execute("SELECT title, requirements, details, tasks, salary FROM vacancies WHERE id=%s;", (vacancy_id,))
-            df = cursor.fetchone()
-            return df
+        vac = self.vacancies.snapshot().by_id.get(int(vacancy_id))
+        if vac is None:
+            return None
+        return (vac.title, vac.requirements, vac.details, vac.tasks, vac.salary)
         
     def get_vacancies_for_interactive_message(self):
-        vacancies = self.get_vacancies_with_details()
-        def shorten_title(title, max_length=24):
-            """
-            Shortens a given title to a maximum length.
-            
-            Args:
-                title (str): название вакансии.
-                max_length (int): максимальная длина заголовка.
-                
-            Returns:
-                str: The shortened title.
-            """
-            if len(title) > max_length:
-                return title[:max_length]  # Truncate the title to the max length
-            return title
-
-        sections = []
-        max_rows_per_section = 10
-        for i in range(0, len(vacancies), max_rows_per_section):
-            section_vacancies = vacancies[i:i + max_rows_per_section]
-            section = {
-                "title": f"Стр. {i // max_rows_per_section + 1}",
-                "rows": [{"id": str(vac[0]), "title": shorten_title(vac[1]), "description": vac[2]} for vac in section_vacancies]
-            }
-            sections.append(section)
-        
-        return sections
+        return self.vacancies.snapshot().sections
 
+    def match_vacancies(self, text):
+        '''
+        ids of all vacancies whose title is mentioned in the text, in order of appearance
+        '''
+        return self.vacancies.snapshot().matcher.find_all(text)
+
+    @reconnecting
     def get_incomplete_surveys(self):
-        with self.conn.cursor() as cur:
-            query = 'SELECT * FROM surveys WHERE sent = FALSE;'
-            cur.execute(query)
+        '''
+        Unsent surveys as a pandas DataFrame. Kept for notebooks, the API streams them with copy_unsent_surveys.
+        '''
+        import pandas as pd  # heavy, only imported by the callers that need it
+
+        with self.cursor() as cur:
+            cur.execute(f"SELECT {', '.join(SURVEY_COLUMNS)} FROM surveys WHERE sent = FALSE ORDER BY id;")
             df = cur.fetchall()
-        self.conn.commit()
-        return pd.DataFrame(df, columns=['id', 'phone', 'age','production_experience', 'completed_survey', 'name', 'vacancy', 'sent', 'resume'])
+        return pd.DataFrame(df, columns=SURVEY_COLUMNS)
+
+    def copy_unsent_surveys(self, out, export_format="csv", claim=False, before_commit=None):
+        '''
+        Writes unsent surveys to the file-like `out` with COPY ... TO STDOUT, as CSV with a header
+        or as NDJSON (one object per line).
+        With claim=True the same statement marks them as sent, so they are exported only once.
+        before_commit() runs after the copy, inside the transaction: if it (or the copy) raises,
+        the transaction is rolled back and nothing is marked.
+        '''
+        if export_format == "ndjson":
+            columns = "row_to_json(surveys)"
+            # the CSV format with control characters as quote and delimiter leaves the JSON untouched,
+            # while the text format would double every backslash
+            options = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+        else:
+            columns = ", ".join(SURVEY_COLUMNS)
+            options = "FORMAT csv, HEADER"
+        if claim:
+            query = f"UPDATE surveys SET sent = TRUE WHERE sent = FALSE RETURNING {columns}"
+        else:
+            query = f"SELECT {columns} FROM surveys WHERE sent = FALSE ORDER BY id"
+        with self.cursor() as cur:
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH ({options})", out)
+            if before_commit is not None:
+                before_commit()
+
+    @reconnecting
+    def claim_unsent_surveys(self, limit=100):
+        '''
+        Marks up to `limit` unsent surveys as sent and returns them as dicts, in one statement.
+        Concurrent callers never get the same survey.
+        '''
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "claim_unsent_surveys",
+                f"""
+                UPDATE surveys SET sent = TRUE
+                WHERE id IN (
+                    SELECT id FROM surveys WHERE sent = FALSE ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {', '.join(SURVEY_COLUMNS)}
+                """, (limit,)
+            )
+            rows = cur.fetchall()
+        return [dict(zip(SURVEY_COLUMNS, row)) for row in sorted(rows)]
 
+    @reconnecting
     def update_sent_status(self, value, phone):
-        query = "UPDATE surveys SET sent = %s WHERE phone = %s;"
-        self.conn.cursor().execute(query, (value, phone,))
-        self.conn.commit()
+        with self.cursor() as cur:
+            self.statements.execute(cur, "set_sent", "UPDATE surveys SET sent = $2 WHERE phone = $1", (phone, value))
 
+    @reconnecting
+    def update_sent_statuses(self, value, phones):
+        '''
+        Sets the sent flag of all the given phones at once, returns the number of updated surveys
+        '''
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "set_sent_many", "UPDATE surveys SET sent = $1 WHERE phone = ANY($2::varchar[])",
+                (value, list(phones))
+            )
+            return cur.rowcount
+
+    @reconnecting
     def set_notification_preference(self, preference, phone):
-        query = "UPDATE users SET wants_notifications = %s WHERE phone = %s"
-        self.conn.cursor().execute(query, (preference, phone,))
-        self.conn.commit()
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "set_notification_preference", "UPDATE users SET wants_notifications = $2 WHERE phone = $1",
+                (phone, preference)
+            )
 
+    @reconnecting
     def wants_notifications(self, phone):
-        query = "SELECT wants_notifications FROM users WHERE phone = %s"
-
-        with self.conn.cursor() as cur:
-            cur.execute(query, (phone,))
+        with self.cursor() as cur:
+            self.statements.execute(
+                cur, "wants_notifications", "SELECT wants_notifications FROM users WHERE phone = $1", (phone,)
+            )
             notif  = cur.fetchone() # fetch phone number
-            cur.close()
         if notif is None:
             return False
-        return True
\ No newline at end of file
+        return True
+
+
+def get_database():
+    '''
+    Returns the WADatabase of the current app, creating it on first use (create_app does it up front).
+    '''
+    extensions = current_app.extensions
+    database = extensions.get("database")
+    if database is None:
+        with _lock:
+            database = extensions.get("database")
+            if database is None:
+                database = WADatabase.from_config(current_app.config)
+                extensions["database"] = database
+    return database
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class MessageDeduplicator:
+    """
+    Drops webhook redeliveries by WhatsApp message id before any DB or Graph API work.
+
+    Ids are kept in a bounded in-memory LRU with a TTL. With several worker processes the
+    memory of one process is not enough, so the `postgres` backend additionally claims every
+    id in the processed_messages table (see WADatabase.claim_message).
+    """
+
+    PURGE_EVERY = 1000  # delete expired rows from processed_messages every N checks
+
+    def __init__(self):
+        self.database = None
+        self.use_database = False
+        self.max_size = 10000
+        self.ttl = 24 * 60 * 60
+        self._seen = OrderedDict()  # message_id -> time it was first seen
+        self._lock = threading.Lock()
+        self._stats = {"checked": 0, "duplicates": 0, "database_duplicates": 0}
+
+    def init_app(self, app, database):
+        self.database = database
+        self.use_database = app.config["DEDUP_BACKEND"] == "postgres"
+        self.max_size = app.config["DEDUP_MAX_SIZE"]
+        self.ttl = app.config["DEDUP_TTL"]
+
+    def is_duplicate(self, message_id):
+        '''
+        Records the id and returns True if it was already seen within the TTL.
+        '''
+        if not message_id:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._stats["checked"] += 1
+            purge = self.use_database and self._stats["checked"] % self.PURGE_EVERY == 0
+            seen_at = self._seen.get(message_id)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self._seen.move_to_end(message_id)
+                self._stats["duplicates"] += 1
+                return True
+            self._seen[message_id] = now
+            self._seen.move_to_end(message_id)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+
+        if self.use_database:
+            try:
+                if purge:
+                    self.database.purge_processed_messages(self.ttl)
+                claimed = self.database.claim_message(message_id, self.ttl)
+            except Exception as e:
+                # better to process a message twice than to lose it
+                logging.error("Error while checking message id %s: %s", message_id, e)
+                return False
+            if not claimed:
+                with self._lock:
+                    self._stats["duplicates"] += 1
+                    self._stats["database_duplicates"] += 1
+                return True
+        return False
+
+    def forget(self, message_id):
+        '''
+        Lets a redelivery of this message through again, e.g. when processing it failed.
+        '''
+        with self._lock:
+            self._seen.pop(message_id, None)
+        if self.use_database:
+            try:
+                self.database.release_message(message_id)
+            except Exception as e:
+                logging.error("Error while releasing message id %s: %s", message_id, e)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._seen)
+        stats["backend"] = "postgres" if self.use_database else "memory"
+        stats["duplicate_rate"] = round(stats["duplicates"] / stats["checked"], 4) if stats["checked"] else 0.0
+        return stats
+
+
+def get_message_id(body):
+    try:
+        return body["entry"][0]["changes"][0]["value"]["messages"][0].get("id")
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+deduplicator = MessageDeduplicator()
@@ -0,0 +1,231 @@
+import math
+import mmap
+import re
+import struct
+from collections import Counter, namedtuple
+
+# File layout (little endian), everything addressed by offsets so it can be searched in place:
+#   header   | magic, counts, avgdl and section offsets
+#   terms    | n_terms x (term offset, term length, df, postings offset), sorted by term bytes
+#   postings | per term: df x (doc id, term frequency)
+#   docs     | n_docs x (length in tokens, question offset, question length, answer offset, answer length)
+#   blob     | UTF-8 terms, questions and answers
+MAGIC = b"WAFAQ001"
+HEADER = struct.Struct("<8sIIfIIII")
+TERM = struct.Struct("<IHII")
+POSTING = struct.Struct("<IH")
+DOC = struct.Struct("<IIIII")
+
+K1 = 1.2
+B = 0.75
+
+_WORDS = re.compile(r"\w+")
+_STOP_WORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "к", "ко", "о", "об", "от", "до", "за", "из", "у", "для", "не", "ли",
+    "же", "бы", "а", "но", "что", "как", "это", "мне", "меня", "вы", "вас", "вам", "ваш", "ваши", "ваша", "я",
+    "мы", "нас", "есть", "the", "a", "an", "is", "are", "to", "of", "in", "on", "and", "or", "i", "you",
+    "do", "can", "for", "it", "any", "my", "me",
+}
+_QUESTION = re.compile(r"(?:\b\d+\s*)?\bQ\s*:")
+_ANSWER = re.compile(r"\bA\s*:")
+# a section heading ("Процесс найма") the PDF text puts right after the last sentence of an answer
+_TRAILING_HEADING = re.compile(r"(?<=[^\d\s][.!?»\"])\s+([A-ZА-ЯЁ][^.!?:;,()\d]*)$")
+
+FaqMatch = namedtuple("FaqMatch", ["confidence", "score", "matched_terms", "question", "answer"])
+
+
+def tokenize(text):
+    '''
+    Lowercased word stems: ё -> е and words cut to 6 characters, which is enough to match most
+    Russian word forms ("вакансии", "вакансию" -> "ваканс")
+    '''
+    tokens = []
+    for word in _WORDS.findall(text.lower().replace("ё", "е")):
+        if word in _STOP_WORDS or (len(word) < 2 and not word.isdigit()):
+            continue
+        tokens.append(word[:6])
+    return tokens
+
+
+def read_pdf_text(path):
+    try:
+        from pypdf import PdfReader
+    except ImportError as e:
+        raise RuntimeError("pypdf is required to build the FAQ index: pip install pypdf") from e
+    return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+
+
+def strip_notes(text):
+    '''
+    Removes the editor's notes in parentheses ("(создать шаблон ...)"). A list marker like "1)"
+    inside a note doesn't end it. Text with an unbalanced "(" is returned as is.
+    '''
+    kept, depth = [], 0
+    for i, char in enumerate(text):
+        if char == "(":
+            depth += 1
+            continue
+        if char == ")" and depth and not text[i - 1].isdigit():
+            depth -= 1
+            continue
+        if not depth:
+            kept.append(char)
+    return "".join(kept) if not depth else text
+
+
+def _strip_heading(answer):
+    match = _TRAILING_HEADING.search(answer)
+    if match is not None and len(match.group(1).split()) <= 4:
+        return answer[:match.start()]
+    return answer
+
+
+def extract_pairs(text):
+    '''
+    Splits "1 Q: ... A: ..." documents into (question, answer) pairs, without the editor's notes
+    and section headings. Drafts are skipped: templates ({{...}}, an answer like **...**),
+    unfinished answers (…) and questions with a note, which describe a step of a flow
+    ("прикладывает резюме") rather than something a user asks.
+    '''
+    text = re.sub(r"\s+", " ", text)
+    pairs = []
+    for block in _QUESTION.split(text)[1:]:
+        parts = _ANSWER.split(block, maxsplit=1)
+        if len(parts) != 2:
+            continue
+        question, answer = parts[0].strip(), parts[1].strip()
+        if not question or not answer or "{{" in question + answer or "…" in question + answer:
+            continue
+        if re.fullmatch(r"\*\*.*\*\*", answer) or strip_notes(question) != question:
+            continue
+        answer = _strip_heading(re.sub(r"\s+([,.!?])", r"\1", re.sub(r"\s+", " ", strip_notes(answer))).strip())
+        if answer:
+            pairs.append((question, answer))
+    return pairs
+
+
+def build_index(pairs):
+    '''
+    Serializes (question, answer) pairs into the binary index format. Questions count twice,
+    as users ask questions rather than quote answers.
+    '''
+    doc_tokens = [tokenize(question) * 2 + tokenize(answer) for question, answer in pairs]
+    postings = {}
+    for doc_id, tokens in enumerate(doc_tokens):
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term.encode("utf-8"), []).append((doc_id, min(tf, 0xFFFF)))
+
+    blob = bytearray()
+
+    def put(text):
+        data = text.encode("utf-8")
+        offset = len(blob)
+        blob.extend(data)
+        return offset, len(data)
+
+    terms = sorted(postings)
+    term_section = bytearray()
+    posting_section = bytearray()
+    for term in terms:
+        offset = len(blob)
+        blob.extend(term)
+        term_section += TERM.pack(offset, len(term), len(postings[term]), len(posting_section))
+        for doc_id, tf in postings[term]:
+            posting_section += POSTING.pack(doc_id, tf)
+
+    doc_section = bytearray()
+    for (question, answer), tokens in zip(pairs, doc_tokens):
+        doc_section += DOC.pack(len(tokens), *put(question), *put(answer))
+
+    avgdl = sum(len(tokens) for tokens in doc_tokens) / len(doc_tokens) if doc_tokens else 0.0
+    terms_offset = HEADER.size
+    postings_offset = terms_offset + len(term_section)
+    docs_offset = postings_offset + len(posting_section)
+    blob_offset = docs_offset + len(doc_section)
+    header = HEADER.pack(MAGIC, len(pairs), len(terms), avgdl, terms_offset, postings_offset, docs_offset, blob_offset)
+    return bytes(header + term_section + posting_section + doc_section + blob)
+
+
+class FaqIndex:
+    """
+    BM25 search over an index file written by build_index. The file is memory-mapped, so it is
+    paged in on demand and shared between forked workers; terms are found by binary search.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.n_docs, self.n_terms, self.avgdl, self._terms, self._postings, self._docs,
+         self._blob) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a FAQ index")
+
+    def _term(self, i):
+        offset, length, df, postings = TERM.unpack_from(self._map, self._terms + i * TERM.size)
+        start = self._blob + offset
+        return self._map[start:start + length], df, postings
+
+    def _find(self, term):
+        low, high = 0, self.n_terms - 1
+        while low <= high:
+            middle = (low + high) // 2
+            found, df, postings = self._term(middle)
+            if found == term:
+                return df, postings
+            if found < term:
+                low = middle + 1
+            else:
+                high = middle - 1
+        return None
+
+    def _text(self, offset, length):
+        start = self._blob + offset
+        return self._map[start:start + length].decode("utf-8")
+
+    def _idf(self, df):
+        return math.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, text, limit=1):
+        '''
+        Returns up to `limit` FaqMatch tuples, best first. `score` is the BM25 score, `confidence`
+        that score divided by the best score any document could get for this query (0..1), so
+        words the FAQ doesn't know about lower it, and `matched_terms` the number of query terms
+        found in the answer's document.
+        '''
+        query = set(tokenize(text))
+        if not query or not self.n_docs:
+            return []
+        scores = Counter()
+        matched = Counter()
+        best_possible = 0.0
+        for term in query:
+            found = self._find(term.encode("utf-8"))
+            idf = self._idf(found[0] if found else 0)
+            best_possible += idf * (K1 + 1)
+            if found is None:
+                continue
+            df, postings = found
+            start = self._postings + postings
+            for i in range(df):
+                doc_id, tf = POSTING.unpack_from(self._map, start + i * POSTING.size)
+                length = DOC.unpack_from(self._map, self._docs + doc_id * DOC.size)[0]
+                norm = K1 * (1 - B + B * length / self.avgdl)
+                scores[doc_id] += idf * tf * (K1 + 1) / (tf + norm)
+                matched[doc_id] += 1
+        results = []
+        for doc_id, score in scores.most_common(limit):
+            _, question_offset, question_length, answer_offset, answer_length = DOC.unpack_from(
+                self._map, self._docs + doc_id * DOC.size
+            )
+            results.append(FaqMatch(
+                score / best_possible,
+                score,
+                matched[doc_id],
+                self._text(question_offset, question_length),
+                self._text(answer_offset, answer_length),
+            ))
+        return results
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,16 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library decoder is used without it
+    orjson = None
+
+
+def loads(data):
+    '''
+    Parses JSON from bytes or str, with orjson when it is installed.
+    Invalid JSON and bytes that are not UTF-8 raise a ValueError (JSONDecodeError or UnicodeDecodeError).
+    '''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,153 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+from .rate_limiter import INTERACTIVE, get_rate_limiter
+
+_lock = threading.Lock()
+
+# Graph API error codes that mean "slow down": application, account, throughput,
+# spam and pair rate limits
+RATE_LIMIT_ERROR_CODES = {4, 613, 80007, 130429, 131048, 131056}
+
+
+class RateLimitTimeout(requests.RequestException):
+    '''
+    No send slot of the phone number became free in time (e.g. the Graph API asked to wait long).
+    '''
+
+
+class GraphClient:
+    """
+    Keep-alive client for the Graph API shared by all send_* helpers.
+
+    One pooled `requests.Session` is reused for every call so the TLS connection to
+    graph.facebook.com stays open, and the URLs and auth headers are built only once.
+    Outgoing messages go through the rate limiter of the phone number and are retried with
+    jittered exponential backoff when the Graph API throttles or fails.
+    """
+
+    def __init__(self, access_token, version, phone_number_id, base_url="https://graph.facebook.com",
+                 pool_size=20, connect_timeout=3.05, read_timeout=10, rate_limit=80, rate_burst=None,
+                 broadcast_share=0.8, max_retries=3, backoff_base=0.5, backoff_max=30, acquire_timeout=60):
+        self.api_url = f"{base_url.rstrip('/')}/{version}"
+        self.messages_url = f"{self.api_url}/{phone_number_id}/messages"
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = get_rate_limiter(phone_number_id, rate_limit, rate_burst, broadcast_share)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.acquire_timeout = acquire_timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {access_token}"})
+        self.json_headers = {"Content-Type": "application/json"}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            access_token=config["ACCESS_TOKEN"],
+            version=config["VERSION"],
+            phone_number_id=config["PHONE_NUMBER_ID"],
+            base_url=config["GRAPH_API_URL"],
+            pool_size=config["GRAPH_POOL_SIZE"],
+            connect_timeout=config["GRAPH_CONNECT_TIMEOUT"],
+            read_timeout=config["GRAPH_READ_TIMEOUT"],
+            rate_limit=config["GRAPH_RATE_LIMIT"],
+            rate_burst=config["GRAPH_RATE_BURST"],
+            broadcast_share=config["GRAPH_BROADCAST_SHARE"],
+            max_retries=config["GRAPH_MAX_RETRIES"],
+            acquire_timeout=config["GRAPH_ACQUIRE_TIMEOUT"],
+        )
+
+    def post_message(self, json=None, data=None, lane=INTERACTIVE):
+        '''
+        POST to /<PHONE_NUMBER_ID>/messages. `data` is an already serialized JSON string.
+        lane is INTERACTIVE for replies in a conversation and BROADCAST for campaigns.
+        Raises RateLimitTimeout if the rate limiter gives no slot within acquire_timeout seconds.
+        '''
+        attempt = 0
+        while True:
+            if not self.limiter.acquire(lane, timeout=self.acquire_timeout):
+                raise RateLimitTimeout(f"no send slot within {self.acquire_timeout} s")
+            try:
+                response = self.session.post(
+                    self.messages_url, json=json, data=data, headers=self.json_headers, timeout=self.timeout
+                )
+            except requests.ConnectionError as e:
+                # read timeouts are not retried: the message may have been sent already
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logging.warning("Graph API connection failed, retrying in %.2fs: %s", delay, e)
+                time.sleep(delay)
+            else:
+                if attempt >= self.max_retries or not self._should_retry(response):
+                    return response
+                # a long Retry-After would pause live replies too, never wait longer than backoff_max
+                delay = min(self._retry_after(response) or self._backoff(attempt), self.backoff_max)
+                logging.warning("Graph API answered %s, retrying in %.2fs", response.status_code, delay)
+                if response.status_code == 429 or self._error_code(response) in RATE_LIMIT_ERROR_CODES:
+                    # hold back every sender of this number, the retry waits for it in acquire()
+                    self.limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+            attempt += 1
+
+    def _backoff(self, attempt):
+        # "full jitter": a random delay up to the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _error_code(response):
+        try:
+            body = response.json()
+        except ValueError:
+            return None
+        error = body.get("error") if isinstance(body, dict) else None
+        return error.get("code") if isinstance(error, dict) else None
+
+    def _should_retry(self, response):
+        if response.status_code == 429 or response.status_code >= 500:
+            return True
+        return response.status_code >= 400 and self._error_code(response) in RATE_LIMIT_ERROR_CODES
+
+    def get_media(self, media_id):
+        ''' Метаданные медиафайла (в том числе временная ссылка на скачивание) '''
+        return self.session.get(f"{self.api_url}/{media_id}/", timeout=self.timeout)
+
+    def download(self, url):
+        return self.session.get(url, stream=True, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
+def get_graph_client():
+    '''
+    Returns the client of the current app, creating it on first use.
+    '''
+    extensions = current_app.extensions
+    client = extensions.get("graph_client")
+    if client is None:
+        with _lock:
+            client = extensions.get("graph_client")
+            if client is None:
+                client = GraphClient.from_config(current_app.config)
+                extensions["graph_client"] = client
+    return client
@@ -0,0 +1,77 @@
+import json
+import logging
+import logging.handlers
+import random
+import re
+import time
+
+# attributes every LogRecord has; anything else was passed through `extra=` and goes into the JSON
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_SECRETS = re.compile(r"(Bearer\s+|access_token=)[A-Za-z0-9._\-]+", re.IGNORECASE)
+
+
+def redact(text):
+    return _SECRETS.sub(r"\1[REDACTED]", text)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records of a category, e.g. request bodies or response headers.
+    The category is passed with `extra={"category": "body"}`; records without one are always kept.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates  # category -> share of records to keep, 0..1
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "category", None))
+        if rate is None or rate >= 1:
+            return True
+        return rate > 0 and random.random() < rate
+
+
+class RedactingFilter(logging.Filter):
+    '''
+    Replaces bearer tokens and access_token parameters in the final message.
+    '''
+
+    def filter(self, record):
+        message = record.getMessage()
+        redacted = redact(message)
+        if redacted != message:
+            record.msg, record.args = redacted, None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per line, with the `extra=` fields of the record as keys.
+    '''
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the QueueListener thread without formatting them in the calling thread.
+
+    The stock QueueHandler formats the message before enqueueing it; here the args are formatted
+    lazily by the listener, so a request thread only pays for building the record.
+    """
+
+    def prepare(self, record):
+        return record
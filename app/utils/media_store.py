@@ -0,0 +1,78 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+
+
+class MediaTooLarge(Exception):
+    def __init__(self, size, max_bytes):
+        super().__init__(f"file is larger than {max_bytes} bytes ({size})")
+        self.size = size
+        self.max_bytes = max_bytes
+
+
+class MediaStore:
+    """
+    Content-addressed file storage: every file is stored once under its SHA-256,
+    as <root>/<ab>/<cd>/<sha256><ext>, however many times and under whatever names it was sent.
+
+    Files are streamed to a temporary file in the same directory tree, hashed on the way
+    and renamed into place, so a reader never sees a partial file.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.tmp_dir = os.path.join(self.root, "tmp")
+
+    @staticmethod
+    def extension(mime_type, filename=None):
+        ''' Расширение файла: по MIME-типу, иначе из имени файла '''
+        ext = mimetypes.guess_extension(mime_type or "") or os.path.splitext(filename or "")[1]
+        ext = ext.lower()
+        # only something like ".pdf" or ".docx", never a path
+        if len(ext) > 10 or not ext[1:].isalnum():
+            return ""
+        return ext
+
+    def path_for(self, sha256, ext=""):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256 + ext)
+
+    def find(self, sha256, ext=""):
+        '''
+        Path of an already stored file with this hash, or None
+        '''
+        if not sha256:
+            return None
+        path = self.path_for(sha256.lower(), ext)
+        return path if os.path.exists(path) else None
+
+    def save(self, chunks, ext=""):
+        '''
+        Writes an iterable of byte chunks and returns (sha256, path, size).
+        Raises MediaTooLarge as soon as more than max_bytes arrive.
+        '''
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise MediaTooLarge(size, self.max_bytes)
+                    digest.update(chunk)
+                    file.write(chunk)
+            sha256 = digest.hexdigest()
+            path = self.path_for(sha256, ext)
+            if os.path.exists(path):
+                os.unlink(tmp_path)  # the same content is already stored
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            return sha256, path, size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
@@ -0,0 +1,185 @@
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flask import g, request
+
+# seconds; from a cached DB query to a Graph API call that was retried
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name -> (type, help); only these families can be recorded
+FAMILIES = {
+    "wahr_http_request_duration_seconds": ("histogram", "Time to answer an HTTP request, by route, method and status."),
+    "wahr_webhook_message_duration_seconds": ("histogram", "Time to process an incoming WhatsApp message, by type."),
+    "wahr_db_query_duration_seconds": ("histogram", "Duration of WADatabase methods, by method."),
+    "wahr_graph_request_duration_seconds": ("histogram", "Duration of Graph API calls, by helper and HTTP status."),
+    "wahr_templates_sent_total": ("counter", "Template messages accepted by the Graph API, by template."),
+    "wahr_survey_transitions_total": ("counter", "Survey transitions, by the step entered (or completed)."),
+    "wahr_opt_outs_total": ("counter", "Users who asked not to receive promotional messages."),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """
+    Counters and histograms in the Prometheus text format for GET /metrics.
+
+    Recording is a dict update under a lock (a few microseconds). Every worker process keeps its own
+    values; with METRICS_DIR set (needed with several gunicorn workers) each one also writes them to
+    METRICS_DIR/metrics-<pid>-<id>.json every METRICS_FLUSH_INTERVAL seconds, and a scrape adds up the
+    files of all processes, so it does not matter which worker answers it. Files of stopped workers are
+    kept so counters never go down; clear the directory when the service (re)starts.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.flush_interval = 5.0
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., count above the last, sum]
+        self._pid = None
+        self._path = None
+
+    def init_app(self, app):
+        self.directory = app.config["METRICS_DIR"]
+        self.flush_interval = app.config["METRICS_FLUSH_INTERVAL"]
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            atexit.register(self.write_snapshot)
+
+        @app.before_request
+        def start_timer():
+            g.metrics_started = time.perf_counter()
+
+        @app.after_request
+        def observe_request(response):
+            started = g.pop("metrics_started", None)
+            if started is not None:
+                route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+                self.observe("wahr_http_request_duration_seconds", time.perf_counter() - started,
+                             route=route, method=request.method, status=response.status_code)
+            return response
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # forked: the values recorded before the fork belong to the parent
+                self._counters.clear()
+                self._histograms.clear()
+            self._pid = os.getpid()
+            if self.directory:
+                self._path = os.path.join(self.directory, f"metrics-{self._pid}-{uuid.uuid4().hex[:8]}.json")
+                threading.Thread(target=self._run, name="metrics", daemon=True).start()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+        self._ensure_started()
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+        index = bisect.bisect_left(BUCKETS, seconds)
+        self._ensure_started()
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += seconds
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, labels, list(values)] for (name, labels), values in self._histograms.items()],
+            }
+
+    def write_snapshot(self):
+        if not self._path:
+            return
+        tmp_path = self._path + ".tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(self._snapshot(), file)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logging.error("Error while writing metrics to %s: %s", self._path, e)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.write_snapshot()
+
+    def _collect(self):
+        if not self.directory:
+            return [self._snapshot()]
+        self._ensure_started()
+        self.write_snapshot()  # this process is always up to date
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            try:
+                with open(path) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError) as e:
+                logging.warning("Skipping metrics file %s: %s", path, e)
+        return snapshots
+
+    def render(self):
+        '''
+        All processes' metrics in the Prometheus text exposition format (0.0.4)
+        '''
+        counters, histograms = {}, {}
+        for snapshot in self._collect():
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged = histograms.setdefault(key, [0] * len(values[:-1]) + [0.0])
+                for i, value in enumerate(values):
+                    merged[i] += value
+
+        lines = []
+        for name, (kind, help_text) in FAMILIES.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for labels, value in sorted((labels, value) for (family, labels), value in counters.items()
+                                            if family == name):
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            for labels, values in sorted((labels, values) for (family, labels), values in histograms.items()
+                                         if family == name):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, values):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, ('le', repr(bound)))} {cumulative}")
+                cumulative += values[len(BUCKETS)]
+                lines.append(f"{name}_bucket{_labels(labels, ('le', '+Inf'))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {values[-1]}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
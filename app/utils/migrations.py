@@ -0,0 +1,174 @@
+import logging
+from collections import namedtuple
+
+# Numbered schema changes, applied in order by `flask --app run init-db` (WADatabase.create_tables).
+# Never edit a migration that was released, add a new one. Run them before starting the workers:
+# a prepared statement whose result column type changed fails until it is prepared again, which
+# costs a running worker a repeated transaction per statement and connection (see statements.py).
+Migration = namedtuple("Migration", ["version", "name", "statements"])
+
+MIGRATIONS = [
+    # the schema as create_tables used to create it; IF NOT EXISTS everywhere, so existing databases adopt it as is
+    Migration(1, "baseline", [
+        """CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            phone VARCHAR(32) UNIQUE NOT NULL,
+            current_step INTEGER DEFAULT 0,
+            survey_mode BOOLEAN DEFAULT FALSE,
+            has_completed_survey BOOLEAN DEFAULT FALSE,
+            wants_notifications BOOLEAN DEFAULT TRUE
+            );""",
+        """CREATE TABLE IF NOT EXISTS surveys (
+            id SERIAL PRIMARY KEY,
+            phone VARCHAR(16) UNIQUE NOT NULL REFERENCES users(phone),
+            age VARCHAR(32),
+            production_experience VARCHAR(32),
+            completed_survey BOOLEAN DEFAULT FALSE,
+            name VARCHAR(50),
+            vacancy VARCHAR(32),
+            sent BOOLEAN DEFAULT FALSE,
+            resume VARCHAR(32) DEFAULT 'Не указан'
+            );""",
+        """CREATE TABLE IF NOT EXISTS vacancies (
+            id SERIAL PRIMARY KEY,
+            title VARCHAR(255) NOT NULL,
+            requirements TEXT,
+            details TEXT,
+            tasks TEXT,
+            salary VARCHAR(32) DEFAULT 'Не указано'
+            );""",
+        # delivery/read callbacks and the sent templates they refer to (see status_ingest.py)
+        """CREATE TABLE IF NOT EXISTS outbound_messages (
+            message_id VARCHAR(128) PRIMARY KEY,
+            recipient_id VARCHAR(32),
+            template_name VARCHAR(128),
+            broadcast_id VARCHAR(32),
+            sent_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );""",
+        "CREATE INDEX IF NOT EXISTS outbound_messages_broadcast_id ON outbound_messages (broadcast_id);",
+        """CREATE TABLE IF NOT EXISTS message_statuses (
+            id BIGSERIAL PRIMARY KEY,
+            message_id VARCHAR(128) NOT NULL,
+            recipient_id VARCHAR(32),
+            status VARCHAR(16) NOT NULL,
+            status_at TIMESTAMPTZ,
+            error_code INTEGER,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );""",
+        "CREATE INDEX IF NOT EXISTS message_statuses_message_id ON message_statuses (message_id);",
+        # ids of handled webhook messages, shared by all worker processes (see dedup.py)
+        """CREATE TABLE IF NOT EXISTS processed_messages (
+            message_id VARCHAR(128) PRIMARY KEY,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );""",
+        # OpenAI assistant thread of every user (see openai_service.py)
+        """CREATE TABLE IF NOT EXISTS assistant_threads (
+            phone VARCHAR(32) PRIMARY KEY,
+            thread_id VARCHAR(64) NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );""",
+        # documents sent by users; the file itself is stored once per sha256 (see media_store.py)
+        """CREATE TABLE IF NOT EXISTS media_files (
+            id SERIAL PRIMARY KEY,
+            phone VARCHAR(32) NOT NULL,
+            sha256 CHAR(64) NOT NULL,
+            filename TEXT,
+            mime_type VARCHAR(128),
+            size BIGINT,
+            path TEXT NOT NULL,
+            received_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            UNIQUE (phone, sha256)
+            );""",
+        # tell the in-process vacancy catalogs to reload whenever the table changes
+        """CREATE OR REPLACE FUNCTION notify_vacancies_changed() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('vacancies_changed', '');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;""",
+        """DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_trigger WHERE tgname = 'vacancies_changed' AND tgrelid = 'vacancies'::regclass
+                ) THEN
+                    CREATE TRIGGER vacancies_changed
+                    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON vacancies
+                    FOR EACH STATEMENT EXECUTE PROCEDURE notify_vacancies_changed();
+                END IF;
+            END;
+            $$;""",
+    ]),
+    # surveys.phone must hold every users.phone it references, and full vacancy titles are saved into vacancy.
+    # Making a varchar longer only changes the catalog, the table and its indexes are not rewritten.
+    Migration(2, "widen surveys.phone and surveys.vacancy", [
+        "ALTER TABLE surveys ALTER COLUMN phone TYPE VARCHAR(32);",
+        "ALTER TABLE surveys ALTER COLUMN vacancy TYPE VARCHAR(255);",
+    ]),
+    Migration(3, "indexes for the hot queries", [
+        # unsent surveys (export, claim): only the few unsent rows are indexed, in id order
+        "CREATE INDEX IF NOT EXISTS surveys_unsent ON surveys (id) WHERE sent = FALSE;",
+        # the statuses of a message in the delivery summary without visiting the table
+        "CREATE INDEX IF NOT EXISTS message_statuses_message_id_status ON message_statuses (message_id) INCLUDE (status);",
+        "DROP INDEX IF EXISTS message_statuses_message_id;",
+        "CREATE INDEX IF NOT EXISTS outbound_messages_template_name ON outbound_messages (template_name);",
+        # purge_processed_messages
+        "CREATE INDEX IF NOT EXISTS processed_messages_received_at ON processed_messages (received_at);",
+    ]),
+    # progress of /send_messages broadcasts, readable from every worker process (see broadcast.py)
+    Migration(4, "broadcast_jobs", [
+        """CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id VARCHAR(32) PRIMARY KEY,
+            template_name VARCHAR(128),
+            status VARCHAR(16) NOT NULL,
+            error TEXT,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            started_at TIMESTAMPTZ,
+            finished_at TIMESTAMPTZ,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );""",
+    ]),
+    # the resume answer holds the path of the stored file (see media_pipeline.py), longer than 32 characters;
+    # answers saved as a media_files id meanwhile get the path of that file
+    Migration(5, "surveys.resume holds the resume path", [
+        "ALTER TABLE surveys ALTER COLUMN resume TYPE TEXT;",
+        """UPDATE surveys SET resume = media_files.path
+            FROM media_files
+            WHERE media_files.id::text = surveys.resume
+            AND media_files.phone = surveys.phone;""",
+    ]),
+]
+
+
+def migrate(database, target=None):
+    '''
+    Applies the migrations up to `target` (all by default) that are not in schema_migrations yet,
+    each in its own transaction. Returns the applied ones. Concurrent callers wait for each other.
+    '''
+    with database.cursor() as cur:
+        cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    );""")
+    applied = []
+    for migration in MIGRATIONS:
+        if target is not None and migration.version > target:
+            break
+        with database.cursor() as cur:
+            # another deploy step running at the same time applies it first, this one then skips it
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (migration.version,))
+            if cur.fetchone() is not None:
+                continue
+            for statement in migration.statements:
+                cur.execute(statement)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (migration.version, migration.name)
+            )
+        logging.info("Applied migration %s: %s", migration.version, migration.name)
+        applied.append(migration)
+    return applied
@@ -0,0 +1,36 @@
+import gzip
+import hashlib
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is served without it
+    brotli = None
+
+
+class PrecompressedBody:
+    """
+    A response body compressed once up front (gzip, and brotli if installed) with a strong ETag per encoding.
+
+    The ETag is a hash of the content, so every worker process gives the same ETag for the same data;
+    the compressed bodies are other representations and get the encoding as a suffix ("<hash>-gzip").
+    """
+
+    def __init__(self, body):
+        self.identity = body
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.encodings = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(body)
+
+    def etag_for(self, encoding):
+        return self.etag if encoding is None else f"{self.etag}-{encoding}"
+
+    def select(self, accept_encodings):
+        '''
+        Returns (content encoding or None, body, etag) for the request's Accept-Encoding
+        (a werkzeug MIMEAccept/Accept object), preferring the smallest body.
+        '''
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and accept_encodings[encoding] > 0:
+                return encoding, self.encodings[encoding], self.etag_for(encoding)
+        return None, self.identity, self.etag
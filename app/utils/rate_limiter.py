@@ -0,0 +1,92 @@
+import threading
+import time
+
+INTERACTIVE = "interactive"
+BROADCAST = "broadcast"
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Token bucket for outbound messages of one phone number, with two priority lanes.
+
+    Interactive replies always go first. Broadcast sends only get a token when no interactive
+    send is waiting, and they are additionally capped at `broadcast_share` of the rate, so a
+    campaign can never use up the whole throughput of the number.
+    """
+
+    def __init__(self, rate, burst=None, broadcast_share=0.8):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.broadcast_rate = self.rate * broadcast_share
+        self.broadcast_burst = max(1.0, self.burst * broadcast_share)
+        self.tokens = self.burst
+        self.broadcast_tokens = self.broadcast_burst
+        self.paused_until = 0.0
+        self.interactive_waiting = 0
+        self._updated_at = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.broadcast_tokens = min(self.broadcast_burst, self.broadcast_tokens + elapsed * self.broadcast_rate)
+
+    def acquire(self, lane=INTERACTIVE, timeout=None):
+        '''
+        Blocks until the message may be sent. Returns False if the timeout ran out first.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if lane == INTERACTIVE:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now < self.paused_until:
+                        wait = self.paused_until - now
+                    elif lane == INTERACTIVE:
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            return True
+                        wait = (1 - self.tokens) / self.rate
+                    else:
+                        if self.interactive_waiting == 0 and self.tokens >= 1 and self.broadcast_tokens >= 1:
+                            self.tokens -= 1
+                            self.broadcast_tokens -= 1
+                            return True
+                        wait = max((1 - self.tokens) / self.rate, (1 - self.broadcast_tokens) / self.broadcast_rate)
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            return False
+                        wait = min(wait, remaining)
+                    self._cond.wait(max(wait, 0.001))
+            finally:
+                if lane == INTERACTIVE:
+                    self.interactive_waiting -= 1
+                    # a waiting broadcast send may proceed now
+                    self._cond.notify_all()
+
+    def pause(self, seconds):
+        '''
+        Stop handing out tokens for a while, e.g. after the Graph API answered 429.
+        '''
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def get_rate_limiter(phone_number_id, rate, burst=None, broadcast_share=0.8):
+    '''
+    Returns the process-wide limiter of a phone number, creating it on first use.
+    '''
+    with _limiters_lock:
+        limiter = _limiters.get(phone_number_id)
+        if limiter is None:
+            limiter = RateLimiter(rate, burst, broadcast_share)
+            _limiters[phone_number_id] = limiter
+        return limiter
@@ -0,0 +1,129 @@
+import re
+import threading
+import time
+
+import psycopg2.errors
+import psycopg2.extensions
+
+_NAME = re.compile(r"[a-z_][a-z0-9_]*")
+_PARAM = re.compile(r"\$(\d+)")
+
+
+class StalePlan(Exception):
+    '''
+    A prepared statement failed because a column type it returns changed (a migration ran).
+    Its transaction is aborted; the statement is prepared again when the transaction is repeated.
+    '''
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    '''
+    psycopg2 connection that remembers which statements are prepared in its server session
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.stale = set()  # prepared, but to be deallocated before they are prepared again
+
+
+class StatementRegistry:
+    """
+    Named statements of WADatabase, prepared once per pooled connection (PREPARE) and run with
+    EXECUTE, so Postgres parses and plans them once per session instead of on every call.
+    Queries use $1, $2 ... parameters. With prepare=False (pgbouncer in transaction mode) they
+    are sent as plain queries. Calls and timings are kept per statement name for /stats.
+
+    A prepared statement outlives the transaction that prepared it, even a rolled back one,
+    so the per-connection set of names stays correct. After a migration changed a column type a
+    statement returns, Postgres rejects it until it is deallocated: it is prepared again and run
+    once more, right here if it opened the transaction, else by repeating the transaction (StalePlan).
+    """
+
+    def __init__(self, prepare=True):
+        self.prepare = prepare
+        self._queries = {}  # name -> (query, the same query with psycopg2 placeholders)
+        self._lock = threading.Lock()
+        self._stats = {}  # name -> [calls, prepares, seconds total, seconds max]
+
+    def _register(self, name, query):
+        if not _NAME.fullmatch(name):
+            raise ValueError(f"invalid statement name: {name!r}")
+        with self._lock:
+            registered = self._queries.get(name)
+            if registered is None:
+                plain = _PARAM.sub(lambda m: f"%(p{m.group(1)})s", query.replace("%", "%%"))
+                registered = self._queries[name] = (query, plain)
+                self._stats[name] = [0, 0, 0.0, 0.0]
+        if registered[0] != query:
+            raise ValueError(f"statement {name} is already registered with another query")
+        return registered[1]
+
+    def execute(self, cur, name, query, params=()):
+        '''
+        Runs the query under the given name on the cursor, preparing it on the cursor's connection first if needed
+        '''
+        plain = self._register(name, query)
+        prepared = getattr(cur.connection, "prepared", None) if self.prepare else None
+        started = time.perf_counter()
+        prepared_now = False
+        if prepared is None:
+            cur.execute(plain, {f"p{i}": value for i, value in enumerate(params, 1)})
+        else:
+            connection = cur.connection
+            in_transaction = connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            if name not in prepared:
+                self._prepare(cur, name, query)
+                prepared_now = True
+            try:
+                self._execute_prepared(cur, name, params)
+            except psycopg2.errors.FeatureNotSupported as e:
+                # Postgres refuses the statement until it is deallocated, not just once
+                if "cached plan must not change result type" not in str(e):
+                    raise
+                prepared.discard(name)
+                connection.stale.add(name)
+                if in_transaction:
+                    # rolling back here would lose the caller's earlier statements
+                    raise StalePlan(name) from e
+                connection.rollback()
+                self._prepare(cur, name, query)
+                self._execute_prepared(cur, name, params)
+                prepared_now = True
+        took = time.perf_counter() - started
+        with self._lock:
+            stats = self._stats[name]
+            stats[0] += 1
+            stats[1] += prepared_now
+            stats[2] += took
+            stats[3] = max(stats[3], took)
+
+    @staticmethod
+    def _prepare(cur, name, query):
+        connection = cur.connection
+        if name in connection.stale:
+            cur.execute(f"DEALLOCATE {name}")
+            connection.stale.discard(name)
+        cur.execute(f"PREPARE {name} AS {query}")
+        connection.prepared.add(name)
+
+    @staticmethod
+    def _execute_prepared(cur, name, params):
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+    def stats(self):
+        with self._lock:
+            items = [(name, list(values)) for name, values in self._stats.items()]
+        return {
+            name: {
+                "calls": calls,
+                "prepares": prepares,
+                "avg_ms": round(1000 * seconds / calls, 3) if calls else 0.0,
+                "max_ms": round(1000 * max_seconds, 3),
+                "total_ms": round(1000 * seconds, 1),
+            }
+            for name, (calls, prepares, seconds, max_seconds) in sorted(items)
+        }
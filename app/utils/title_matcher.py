@@ -0,0 +1,83 @@
+import re
+from collections import deque
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize(text):
+    '''
+    Приводит текст к виду для сравнения: нижний регистр, ё -> е, один пробел между словами.
+    '''
+    return _whitespace.sub(" ", text.lower().replace("ё", "е")).strip()
+
+
+class TitleMatcher:
+    """
+    Aho-Corasick automaton over normalized vacancy titles.
+
+    Finds every title contained in a message in one pass over the message, instead of
+    testing the titles one by one.
+    """
+
+    def __init__(self, titles):
+        '''
+        titles - iterable of (vacancy_id, title) pairs
+        '''
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]  # (vacancy_id, pattern length) for every pattern ending in the state
+
+        for vacancy_id, title in titles:
+            pattern = normalize(title or "")
+            if pattern:
+                self._add(pattern, vacancy_id)
+        self._build_failure_links()
+
+    def _add(self, pattern, vacancy_id):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = next_state
+            state = next_state
+        self.output[state].append((vacancy_id, len(pattern)))
+
+    def _build_failure_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                # patterns that end in the failure state also end here
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find_all(self, text):
+        '''
+        Returns the ids of all vacancies whose title occurs in the text, in order of appearance.
+        Longer titles come first when several start at the same position.
+        '''
+        goto, fail, output = self.goto, self.fail, self.output
+        matches = []
+        state = 0
+        for position, char in enumerate(normalize(text)):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for vacancy_id, length in output[state]:
+                matches.append((position - length + 1, -length, vacancy_id))
+
+        found = []
+        seen = set()
+        for _, _, vacancy_id in sorted(matches):
+            if vacancy_id not in seen:
+                seen.add(vacancy_id)
+                found.append(vacancy_id)
+        return found
@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import namedtuple
+
+import psycopg2
+
+from .precompressed import PrecompressedBody
+from .title_matcher import TitleMatcher
+
+Vacancy = namedtuple("Vacancy", ["id", "title", "requirements", "details", "tasks", "salary"])
+
+
+def shorten_title(title, max_length=24):
+    """
+    Shortens a given title to a maximum length.
+
+    Args:
+        title (str): название вакансии.
+        max_length (int): максимальная длина заголовка.
+
+    Returns:
+        str: The shortened title.
+    """
+    if len(title) > max_length:
+        return title[:max_length]  # Truncate the title to the max length
+    return title
+
+
+class CatalogSnapshot:
+    '''
+    Immutable copy of the vacancies table at one version. Readers keep a reference to it,
+    so a refresh never changes the data under them.
+    '''
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = tuple(Vacancy(*row) for row in rows)
+        self.by_id = {vacancy.id: vacancy for vacancy in self.rows}
+        self.sections = self._build_sections()
+        self.loaded_at = time.monotonic()
+        self._matcher = None
+        self._export = None
+
+    @property
+    def matcher(self):
+        '''
+        Title matcher for this version, built on first use.
+        '''
+        if self._matcher is None:
+            self._matcher = TitleMatcher((vacancy.id, vacancy.title) for vacancy in self.rows)
+        return self._matcher
+
+    @property
+    def export(self):
+        '''
+        Compact JSON of all vacancies for GET /vacancies, compressed once per version.
+        '''
+        if self._export is None:
+            body = json.dumps([vacancy._asdict() for vacancy in self.rows], ensure_ascii=False, separators=(",", ":"))
+            self._export = PrecompressedBody(body.encode("utf-8"))
+        return self._export
+
+    def _build_sections(self):
+        ''' Секции для interactive сообщения со списком вакансий (максимум 10 строк в секции) '''
+        sections = []
+        max_rows_per_section = 10
+        for i in range(0, len(self.rows), max_rows_per_section):
+            section_vacancies = self.rows[i:i + max_rows_per_section]
+            section = {
+                "title": f"Стр. {i // max_rows_per_section + 1}",
+                "rows": [{"id": str(vac.id), "title": shorten_title(vac.title), "description": vac.salary} for vac in section_vacancies]
+            }
+            sections.append(section)
+        return sections
+
+
+class VacancyCatalog:
+    """
+    In-memory catalog of vacancies, loaded once and refreshed only when the table changes.
+
+    A trigger on `vacancies` (see WADatabase.create_tables) sends a NOTIFY on every change and a
+    listener thread marks the catalog stale. The TTL is a fallback for missed notifications,
+    e.g. while the listener is reconnecting.
+    """
+
+    CHANNEL = "vacancies_changed"
+    RETRY_INTERVAL = 5  # seconds to keep serving the previous snapshot after a failed reload
+
+    def __init__(self, load, db_config, ttl=300, listen=True):
+        self.load = load  # callable returning the rows of the vacancies table
+        self.db_config = db_config
+        self.ttl = ttl
+        self.listen = listen
+        self._snapshot = None
+        self._stale = True
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._listener_pid = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "refreshes": 0, "refresh_failures": 0, "notifications": 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def snapshot(self):
+        '''
+        Returns the current CatalogSnapshot, reloading it first if the table has changed.
+        If the reload fails the previous snapshot is served; it raises only when there is none yet.
+        '''
+        self._ensure_listening()
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and (
+            (not self._stale and now - snapshot.loaded_at < self.ttl) or now < self._retry_at
+        ):
+            self._count("hits")
+            return snapshot
+
+        self._count("misses")
+        if snapshot is not None:
+            # someone is already reloading, keep serving the previous version meanwhile
+            if not self._lock.acquire(blocking=False):
+                return snapshot
+        else:
+            self._lock.acquire()
+        try:
+            if self._snapshot is snapshot:
+                self.refresh()
+            return self._snapshot
+        except Exception as e:
+            if snapshot is None:
+                raise
+            # the vacancies rarely change, a slightly old list is better than none
+            self._count("refresh_failures")
+            logging.error("Reloading the vacancy catalog failed, serving version %s: %s", snapshot.version, e)
+            self._retry_at = time.monotonic() + self.RETRY_INTERVAL
+            return snapshot
+        finally:
+            self._lock.release()
+
+    def refresh(self):
+        # clear the flag before loading, so a change during the load triggers another refresh
+        self._stale = False
+        try:
+            rows = self.load()
+        except Exception:
+            self._stale = True
+            raise
+        version = self._snapshot.version + 1 if self._snapshot is not None else 1
+        self._snapshot = CatalogSnapshot(version, rows)
+        self._count("refreshes")
+        logging.info("Vacancy catalog loaded: version %s, %s vacancies", version, len(rows))
+
+    def invalidate(self):
+        self._stale = True
+
+    @property
+    def version(self):
+        return self.snapshot().version
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        snapshot = self._snapshot
+        stats["version"] = snapshot.version if snapshot is not None else 0
+        stats["vacancies"] = len(snapshot.rows) if snapshot is not None else 0
+        stats["listening"] = self._listener_pid == os.getpid()
+        return stats
+
+    ######## LISTEN/NOTIFY ##############
+
+    def _ensure_listening(self):
+        if not self.listen or self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            listener = threading.Thread(target=self._listen, name="vacancy-catalog-listener", daemon=True)
+            listener.start()
+            self._listener_pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.db_config)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.CHANNEL};")
+                # anything could have changed while we were not listening
+                self.invalidate()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self.invalidate()
+                        self._count("notifications")
+            except Exception as e:
+                logging.error("Vacancy catalog listener failed, retrying: %s", e)
+                self.invalidate()
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
@@ -1,25 +1,25 @@
 import logging
+import time
+from functools import wraps
 from flask import current_app, jsonify
 import json
 import requests
-from dotenv import load_dotenv
-import os
-
-# from app.services.openai_service import generate_ai_ response
-
-from .db import WADatabase
+from werkzeug.local import LocalProxy
+
+from app.services.openai_service import generate_ai_response
+from app.services.faq import faq_responder, is_greeting
+
+from .db import get_database
+from .graph_client import get_graph_client
+from .metrics import metrics
+from .rate_limiter import INTERACTIVE
+from app.services.status_ingest import status_ingest
+from app.services.media_pipeline import media_pipeline
+from app.services.survey_sessions import survey_sessions
 import re
 
-load_dotenv()
-
-db_config = {
-    'host': os.getenv("DBHOST"),
-    'database': os.getenv("DBNAME"),
-    'user': os.getenv("DBUSER"),
-    'password': os.getenv("DBPASSWORD"),
-    'port': os.getenv("DBPORT")
-}
-database = WADatabase(db_config)
+# the WADatabase of the current app (views.py imports it too), nothing connects before the first query
+database = LocalProxy(get_database)
 
 # Example survey questions with JSON keys
 survey_questions = [
@@ -47,9 +47,11 @@ def is_valid_whatsapp_message(body):
 
 # logs http response
 def log_http_response(response):
-    logging.info(f"Status: {response.status_code}")
-    logging.info(f"Content-type: {response.headers.get('content-type')}")
-    logging.info(f"Body: {response.text}")
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return  # don't even decode the body
+    logging.info("Status: %s", response.status_code)
+    logging.info("Content-type: %s", response.headers.get('content-type'), extra={"category": "headers"})
+    logging.info("Body: %s", response.text, extra={"category": "response"})
 
 
 
@@ -58,40 +60,22 @@ def log_http_response(response):
 def fetch_media_data(media_id):
     ''' Получение ссылки на документ'''
 
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{media_id}/"
-    
-    headers = {
-        'Authorization': f'Bearer {current_app.config["ACCESS_TOKEN"]}'
-    }
-
+    started = time.perf_counter()
+    status = "error"
     try:
-        response = requests.get(url, headers=headers)
+        response = get_graph_client().get_media(media_id)
+        status = response.status_code
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching media data: {e}")
+        logging.error("Error fetching media data: %s", e)
         raise
+    finally:
+        metrics.observe("wahr_graph_request_duration_seconds", time.perf_counter() - started,
+                        helper="fetch_media_data", status=status)
 
-def get_file(url, file_name):
-    headers = {
-        'Authorization': f'Bearer {current_app.config["ACCESS_TOKEN"]}'
-    }
-    try:
-        response = requests.get(url, headers=headers, stream=True)
-        response.raise_for_status()
-        downloads_folder = '/home/shark/wahr_chatbot/downloads'
-        file_path = os.path.join(downloads_folder, file_name)
-
-        with open(file_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        logging.info(f"Downloaded file: {file_path}")
-        return file_path
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error downloading file: {e}")
-        raise
-
-
+def notify_user(wa_id, text):
+    send_message(get_text_message_input(wa_id, text))
 
 
 # processes OpenAI style text to What's App style text (for AI integration)
@@ -187,82 +171,70 @@ def create_button_interactive_json(header_text, body_text, footer_text, button_t
 
     return json
 
-def send_interactive(wa_id, interactive_elements):
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
-    
-    headers = {
-        "Authorization": "Bearer " + current_app.config["ACCESS_TOKEN"],
-        "Content-Type": "application/json",
-    }
-
-    data = {
-        "messaging_product": "whatsapp",
-        "recipient_type": "individual",
-        "to": wa_id, #change to something else
-    }
-    data.update(interactive_elements)
-
-    logging.info(f'POST data: URL {url}\n headers: {headers}\n data: {data}')
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-    except requests.Timeout:
-        logging.error("Timeout occurred while sending message")
-        return jsonify({"status": "error", "message": "Request timed out"}), 408
-    except requests.RequestException as e:
-        logging.error(f"Request failed due to: {e}")
-        return jsonify({"status": "error", "message": "Failed to send message"}), 500
-    else:
-        log_http_response(response)
-        return response
-
-# sends a message (first, a reply is required)
-def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {current_app.config['ACCESS_TOKEN']}",
-    }
-
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
-
-    logging.info(f'POST data: URL {url}\n headers: {headers}\n data: {data}')
+def post_to_graph(data=None, json_data=None, lane=INTERACTIVE, helper="post_to_graph"):
+    '''
+    Sends a message through the shared Graph API client (rate limited, with retries).
+    Returns the response, or an error tuple if the request failed.
+    helper - the send_* function, the duration goes to /metrics under its name.
+    '''
+    started = time.perf_counter()
+    status = "error"
     try:
-        response = requests.post(
-            url, data=data, headers=headers, timeout=10
-        )  # 10 seconds timeout as an example
+        response = get_graph_client().post_message(json=json_data, data=data, lane=lane)
+        status = response.status_code
         response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
     except requests.Timeout:
+        status = "timeout"
         logging.error("Timeout occurred while sending message")
         return jsonify({"status": "error", "message": "Request timed out"}), 408
     except (
         requests.RequestException
     ) as e:  # This will catch any general request exception
-        logging.error(f"Request failed due to: {e}")
+        logging.error("Request failed due to: %s", e)
         return jsonify({"status": "error", "message": "Failed to send message"}), 500
     else:
         # Process the response as normal
         log_http_response(response)
         return response
+    finally:
+        metrics.observe("wahr_graph_request_duration_seconds", time.perf_counter() - started, helper=helper, status=status)
 
-def send_template_message(wa_id, template_name = "hello_world", code = "en-US"):
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
-    headers = {
-        "Authorization": "Bearer " + current_app.config["ACCESS_TOKEN"],
-        "Content-Type": "application/json",
+def send_interactive(wa_id, interactive_elements):
+    data = {
+        "messaging_product": "whatsapp",
+        "recipient_type": "individual",
+        "to": wa_id, #change to something else
     }
+    data.update(interactive_elements)
+
+    logging.info('POST data: %s', data, extra={"category": "body"})
+    return post_to_graph(json_data=data, helper="send_interactive")
+
+# sends a message (first, a reply is required)
+def send_message(data):
+    logging.info('POST data: %s', data, extra={"category": "body"})
+    return post_to_graph(data=data, helper="send_message")
+
+def send_template_message(wa_id, template_name = "hello_world", code = "en-US", lane = INTERACTIVE, broadcast_id = None):
     data = {
         "messaging_product": "whatsapp",
         "to": wa_id, #change to something else
         "type": "template",
         "template": {"name": f"{template_name}", "language": {"code": f"{code}"}},
     }
-    logging.info(f'POST data: URL {url}\n headers: {headers}\n data: {data}')
-    
-    response = requests.post(url, headers=headers, json=data)
-    log_http_response(response)
+    logging.info('POST data: %s', data, extra={"category": "body"})
+    response = post_to_graph(json_data=data, lane=lane, helper="send_template_message")
+    if isinstance(response, requests.Response):
+        metrics.inc("wahr_templates_sent_total", template=template_name)
+        # remember the message id, so its delivery statuses can be summarized per template/broadcast
+        try:
+            message_id = response.json()["messages"][0]["id"]
+            status_ingest.add_outbound(message_id, wa_id, template_name, broadcast_id)
+        except (ValueError, KeyError, IndexError):
+            pass
     return response
 
-def send_template_message_with_parameters(wa_id, template_name, code, template_data):
+def send_template_message_with_parameters(wa_id, template_name, code, template_data, lane=INTERACTIVE):
     """
     Sends a WhatsApp message using a template with dynamic data.
 
@@ -271,17 +243,12 @@ def send_template_message_with_parameters(wa_id, template_name, code, template_d
         template_name (str): The name of the template.
         code (str): language code
         template_data (list): A list of dynamic data to replace placeholders.
+        lane (str): INTERACTIVE for replies, BROADCAST for campaigns.
 
     Returns:
-        Response: The API response object.
+        Response: The API response object, or an error tuple if the request failed.
     """
 
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
-    headers = {
-        "Authorization": "Bearer " + current_app.config["ACCESS_TOKEN"],
-        "Content-Type": "application/json",
-    }
-
     data = {
         "messaging_product": "whatsapp",
         "to": wa_id,
@@ -298,15 +265,12 @@ def send_template_message_with_parameters(wa_id, template_name, code, template_d
         }
     }
 
-    response = requests.post(url, headers=headers, json=data)
+    response = post_to_graph(json_data=data, lane=lane, helper="send_template_message_with_parameters")
+    if isinstance(response, requests.Response):
+        metrics.inc("wahr_templates_sent_total", template=template_name)
     return response
 
 def send_location_message(wa_id, latitude, longitude, name, address):
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
-    headers = {
-        "Authorization": "Bearer " + current_app.config["ACCESS_TOKEN"],
-        "Content-Type": "application/json",
-    }
     data = {
         "messaging_product": "whatsapp",
         "to": wa_id, #change to something else
@@ -318,10 +282,8 @@ def send_location_message(wa_id, latitude, longitude, name, address):
             "address": f"{address}"
         }
     }
-    logging.info(f'POST data: URL {url}\n headers: {headers}\n data: {data}')
-    response = requests.post(url, headers=headers, json=data)
-    log_http_response(response)
-    return response
+    logging.info('POST data: %s', data, extra={"category": "body"})
+    return post_to_graph(json_data=data, helper="send_location_message")
 
 ##### Higher level messages ####
 
@@ -362,34 +324,52 @@ def init_resume_flow(wa_id):
     try:
         question = survey_questions[0]['question']
         data = get_text_message_input(wa_id, question)
-        database.mark_survey_as_completed_or_incompleted(wa_id, isCompleted=False)
-        database.set_step(wa_id) # sets to 1
-        database.set_survey_mode(wa_id, True)
+        survey_sessions.transition(wa_id, completed=False, current_step=1, survey_mode=True)
         send_message(data)
     except KeyError:
         logging.error('No question available for the current step.')
     except Exception as e:
-        logging.error(f'Error while sending question or updating session: {e}')
+        logging.error('Error while sending question or updating session: %s', e)
 
 def init_resume_flow_vac_filled(wa_id, interactive):
     try:
         vacancy_id = int(interactive.get("button_reply", {}).get("id", ""))
         vacancy = database.get_vacancy_details(vacancy_id)
-        database.save_vacancy(wa_id, vacancy)
 
         question = survey_questions[0]['question']
         data = get_text_message_input(wa_id, question)
-        database.mark_survey_as_completed_or_incompleted(wa_id, isCompleted=False)
-        database.set_step(wa_id) # sets to 1
-        database.set_survey_mode(wa_id, True)
+        survey_sessions.transition(wa_id, completed=False, current_step=1, survey_mode=True,
+                                   survey={"vacancy": vacancy[0]})
         send_message(data)
     except KeyError:
         logging.error('No question available for the current step.')
     except Exception as e:
-        logging.error(f'Error while sending question or updating session: {e}')
+        logging.error('Error while sending question or updating session: %s', e)
 
 #####################
 
+def _timed_by_message_type(process):
+    '''
+    Observes the processing time of every message under its type (text, button, list_reply, ...)
+    '''
+    @wraps(process)
+    def wrapper(body):
+        started = time.perf_counter()
+        try:
+            return process(body)
+        finally:
+            try:
+                message = body["entry"][0]["changes"][0]["value"]["messages"][0]
+                message_type = message.get("type") or "unknown"
+                if message_type == "interactive":
+                    message_type = message.get("interactive", {}).get("type") or message_type
+            except (KeyError, IndexError, TypeError):
+                message_type = "unknown"
+            metrics.observe("wahr_webhook_message_duration_seconds", time.perf_counter() - started, type=message_type)
+
+    return wrapper
+
+@_timed_by_message_type
 def process_whatsapp_message(body):
     wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"] # change .config recipient waid to this i guess
     name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
@@ -405,15 +385,11 @@ def process_whatsapp_message(body):
 
     sent_answer = False
 
-    db_user = database.get_user(wa_id)
-    logging.info(f'Is the user with waid {wa_id} in the DB? Answer: {db_user}')
-    
-    if db_user == False:
-        database.create_user(wa_id) # CREATE A USER
-
-    survey_mode, step = database.filling_a_survey(wa_id)
-    logging.info(f'survey mode is {survey_mode} and step is {step}')
-    vacancy_filled = database.vacancy_filled(wa_id) # true or false
+    # creates the user if needed and fetches its survey state, from memory for active users if the cache is on
+    user_state = survey_sessions.get(wa_id)
+    survey_mode, step = user_state.survey_mode, user_state.current_step
+    logging.info('survey mode is %s and step is %s', survey_mode, step)
+    vacancy_filled = user_state.vacancy_filled # true or false
 
     if survey_mode == True:
         if step < len(survey_questions):
@@ -423,35 +399,29 @@ def process_whatsapp_message(body):
                 current_key = survey_questions[step]['key']
             except IndexError:
                 logging.error("Outside the index")
-            logging.info(f'Key: {key}, vacancy_filled: {vacancy_filled}')
+            logging.info('Key: %s, vacancy_filled: %s', key, vacancy_filled)
             if current_key == 'vacancy' and (vacancy_filled == True): # age precedes vacancy IMPORTANT 
                 # skip the vacancy question if it was filled
                 step += 1
-                database.increment_step(wa_id)
 
             question = survey_questions[step]['question']
             data = get_text_message_input(wa_id, question)
-            database.increment_step(wa_id)
-            database.save_survey_results(wa_id, key, message_body)
+            # the answer and the next step are saved together
+            survey_sessions.transition(wa_id, current_step=step + 1, survey={key: message_body})
         else:
             # handle receiving a document    
             key = survey_questions[step-1]['key']
             if message_type == 'document':
-                database.set_survey_mode(wa_id, value=False)
-                database.mark_survey_as_completed_or_incompleted(wa_id, isCompleted=True) # this should mark it as completed for the user
-
                 document_id = message['document']['id']
-                filename = message['document']['filename'].replace(' ', '_')
-                try:
-                    document_data = fetch_media_data(document_id)
-                    file_path = get_file(document_data['url'], filename)
-                    database.save_survey_results(wa_id, key, file_path)
-                except Exception as e:
-                    error = f'Ошибка при обработке отправленного документа: {e}'
-                    logging.error(error)
-                    data = get_text_message_input(wa_id, error)
+                filename = message['document'].get('filename')
+                # downloaded in the background, the survey gets the path of the stored file
+                if not media_pipeline.submit(wa_id, document_id, filename, survey_key=key):
+                    logging.warning("Media queue is full, document %s from %s dropped", document_id, wa_id)
+                    data = get_text_message_input(wa_id, 'Не удалось принять документ, пожалуйста, отправьте его ещё раз позже.')
                     send_message(data)
-                    return jsonify({"status": "error", "message": str(e)}), 500
+                    return jsonify({"status": "error", "message": "Media queue is full"}), 503
+                # completed only once the resume is queued, a rejected one can be sent again
+                survey_sessions.transition(wa_id, survey_mode=False, completed=True)
 
                 data = get_text_message_input(wa_id, "Мы сохранили ваши данные!")
             elif message_type == 'text':
@@ -459,9 +429,7 @@ def process_whatsapp_message(body):
                 if message_body != 'Нет':
                     data = get_text_message_input(wa_id, 'Пожалуйста, отправьте файл в качестве ответа. Если вы желаете не указывать резюме, напишите "Нет".')
                 else:
-                    database.set_survey_mode(wa_id, value=False)
-                    database.mark_survey_as_completed_or_incompleted(wa_id, isCompleted=True) # this should mark it as completed for the user
-                    database.save_survey_results(wa_id, key, "Не указан")
+                    survey_sessions.transition(wa_id, survey_mode=False, completed=True, survey={key: "Не указан"})
                     data = get_text_message_input(wa_id, 'Ваши данные сохранены. Резюме не указано.')
             else:
                 data = get_text_message_input(wa_id, 'Пожалуйста, отправьте файл в качестве ответа.')
@@ -476,20 +444,39 @@ def process_whatsapp_message(body):
             sent_answer = True
 
         if not sent_answer:
-            vacancies = database.get_vacancies()
-            for idx, vacancy_title in vacancies: # vacancy details
-                if vacancy_title.lower() in message_body:
-                    vacancy = database.get_vacancy_details(idx)
-                    # data = get_text_message_input(wa_id, response)
-                    # send_message(data)
-                    send_vacancy_details(wa_id, vacancy)
-                    sent_answer = True
-                    break
+            matched_ids = database.match_vacancies(message_body) # vacancy details
+            if matched_ids:
+                idx = matched_ids[0]
+                vacancy = database.get_vacancy_details(idx)
+                # data = get_text_message_input(wa_id, response)
+                # send_message(data)
+                send_vacancy_details(wa_id, vacancy, idx)
+                sent_answer = True
+
+        greeting = is_greeting(message_body) # answered by the greeting template with its buttons
+        if not sent_answer and not greeting:
+            answer = faq_responder.answer(message_body) # common questions, from the local FAQ index
+            if answer:
+                data = get_text_message_input(wa_id, answer)
+                send_message(data)
+                sent_answer = True
+
+        if not sent_answer and not greeting and current_app.config["AI_FALLBACK"]:
+            faq_responder.record_fallback(to_ai=True)
+            try:
+                response = generate_ai_response(message_body, wa_id, name)
+                data = get_text_message_input(wa_id, process_text(response))
+                send_message(data)
+                sent_answer = True
+            except Exception as e:
+                logging.error("AI response failed, sending the greeting instead: %s", e)
 
         if not sent_answer:
+            if not current_app.config["AI_FALLBACK"] and not greeting:
+                faq_responder.record_fallback(to_ai=False)
             logging.info("Trying to send a template message")
             res = send_template_message(wa_id, template_name="greeting", code="ru")
-            logging.info(f'Response: {res}')
+            logging.info('Response: %s', res)
             
     elif message_type == "button":
         payload = message.get("button", {}).get("payload", "")
@@ -517,7 +504,8 @@ def process_whatsapp_message(body):
             send_template_message(wa_id, template_name="help_ru", code="ru")
         
         if payload == 'Не присылать рекламу':
-            database.set_notification_preference(preference=False, phone=wa_id)
+            survey_sessions.transition(wa_id, wants_notifications=False)
+            metrics.inc("wahr_opt_outs_total")
 
     elif message_type == 'interactive':
         interactive = message.get("interactive", {})
@@ -529,8 +517,7 @@ def process_whatsapp_message(body):
         elif interactive_type == 'button_reply':
             vacancy_id = int(interactive.get("button_reply", {}).get("id", ""))
             vacancy = database.get_vacancy_details(vacancy_id)
-            database.save_vacancy(wa_id, vacancy[0])
-            database.update_sent_status(False, wa_id)
+            survey_sessions.transition(wa_id, survey={"vacancy": vacancy[0], "sent": False})
             send_location_message(wa_id, 51.16603968026849, 71.50774278447689, 'Мы ждем Вас на собеседовании с понедельника по пятницу с 9:00 до 16:00 (обед 13:00-14:00). Ссылка в 2Гис: https://go.2gis.com/e7yls. Можете добраться автобусом 64 (остановка "Астана Ютария", пешком 16 минут).', 'Адрес: г. Астана, 92-ая улица, 2') # factory address
             # init_resume_flow_vac_filled(wa_id, interactive)
 
@@ -538,35 +525,16 @@ def process_whatsapp_message(body):
         # process the document only if survey mode is enabled.
         # send_template_message(wa_id, template_name="greeting", code="ru")
 
-        # remove this later
+        # downloaded in the background, see media_pipeline.py
         document_id = message['document']['id']
-        filename = message['document']['filename'].replace(' ', '_')
+        filename = message['document'].get('filename')
 
-        try:
-            document_data = fetch_media_data(document_id)
-            file_path = get_file(document_data['url'], filename)
-        except Exception as e:
-            error = f'Ошибка при обработке отправленного документа: {e}'
-            logging.error(error)
-            data = get_text_message_input(wa_id, error)
+        if not media_pipeline.submit(wa_id, document_id, filename):
+            logging.warning("Media queue is full, document %s from %s dropped", document_id, wa_id)
+            data = get_text_message_input(wa_id, 'Не удалось принять документ, пожалуйста, отправьте его ещё раз позже.')
             send_message(data)
-            return jsonify({"status": "error", "message": str(e)}), 500
-    
-
-
-            
-
+            return jsonify({"status": "error", "message": "Media queue is full"}), 503
 
-
-
-
-
-
-
-
-
-
-    
     # OpenAI Integration
     # response = generate_ai_response(message_body, wa_id, name)
     # response = process_text(response)
@@ -1,30 +1,28 @@
 import logging
 import json
+import csv
+import io
 
-from flask import Blueprint, request, jsonify, current_app, render_template, redirect, url_for
+from flask import Blueprint, request, jsonify, current_app, render_template, redirect, url_for, g, Response, stream_with_context
 
-from .decorators.security import signature_required
+from .decorators.security import signature_required, webhook_payload
 from .utils.whatsapp_utils import (
     process_whatsapp_message,
     is_valid_whatsapp_message,
-    send_template_message
+    database as database_wa,
 )
-from dotenv import load_dotenv
-import os
-from app.utils.db import WADatabase
+from app.services.message_queue import message_queue
+from app.services.broadcast import broadcasts
+from app.utils.dedup import deduplicator, get_message_id
+from app.services.status_ingest import status_ingest
+from app.services.media_pipeline import media_pipeline
+from app.services import openai_service
+from app.services.faq import faq_responder
+from app.services.survey_sessions import survey_sessions
+from app.utils.copy_stream import iter_copy
+from app.utils.metrics import metrics
 import time
 
-load_dotenv()
-
-db_config = {
-    'host': os.getenv("DBHOST"),
-    'database': os.getenv("DBNAME"),
-    'user': os.getenv("DBUSER"),
-    'password': os.getenv("DBPASSWORD"),
-    'port': os.getenv("DBPORT")
-}
-database_wa = WADatabase(db_config)
-
 webhook_blueprint = Blueprint("webhook", __name__)
 
 
@@ -42,22 +40,46 @@ def handle_message():
     Returns:
         response: A tuple containing a JSON response and an HTTP status code.
     """
-    body = request.get_json()
-    logging.info(f"request body: {body}")
+    # parsed once by the webhook_payload decorator
+    body = g.get("webhook_body")
+    if body is None:
+        body = request.get_json()
+    logging.info("request body: %s", body, extra={"category": "body"})
 
     # Check if it's a WhatsApp status update
-    if (
+    statuses = (
         body.get("entry", [{}])[0]
         .get("changes", [{}])[0]
         .get("value", {})
         .get("statuses")
-    ):
+    )
+    if statuses:
         logging.info("Received a WhatsApp status update.")
+        # buffered and written in batches, see status_ingest.py
+        status_ingest.add_statuses(statuses)
         return jsonify({"status": "ok"}), 200
 
     try:
         if is_valid_whatsapp_message(body):
-            process_whatsapp_message(body)
+            # Meta redelivers webhooks we were slow to answer, handle every message only once
+            message_id = get_message_id(body)
+            if deduplicator.is_duplicate(message_id):
+                logging.info("Duplicate message %s dropped", message_id)
+                return jsonify({"status": "ok"}), 200
+            if message_queue.enabled:
+                if not message_queue.submit(body):
+                    # Meta retries non-200 deliveries, so the event is not lost
+                    deduplicator.forget(message_id)
+                    logging.warning("Message queue is full, asking the sender to retry")
+                    return jsonify({"status": "error", "message": "Queue is full"}), 503
+                logging.info("Valid What's App message received. Queued for processing")
+                return jsonify({"status": "ok"}), 200
+            try:
+                process_whatsapp_message(body)
+            except Exception:
+                # let the redelivery of a failed message through
+                deduplicator.forget(message_id)
+                raise
             logging.info("Valid What's App message received. Processing started")
             return jsonify({"status": "ok"}), 200
         else:
@@ -95,27 +117,16 @@ def verify():
         return jsonify({"status": "error", "message": "Missing parameters"}), 400
 
 def send_messages_to_selected_users(body):
+    '''
+    Starts a background broadcast job and returns its id right away.
+    Progress is available at GET /send_messages/<job_id>.
+    '''
     try:
         contacts = body.get("contacts", [{}])
-        for contact in contacts:
-            number = contact.get("phone", "") # phone number
-            number = number.replace('+','').strip()
-            logging.info(f'number: {number}')
-            number_in_db = database_wa.get_user(number)
-            logging.info(f'exists?: {number_in_db}')
-            if number_in_db == False:
-                database_wa.create_user(number)
-                logging.info(f'created user: {number}')
-            name = contact.get("name", "") # name
-            wants_notif = database_wa.wants_notifications(phone=number)
-            logging.info(f'Wants notifs?: {wants_notif}')
-            if wants_notif != False:
-                try:
-                    send_template_message(number, template_name="rassylka_vacansii", code="ru") # TODO: this template doesn't exist yet.
-                except Exception as err3:
-                    logging.error(f'Error occurred: {err3}')
-            # send_template_message(number, template_name="greeting", code="ru")
-        return jsonify({"status": "ok"}), 200
+        template_name = body.get("template", "rassylka_vacansii") # TODO: this template doesn't exist yet.
+        code = body.get("language", "ru")
+        job = broadcasts.submit(contacts, template_name=template_name, code=code)
+        return jsonify({"status": "ok", "job_id": job.id, "total": job.total}), 202
     except Exception as e:
         return jsonify({"status": f"error: {e}"}), 400
 
@@ -124,6 +135,7 @@ def webhook_get():
     return verify()
 
 @webhook_blueprint.route("/webhook", methods=["POST"])
+@webhook_payload
 def webhook_post():
     return handle_message()
 
@@ -131,15 +143,69 @@ def webhook_post():
 def webhook_test():
     return jsonify({"status": "OK"}), 200
 
+@webhook_blueprint.route("/stats", methods = ["GET"])
+def stats():
+    verification = request.headers.get('token', '')
+    if verification == current_app.config['VERIFY_TOKEN']:
+        return jsonify({
+            "message_queue": message_queue.stats(),
+            "vacancy_catalog": database_wa.vacancies.stats(),
+            "db_statements": database_wa.statements.stats(),
+            "deduplication": deduplicator.stats(),
+            "status_ingest": status_ingest.stats(),
+            "media_pipeline": media_pipeline.stats(),
+            "assistant": openai_service.stats(),
+            "faq": faq_responder.stats(),
+            "survey_sessions": survey_sessions.stats(),
+        }), 200
+    else:
+        return jsonify({"status": "error", "message": "Verification failed"}), 400
+
+@webhook_blueprint.route("/metrics", methods = ["GET"])
+def metrics_endpoint():
+    '''
+    Prometheus metrics of all worker processes, see utils/metrics.py
+    '''
+    token = current_app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization", "") != f"Bearer {token}":
+        return jsonify({"status": "error", "message": "Verification failed"}), 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@webhook_blueprint.route("/statuses/summary", methods = ["GET"])
+def statuses_summary():
+    '''
+    Delivery funnel per template/broadcast, filtered by ?broadcast_id= and/or ?template=
+    '''
+    verification = request.headers.get('token', '')
+    if verification == current_app.config['VERIFY_TOKEN']:
+        summary = database_wa.get_status_summary(
+            broadcast_id=request.args.get("broadcast_id"),
+            template_name=request.args.get("template"),
+        )
+        return jsonify(summary), 200
+    else:
+        return jsonify({"status": "error", "message": "Verification failed"}), 400
+
 @webhook_blueprint.route("/send_messages", methods = ["POST"])
 def send_messages_list():
     verification = request.headers.get('token', '')
     if verification == current_app.config['VERIFY_TOKEN']:
         body = request.get_json()
-        logging.info(f'Logged a post request: Body is {body}')
+        logging.info('Logged a post request: Body is %s', body, extra={"category": "body"})
         return send_messages_to_selected_users(body)
     else:
         return jsonify({"status": "error", "message": "Verification failed"}), 400
+
+@webhook_blueprint.route("/send_messages/<job_id>", methods = ["GET"])
+def send_messages_status(job_id):
+    verification = request.headers.get('token', '')
+    if verification == current_app.config['VERIFY_TOKEN']:
+        job = broadcasts.get(job_id)
+        if job is None:
+            return jsonify({"status": "error", "message": "Unknown job"}), 404
+        return jsonify(job.to_dict()), 200
+    else:
+        return jsonify({"status": "error", "message": "Verification failed"}), 400
     
 # @webhook_blueprint.route('/')
 # def index():
@@ -147,35 +213,71 @@ def send_messages_list():
 
 @webhook_blueprint.route("/vacancies", methods = ["GET"])
 def vacancies_list():
+    '''
+    All vacancies as compact JSON. The body is built and compressed once per catalog version,
+    a matching If-None-Match (the ETag of the same encoding) gets 304 Not Modified.
+    '''
     verification = request.headers.get('token', '')
     if verification == current_app.config['VERIFY_TOKEN']:
-        data = database_wa.get_vacancies_full()
-        vacancies = []
-        for idx, title, details, requirements, tasks, salary in data:
-            el = {
-                "id": idx,
-                "title": title,
-                "details": details,
-                "requirements": requirements,
-                "tasks": tasks,
-                "salary": salary
-            }
-            vacancies.append(el)
-        json_object = vacancies
-        json_object = json.dumps(json_object, indent=4)
-
-        return json_object # return a JSON of all vacancies
+        export = database_wa.vacancies.snapshot().export
+        encoding, body, etag = export.select(request.accept_encodings)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype="application/json")
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        response.vary.add("Accept-Encoding")
+        return response # return a JSON of all vacancies
     else:
         return jsonify({"status": "error", "message": "Failed verification"}), 400
 
+def _stream_users(export_format):
+    '''
+    Streams the whole users table as NDJSON or CSV, a chunk of rows at a time
+    '''
+    chunk_rows = 500
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == "csv" else None
+    if writer is not None:
+        writer.writerow(["id", "phone", "want_notifications"])
+    rows = 0
+    for idx, phone, wantsNotifications in database_wa.iter_users():
+        if writer is not None:
+            writer.writerow([idx, phone, wantsNotifications])
+        else:
+            buffer.write(json.dumps({"id": idx, "phone": phone, "want_notifications": wantsNotifications}))
+            buffer.write("\n")
+        rows += 1
+        if rows % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
 @webhook_blueprint.route("/users", methods = ["GET"])
 def users_list():
+    '''
+    ?after_id=&limit= returns one page of users; ?format=ndjson or ?format=csv streams all of them
+    '''
     verification = request.headers.get('token', '')
     if verification == current_app.config['VERIFY_TOKEN']:
-        data = database_wa.get_users_full()
-        
+        export_format = request.args.get("format", "json")
+        if export_format in ("ndjson", "csv"):
+            mimetype = "text/csv" if export_format == "csv" else "application/x-ndjson"
+            return Response(stream_with_context(_stream_users(export_format)), mimetype=mimetype)
+
+        try:
+            after_id = int(request.args.get("after_id", 0))
+            limit = max(1, min(int(request.args.get("limit", 100)), 1000))
+        except ValueError:
+            return jsonify({"status": "error", "message": "after_id and limit must be integers"}), 400
+        data = database_wa.get_users_page(after_id=after_id, limit=limit)
+
         users = []
-        for idx, phone, hasCompletedSurvey, current_step, wantsNotifications in data:
+        for idx, phone, wantsNotifications in data:
             el = {
                 "id": idx,
                 "phone": phone,
@@ -183,7 +285,61 @@ def users_list():
             }
             users.append(el)
 
-        return jsonify(users) # return a JSON of all vacancies
+        # there is a next page only if this one is full
+        next_after_id = users[-1]["id"] if len(users) == limit else None
+        return jsonify({"users": users, "next_after_id": next_after_id})
+    else:
+        return jsonify({"status": "error", "message": "Failed verification"}), 400
+
+
+@webhook_blueprint.route("/surveys/export", methods = ["GET"])
+def surveys_export():
+    '''
+    Streams unsent surveys as ?format=csv (default) or ?format=ndjson.
+    With ?claim=1 the exported surveys are marked as sent in the same statement, committed only
+    once the whole body was sent; if the client goes away before, nothing is marked.
+    '''
+    verification = request.headers.get('token', '')
+    if verification == current_app.config['VERIFY_TOKEN']:
+        export_format = request.args.get("format", "csv")
+        if export_format not in ("csv", "ndjson"):
+            return jsonify({"status": "error", "message": "format must be csv or ndjson"}), 400
+        claim = request.args.get("claim", "0").lower() in ("1", "true", "yes")
+        mimetype = "text/csv" if export_format == "csv" else "application/x-ndjson"
+        copy = database_wa.copy_unsent_surveys  # resolved here, the copy runs in its own thread
+        chunks = iter_copy(lambda out: copy(out, export_format=export_format, claim=claim, before_commit=out.wait_consumed))
+        return Response(chunks, mimetype=mimetype)
+    else:
+        return jsonify({"status": "error", "message": "Failed verification"}), 400
+
+@webhook_blueprint.route("/surveys/claim", methods = ["POST"])
+def surveys_claim():
+    '''
+    Marks up to ?limit= unsent surveys as sent and returns them
+    '''
+    verification = request.headers.get('token', '')
+    if verification == current_app.config['VERIFY_TOKEN']:
+        try:
+            limit = max(1, min(int(request.args.get("limit", 100)), 1000))
+        except ValueError:
+            return jsonify({"status": "error", "message": "limit must be an integer"}), 400
+        return jsonify({"surveys": database_wa.claim_unsent_surveys(limit=limit)}), 200
+    else:
+        return jsonify({"status": "error", "message": "Failed verification"}), 400
+
+@webhook_blueprint.route("/surveys/sent", methods = ["POST"])
+def surveys_sent():
+    '''
+    Sets the sent flag for a list of phones: {"phones": [...], "sent": true}
+    '''
+    verification = request.headers.get('token', '')
+    if verification == current_app.config['VERIFY_TOKEN']:
+        body = request.get_json(silent=True) or {}
+        phones = body.get("phones")
+        if not isinstance(phones, list):
+            return jsonify({"status": "error", "message": "phones must be a list"}), 400
+        updated = database_wa.update_sent_statuses(bool(body.get("sent", True)), phones)
+        return jsonify({"status": "ok", "updated": updated}), 200
     else:
         return jsonify({"status": "error", "message": "Failed verification"}), 400
 
@@ -0,0 +1,146 @@
+"""
+Local stand-in for graph.facebook.com, for load tests. Point the bot at it with GRAPH_API_URL.
+
+    POST /<version>/<phone number id>/messages   -> {"messages": [{"id": "wamid.fake.<n>"}]}
+    GET  /<version>/<media id>/                  -> media metadata with a download url on this server
+    GET  /media/<media id>                       -> the file (deterministic bytes per media id)
+
+Every answer waits --latency-ms (+- --jitter-ms). A share of the requests fails: --error-rate with
+429 / code 130429 (throttled), --server-error-rate with 500.
+
+    python benchmarks/fake_graph.py --port 8765 --latency-ms 80 --error-rate 0.02
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class FakeGraph:
+    def __init__(self, host="127.0.0.1", port=8765, latency_ms=50, jitter_ms=20, error_rate=0.0,
+                 server_error_rate=0.0, media_size=200 * 1024):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.media_size = media_size
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-graph", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def _media(self, media_id):
+        seed = hashlib.sha256(media_id.encode("utf-8")).digest()
+        return b"%PDF-1.4\n" + (seed * (self.media_size // len(seed) + 1))[:self.media_size]
+
+    def _failure(self):
+        '''
+        (status, body) of an injected error, or None
+        '''
+        roll = random.random()
+        if roll < self.error_rate:
+            return 429, {"error": {"code": 130429, "message": "Rate limit hit", "type": "OAuthException"}}
+        if roll < self.error_rate + self.server_error_rate:
+            return 500, {"error": {"code": 1, "message": "An unknown error occurred"}}
+        return None
+
+    def _handler(self):
+        graph = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _wait(self):
+                delay = graph.latency_ms + random.uniform(-graph.jitter_ms, graph.jitter_ms)
+                if delay > 0:
+                    time.sleep(delay / 1000)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                self._wait()
+                failure = graph._failure()
+                if failure is not None:
+                    graph._count(f"messages_{failure[0]}")
+                    return self._reply(*failure)
+                graph._count("messages")
+                with graph._lock:
+                    graph._message_ids += 1
+                    message_id = graph._message_ids
+                self._reply(200, {"messaging_product": "whatsapp", "messages": [{"id": f"wamid.fake.{message_id}"}]})
+
+            def do_GET(self):
+                path = urlsplit(self.path).path.strip("/").split("/")
+                self._wait()
+                if len(path) == 2 and path[0] == "media":
+                    graph._count("media_downloads")
+                    return self._reply(200, graph._media(path[1]), content_type="application/pdf")
+                if len(path) == 2:
+                    graph._count("media_info")
+                    data = graph._media(path[1])
+                    return self._reply(200, {
+                        "url": f"{graph.url}/media/{path[1]}?ext={int(time.time()) + 300}",
+                        "mime_type": "application/pdf",
+                        "sha256": hashlib.sha256(data).hexdigest(),
+                        "file_size": len(data),
+                        "id": path[1],
+                        "messaging_product": "whatsapp",
+                    })
+                self._reply(404, {"error": {"code": 100, "message": "Unknown path"}})
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 429 answers")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="share of 500 answers")
+    args = parser.parse_args()
+
+    graph = FakeGraph(args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate,
+                      args.server_error_rate).start()
+    print(f"fake Graph API on {graph.url}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(10)
+            print(dict(graph.counts))
+    except KeyboardInterrupt:
+        graph.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Query plans and timings of the hot queries before and after the index migrations.
+
+Seeds a scratch schema (dropped afterwards unless --keep) with the baseline tables only, runs
+EXPLAIN ANALYZE on every query, applies the remaining migrations and runs them again. Uses the
+DB* settings from .env; nothing outside the scratch schema is touched.
+
+    python benchmarks/schema.py --users 1000000
+    python benchmarks/schema.py --users 100000 --repeat 3 --plans
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+
+from app.config import load_configurations  # noqa: E402
+from app.utils.db import SURVEY_COLUMNS, WADatabase  # noqa: E402
+from app.utils.migrations import migrate  # noqa: E402
+
+# (name, query); every run is rolled back, so the queries that change data see the same rows each time
+QUERIES = [
+    ("unsent surveys (export)", f"SELECT {', '.join(SURVEY_COLUMNS)} FROM surveys WHERE sent = FALSE ORDER BY id"),
+    ("claim 100 unsent surveys", f"""
+        UPDATE surveys SET sent = TRUE
+        WHERE id IN (SELECT id FROM surveys WHERE sent = FALSE ORDER BY id LIMIT 100 FOR UPDATE SKIP LOCKED)
+        RETURNING {', '.join(SURVEY_COLUMNS)}"""),
+    ("users page (broadcast)", "SELECT id, phone, wants_notifications FROM users WHERE id > %(middle)s ORDER BY id LIMIT 1000"),
+    ("status summary of a template", """
+        SELECT o.template_name, o.broadcast_id, count(*),
+               count(*) FILTER (WHERE 'delivered' = ANY(s.statuses)),
+               count(*) FILTER (WHERE 'read' = ANY(s.statuses))
+        FROM outbound_messages o
+        LEFT JOIN LATERAL (
+            SELECT array_agg(DISTINCT status) AS statuses FROM message_statuses WHERE message_id = o.message_id
+        ) s ON TRUE
+        WHERE o.template_name = 'template_3'
+        GROUP BY o.template_name, o.broadcast_id"""),
+    ("purge processed messages", "DELETE FROM processed_messages WHERE received_at < now() - make_interval(secs => 86400)"),
+]
+
+
+def seed(conn, users):
+    messages = max(users // 5, 1)
+    started = time.perf_counter()
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO users (phone, wants_notifications) "
+            "SELECT '77' || lpad(i::text, 9, '0'), i %% 20 <> 0 FROM generate_series(1, %s) i", (users,)
+        )
+        # 1% of the surveys are not sent yet, like a bot that exports them every few minutes
+        cur.execute(
+            "INSERT INTO surveys (phone, name, age, vacancy, sent, completed_survey) "
+            "SELECT '77' || lpad(i::text, 9, '0'), 'Имя ' || i, (18 + i %% 40)::text, 'Оператор', i %% 100 <> 0, TRUE "
+            "FROM generate_series(1, %s) i", (users,)
+        )
+        cur.execute(
+            "INSERT INTO outbound_messages (message_id, recipient_id, template_name, broadcast_id) "
+            "SELECT 'wamid.' || i, '77' || lpad(i::text, 9, '0'), 'template_' || i %% 20, 'b' || i %% 50 "
+            "FROM generate_series(1, %s) i", (messages,)
+        )
+        cur.execute(
+            "INSERT INTO message_statuses (message_id, recipient_id, status) "
+            "SELECT 'wamid.' || i, '77' || lpad(i::text, 9, '0'), status "
+            "FROM generate_series(1, %s) i, unnest(ARRAY['sent', 'delivered', 'read']) status", (messages,)
+        )
+        # 25 hours of webhook ids: the periodic purge finds the last hour older than the dedup ttl
+        cur.execute(
+            "INSERT INTO processed_messages (message_id, received_at) "
+            "SELECT 'wamid.in.' || i, now() - make_interval(secs => i * 90000.0 / %s) FROM generate_series(1, %s) i",
+            (messages, messages)
+        )
+    conn.commit()
+    return time.perf_counter() - started
+
+
+def vacuum_analyze(conn):
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("VACUUM ANALYZE")
+    conn.autocommit = False
+
+
+def explain(conn, query, params, repeat):
+    timings = []
+    with conn.cursor() as cur:
+        for _ in range(repeat):
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+            result = cur.fetchone()[0]
+            result = json.loads(result) if isinstance(result, str) else result
+            timings.append(result[0]["Execution Time"])
+            conn.rollback()
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+        plan = "\n".join(row[0] for row in cur.fetchall())
+        conn.rollback()
+    return statistics.median(timings), plan
+
+
+def measure(conn, users, repeat):
+    params = {"middle": users // 2}
+    return {name: explain(conn, query, params, repeat) for name, query in QUERIES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--schema", default="bench_migrations")
+    parser.add_argument("--plans", action="store_true", help="print the full plans, not only the timings")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch schema")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    load_configurations(app)
+    db_config = {key: value for key, value in app.config["DB_CONFIG"].items() if value}
+    db_config["options"] = f"-c search_path={args.schema}"
+
+    conn = psycopg2.connect(**db_config)
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE")
+        cur.execute(f"CREATE SCHEMA {args.schema}")
+    conn.commit()
+    database = WADatabase(db_config, listen_for_changes=False, prepare=False)
+    try:
+        migrate(database, target=1)
+        print(f"seeded {args.users} users in {seed(conn, args.users):.1f}s")
+        vacuum_analyze(conn)
+        before = measure(conn, args.users, args.repeat)
+
+        started = time.perf_counter()
+        applied = migrate(database)
+        print(f"applied migrations {[m.version for m in applied]} in {time.perf_counter() - started:.2f}s")
+        vacuum_analyze(conn)
+        after = measure(conn, args.users, args.repeat)
+
+        print(f"\n{'query':32} {'before ms':>10} {'after ms':>10}")
+        for name, _ in QUERIES:
+            print(f"{name:32} {before[name][0]:10.2f} {after[name][0]:10.2f}")
+        if args.plans:
+            for name, _ in QUERIES:
+                print(f"\n=== {name}\n--- before\n{before[name][1]}\n--- after\n{after[name][1]}")
+    finally:
+        database.close()
+        if not args.keep:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE")
+            conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Cold start of a worker: time to import the app, to run create_app() and to answer the first requests.
+
+Every run is a fresh interpreter, like a newly forked gunicorn worker. No database is needed for
+the import and /test numbers; --db-route also times the first request that opens the pool.
+
+    python benchmarks/startup.py --runs 10
+    python benchmarks/startup.py --runs 10 --db-route /vacancies
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+client = application.test_client()
+client.get("/test")
+first = time.perf_counter()
+result = {
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_request_ms": (first - created) * 1000,
+    "heavy_modules": sorted(m for m in ("pandas", "openai", "numpy") if m in sys.modules),
+}
+db_route = sys.argv[1]
+if db_route:
+    started = time.perf_counter()
+    response = client.get(db_route, headers={"token": application.config["VERIFY_TOKEN"] or ""})
+    result["first_db_request_ms"] = (time.perf_counter() - started) * 1000
+    result["first_db_request_status"] = response.status_code
+print(json.dumps(result))
+"""
+
+
+def run_once(db_route):
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, db_route or ""], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--db-route", default="", help="e.g. /vacancies, needs a reachable database")
+    args = parser.parse_args()
+
+    results = [run_once(args.db_route) for _ in range(args.runs)]
+    for key in ("import_ms", "create_app_ms", "first_request_ms", "first_db_request_ms"):
+        values = [result[key] for result in results if key in result]
+        if values:
+            print(f"{key:22} median {statistics.median(values):8.1f}  min {min(values):8.1f}  max {max(values):8.1f}")
+    print("heavy modules imported:", ", ".join(results[-1]["heavy_modules"]) or "none")
+    if args.db_route:
+        print("first db request status:", results[-1]["first_db_request_status"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""
+Load test of POST /webhook with signed WhatsApp payloads: text, button, list_reply, button_reply,
+document and statuses, in the shapes process_whatsapp_message reads.
+
+Requests are sent at --rate per second (0 = as fast as --concurrency allows) for --duration
+seconds. With a rate, latency is measured from the moment a request was due, so a server that
+falls behind shows up in the percentiles instead of silently lowering the rate.
+
+With --spawn the bot itself is started (gunicorn if installed, the Flask server otherwise)
+against a fake Graph API (fake_graph.py) and the Postgres from .env, after `flask init-db`:
+
+    python benchmarks/webhook_load.py --spawn --rate 200 --duration 30 --graph-latency-ms 80
+    python benchmarks/webhook_load.py --url http://127.0.0.1:5000 --rate 100 --mix text=8,statuses=2
+
+The vacancy ids for list_reply/button_reply are read from GET /vacancies (needs VERIFY_TOKEN);
+without vacancies these two types are left out.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import queue
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_graph import FakeGraph  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+KINDS = ("text", "button", "list_reply", "button_reply", "document", "statuses")
+DEFAULT_MIX = "text=40,button=10,list_reply=8,button_reply=4,document=3,statuses=35"
+
+TEXTS = [
+    "Здравствуйте", "Добрый день! Какие есть вакансии?", "Хочу работать у вас", "Сколько платят?",
+    "Где находится завод?", "Какой график работы?", "Есть ли доставка до работы?", "привет",
+]
+BUTTON_PAYLOADS = ["О нас", "Вакансии", "Помощь", "Процесс найма", "Связаться с HR", "Отправить резюме"]
+STATUSES = ["sent", "delivered", "read"]
+
+
+class Payloads:
+    '''
+    Webhook bodies for random users out of a fixed pool, every message with a new id
+    '''
+
+    def __init__(self, users, vacancy_ids, phone_number_id="123456789"):
+        self.phones = [f"7700{i:07d}" for i in range(users)]
+        self.vacancy_ids = vacancy_ids
+        self.phone_number_id = phone_number_id
+        self.run_id = uuid.uuid4().hex[:8]
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next_id(self):
+        with self._lock:
+            self._counter += 1
+            return f"wamid.load.{self.run_id}.{self._counter}"
+
+    def _envelope(self, value):
+        return {
+            "object": "whatsapp_business_account",
+            "entry": [{"id": "0", "changes": [{"field": "messages", "value": {
+                "messaging_product": "whatsapp",
+                "metadata": {"display_phone_number": "77000000000", "phone_number_id": self.phone_number_id},
+                **value,
+            }}]}],
+        }
+
+    def _message(self, wa_id, message_type, content):
+        return self._envelope({
+            "contacts": [{"profile": {"name": "Load Test"}, "wa_id": wa_id}],
+            "messages": [{
+                "from": wa_id, "id": self._next_id(), "timestamp": str(int(time.time())),
+                "type": message_type, **content,
+            }],
+        })
+
+    def make(self, kind):
+        wa_id = random.choice(self.phones)
+        if kind == "text":
+            return self._message(wa_id, "text", {"text": {"body": random.choice(TEXTS)}})
+        if kind == "button":
+            payload = random.choice(BUTTON_PAYLOADS)
+            return self._message(wa_id, "button", {"button": {"payload": payload, "text": payload}})
+        if kind in ("list_reply", "button_reply"):
+            vacancy_id = str(random.choice(self.vacancy_ids))
+            return self._message(wa_id, "interactive", {"interactive": {
+                "type": kind, kind: {"id": vacancy_id, "title": "Вакансия"},
+            }})
+        if kind == "document":
+            media_id = str(random.randrange(10 ** 15, 10 ** 16))
+            return self._message(wa_id, "document", {"document": {
+                "id": media_id, "filename": "resume.pdf", "mime_type": "application/pdf",
+            }})
+        if kind == "statuses":
+            return self._envelope({"statuses": [{
+                "id": f"wamid.fake.{random.randrange(1, 10 ** 6)}", "status": random.choice(STATUSES),
+                "timestamp": str(int(time.time())), "recipient_id": wa_id,
+            }]})
+        raise ValueError(f"unknown message type {kind}")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise SystemExit(f"unknown message type {kind!r}, use {', '.join(KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds, error=None):
+        with self._lock:
+            self.latencies[kind].append(seconds)
+            if error is not None:
+                self.errors[kind][error] += 1
+
+    def summary(self, elapsed):
+        rows = {}
+        for kind in list(KINDS) + ["all"]:
+            if kind == "all":
+                values = sorted(v for kind_values in self.latencies.values() for v in kind_values)
+                errors = sum((counter for counter in self.errors.values()), Counter())
+            else:
+                values = sorted(self.latencies.get(kind, []))
+                errors = self.errors.get(kind, Counter())
+            if not values:
+                continue
+            rows[kind] = {
+                "requests": len(values),
+                "errors": sum(errors.values()),
+                "error_kinds": dict(errors),
+                "rps": round(len(values) / elapsed, 1),
+                "p50_ms": round(1000 * percentile(values, 0.50), 2),
+                "p95_ms": round(1000 * percentile(values, 0.95), 2),
+                "p99_ms": round(1000 * percentile(values, 0.99), 2),
+                "max_ms": round(1000 * values[-1], 2),
+            }
+        return rows
+
+
+def worker(url, secret, payloads, tasks, results):
+    session = requests.Session()
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        due, kind = task
+        body = json.dumps(payloads.make(kind), ensure_ascii=False).encode("utf-8")
+        signature = hmac.new(secret.encode("latin-1"), body, hashlib.sha256).hexdigest()
+        started = due or time.perf_counter()
+        error = None
+        try:
+            response = session.post(
+                f"{url}/webhook", data=body, timeout=30,
+                headers={"Content-Type": "application/json", "X-Hub-Signature-256": f"sha256={signature}"},
+            )
+            if response.status_code >= 400:
+                error = f"HTTP {response.status_code}"
+        except requests.RequestException as e:
+            error = type(e).__name__
+        results.add(kind, time.perf_counter() - started, error)
+
+
+def run_load(url, secret, payloads, mix, rate, duration, concurrency):
+    kinds, weights = zip(*mix.items())
+    tasks = queue.Queue()
+    results = Results()
+    threads = [
+        threading.Thread(target=worker, args=(url, secret, payloads, tasks, results), daemon=True)
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+
+    started = time.perf_counter()
+    end = started + duration
+    sent = 0
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if rate > 0:
+            due = started + sent / rate
+            if due > now:
+                time.sleep(due - now)
+            tasks.put((due, random.choices(kinds, weights)[0]))
+        else:
+            # closed loop: keep every worker busy, without building up a backlog
+            if tasks.qsize() >= concurrency:
+                time.sleep(0.0005)
+                continue
+            tasks.put((None, random.choices(kinds, weights)[0]))
+        sent += 1
+    for _ in threads:
+        tasks.put(None)
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def fetch_vacancy_ids(url, token):
+    try:
+        response = requests.get(f"{url}/vacancies", headers={"token": token or ""}, timeout=10)
+        response.raise_for_status()
+        return [vacancy["id"] for vacancy in response.json()]
+    except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+        print(f"could not read the vacancies: {e}")
+        return []
+
+
+def fetch_stats(url, token):
+    try:
+        response = requests.get(f"{url}/stats", headers={"token": token or ""}, timeout=10)
+        return response.json() if response.ok else None
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def spawn_app(port, graph_url, secret, workers, threads, log_path):
+    env = dict(os.environ)
+    env.update({
+        "GRAPH_API_URL": graph_url,
+        "APP_SECRET": secret,
+        "VERIFY_WEBHOOK_SIGNATURE": "true",
+        "ACCESS_TOKEN": env.get("ACCESS_TOKEN") or "load-test",
+        "VERSION": env.get("VERSION") or "v20.0",
+        "PHONE_NUMBER_ID": env.get("PHONE_NUMBER_ID") or "123456789",
+    })
+    subprocess.run([sys.executable, "-m", "flask", "--app", "run", "init-db"], cwd=ROOT, env=env, check=True,
+                   capture_output=True)
+    try:
+        import gunicorn  # noqa: F401
+        command = [sys.executable, "-m", "gunicorn", "-w", str(workers), "--threads", str(threads),
+                   "-b", f"127.0.0.1:{port}", "run:app"]
+    except ImportError:
+        command = [sys.executable, "-c",
+                   f"from run import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log = open(log_path, "ab")
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"the app exited with {process.returncode}, see {log_path}")
+        try:
+            requests.get(f"{url}/test", timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"the app did not start in 30s, see {log_path}")
+
+
+def print_report(summary, elapsed):
+    print(f"\n{elapsed:.1f}s")
+    print(f"{'type':14} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind, row in summary.items():
+        print(f"{kind:14} {row['requests']:9} {row['errors']:7} {row['rps']:8} {row['p50_ms']:8} "
+              f"{row['p95_ms']:8} {row['p99_ms']:8} {row['max_ms']:8}")
+    for kind, row in summary.items():
+        if row["error_kinds"] and kind != "all":
+            print(f"  {kind} errors: {row['error_kinds']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="the running bot, unless --spawn")
+    parser.add_argument("--rate", type=float, default=50, help="requests per second, 0 = as fast as possible")
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at most")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"weights per message type, default {DEFAULT_MIX}")
+    parser.add_argument("--users", type=int, default=1000, help="distinct senders")
+    parser.add_argument("--app-secret", default=os.getenv("APP_SECRET") or "load-test-secret")
+    parser.add_argument("--token", default=os.getenv("VERIFY_TOKEN"), help="VERIFY_TOKEN for /vacancies and /stats")
+    parser.add_argument("--json", help="also write the results to this file")
+    spawn = parser.add_argument_group("--spawn: start the bot and a fake Graph API locally")
+    spawn.add_argument("--spawn", action="store_true")
+    spawn.add_argument("--port", type=int, default=5055)
+    spawn.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    spawn.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    spawn.add_argument("--graph-port", type=int, default=8765)
+    spawn.add_argument("--graph-latency-ms", type=float, default=50)
+    spawn.add_argument("--graph-jitter-ms", type=float, default=20)
+    spawn.add_argument("--graph-error-rate", type=float, default=0.0, help="share of 429 answers")
+    spawn.add_argument("--graph-server-error-rate", type=float, default=0.0, help="share of 500 answers")
+    spawn.add_argument("--app-log", default="loadtest-app.log")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    graph = process = None
+    url = args.url.rstrip("/")
+    if args.spawn:
+        graph = FakeGraph(port=args.graph_port, latency_ms=args.graph_latency_ms, jitter_ms=args.graph_jitter_ms,
+                          error_rate=args.graph_error_rate, server_error_rate=args.graph_server_error_rate).start()
+        process, url = spawn_app(args.port, graph.url, args.app_secret, args.workers, args.threads, args.app_log)
+    try:
+        vacancy_ids = fetch_vacancy_ids(url, args.token) if {"list_reply", "button_reply"} & set(mix) else []
+        if not vacancy_ids:
+            for kind in ("list_reply", "button_reply"):
+                if mix.pop(kind, None):
+                    print(f"no vacancies, {kind} left out")
+        payloads = Payloads(args.users, vacancy_ids, os.getenv("PHONE_NUMBER_ID") or "123456789")
+        print(f"{url}/webhook: rate {args.rate or 'max'}/s, {args.concurrency} in flight, {args.duration}s, mix {mix}")
+
+        results, elapsed = run_load(url, args.app_secret, payloads, mix, args.rate, args.duration, args.concurrency)
+        summary = results.summary(elapsed)
+        print_report(summary, elapsed)
+
+        report = {"elapsed_s": round(elapsed, 2), "types": summary, "app_stats": fetch_stats(url, args.token)}
+        if graph is not None:
+            report["graph_requests"] = dict(graph.counts)
+            print(f"\nfake Graph API requests: {dict(graph.counts)}")
+        if report["app_stats"]:
+            print(f"message queue: {report['app_stats'].get('message_queue')}")
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump(report, file, ensure_ascii=False, indent=2)
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=30)
+        if graph is not None:
+            graph.stop()
+
+
+if __name__ == "__main__":
+    main()
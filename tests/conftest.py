@@ -0,0 +1,34 @@
+import os
+import uuid
+
+import psycopg2
+import pytest
+
+from app.utils.db import WADatabase
+
+
+@pytest.fixture
+def postgres():
+    '''
+    A WADatabase on a fresh schema of the database in TEST_DATABASE_URL, dropped afterwards.
+    Tests using it are skipped when TEST_DATABASE_URL is not set.
+    '''
+    dsn = os.getenv("TEST_DATABASE_URL")
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    schema = f"wahr_test_{uuid.uuid4().hex[:8]}"
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+    database = WADatabase(
+        {"dsn": dsn, "options": f"-c search_path={schema}"}, maxconn=4, listen_for_changes=False
+    )
+    try:
+        database.create_tables()
+        yield database
+    finally:
+        database.close()
+        with admin.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
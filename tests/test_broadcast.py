@@ -0,0 +1,107 @@
+import threading
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.broadcast import BroadcastJob, BroadcastManager, normalize_phone
+
+
+class FakeDatabase:
+    def __init__(self, opted_out=(), fail=False):
+        self.users = set()
+        self.opted_out = set(opted_out)
+        self.fail = fail
+        self.saved = {}
+
+    def create_users(self, phones):
+        if self.fail:
+            raise RuntimeError("database down")
+        self.users.update(phones)
+
+    def filter_notifiable(self, phones):
+        return {phone for phone in phones if phone not in self.opted_out}
+
+    def save_broadcast_job(self, job):
+        self.saved[job.id] = job.progress()
+
+    def get_broadcast_job(self, job_id):
+        saved = self.saved.get(job_id)
+        return dict(saved, seconds_since_update=0) if saved else None
+
+
+def make(database, send):
+    manager = BroadcastManager()
+    app = SimpleNamespace(config={"BROADCAST_CONCURRENCY": 2}, app_context=nullcontext)
+    manager.init_app(app, database, send)
+    return manager
+
+
+def wait(job):
+    for _ in range(200):
+        if job.finished_at is not None:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError("the broadcast did not finish")
+
+
+def test_normalize_phone():
+    assert normalize_phone("+7 (701) 234-56-78") == "77012345678"
+    assert normalize_phone(77012345678) == "77012345678"
+    for value in ("", "abc", "0701234", "1" * 16, None, True, ["77012345678"]):
+        assert normalize_phone(value) is None
+
+
+def test_progress_counts_every_contact():
+    sent = []
+
+    def send(phone, template_name, code, lane=None, broadcast_id=None):
+        sent.append(phone)
+        return SimpleNamespace(ok=phone != "77010000003")
+
+    database = FakeDatabase(opted_out={"77010000002"})
+    manager = make(database, send)
+    contacts = [
+        {"phone": "+77010000001"}, {"phone": "77010000001"}, {"phone": "77010000002"},
+        {"phone": "77010000003"}, {"phone": "7701000000312345678"}, {"phone": "not a number"}, "77010000004",
+    ]
+    job = wait(manager.submit(contacts, "template", "ru"))
+
+    # the duplicate is dropped, three malformed contacts are skipped without failing create_users
+    assert database.users == {"77010000001", "77010000002", "77010000003"}
+    assert sorted(sent) == ["77010000001", "77010000003"]
+    progress = job.to_dict()
+    assert progress["status"] == "done"
+    assert (progress["total"], progress["sent"], progress["failed"], progress["skipped"]) == (6, 1, 1, 4)
+    assert progress["pending"] == 0
+    # the final progress is saved for the other workers
+    assert database.saved[job.id]["status"] == "done"
+    assert database.saved[job.id]["sent"] == 1
+
+
+def test_failed_broadcast_records_the_error():
+    database = FakeDatabase(fail=True)
+    job = wait(make(database, lambda *args, **kwargs: None).submit([{"phone": "77010000001"}], "template", "ru"))
+    assert job.status == "failed"
+    assert database.saved[job.id]["error"] == "database down"
+
+
+def test_job_of_another_worker_is_read_from_the_database():
+    database = FakeDatabase()
+    job = BroadcastJob(["77010000001"], "template", "ru")
+    job.status = "running"
+    database.save_broadcast_job(job)
+    found = make(database, None).get(job.id)
+    assert found is not job
+    assert found.status == "running" and found.total == 1
+    assert make(database, None).get("unknown") is None
+
+
+@pytest.mark.parametrize("status, expected", [("running", "interrupted"), ("queued", "interrupted"), ("done", "done")])
+def test_stale_jobs_are_interrupted(status, expected):
+    job = BroadcastJob(["77010000001"], "template", "ru")
+    job.status = status
+    saved = dict(job.progress(), seconds_since_update=BroadcastJob.STALE_AFTER + 1)
+    restored = BroadcastJob.from_saved(saved)
+    assert restored.status == expected
+    assert (restored.error is not None) == (expected == "interrupted")
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+from app.utils.copy_stream import iter_copy
+
+
+def write_rows(out, rows, committed=None):
+    for i in range(rows):
+        out.write(b"row %d\n" % i)
+    if committed is not None:
+        out.wait_consumed()
+        committed.set()
+
+
+def test_yields_everything_in_chunks():
+    chunks = list(iter_copy(write_rows, 1000, chunk_size=1024))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == b"".join(b"row %d\n" % i for i in range(1000))
+
+
+def test_error_is_raised_in_the_consumer():
+    def fail(out):
+        out.write(b"partial")
+        raise ValueError("copy failed")
+
+    with pytest.raises(ValueError, match="copy failed"):
+        list(iter_copy(fail))
+
+
+def test_commits_only_after_the_body_was_consumed():
+    committed = threading.Event()
+    chunks = iter_copy(write_rows, 1000, committed, chunk_size=1024)
+    body = b""
+    for chunk in chunks:
+        # the copy waits until the consumer asks for more after the last chunk
+        assert not committed.is_set()
+        body += chunk
+    assert committed.wait(timeout=5)
+    assert body.endswith(b"row 999\n")
+
+
+def test_closing_early_aborts_before_the_commit():
+    committed = threading.Event()
+    aborted = threading.Event()
+
+    def copy(out):
+        try:
+            write_rows(out, 100000, committed)
+        except BaseException:
+            aborted.set()
+            raise
+
+    chunks = iter_copy(copy, chunk_size=1024, max_chunks=2)
+    next(chunks)
+    chunks.close()
+    assert aborted.wait(timeout=5)
+    assert not committed.is_set()
+
+
+def test_closing_after_the_last_chunk_does_not_commit():
+    committed = threading.Event()
+    aborted = threading.Event()
+
+    def copy(out):
+        try:
+            write_rows(out, 10, committed)
+        except BaseException:
+            aborted.set()
+            raise
+
+    chunks = iter_copy(copy)
+    next(chunks)  # the whole (small) body, the client goes away before asking for more
+    chunks.close()
+    assert aborted.wait(timeout=5)
+    assert not committed.is_set()
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from app.utils.db import ConnectionDropped, WADatabase
+
+
+class FakeConnection:
+    def __init__(self, name):
+        self.name = name
+        self.closed = 0
+        self.commits = 0
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakePool:
+    def __init__(self):
+        self.created = 0
+        self.idle = []
+        self.closed = []
+
+    def getconn(self):
+        if self.idle:
+            return self.idle.pop()
+        self.created += 1
+        return FakeConnection(self.created)
+
+    def putconn(self, conn, close=False):
+        if close:
+            self.closed.append(conn)
+        else:
+            self.idle.append(conn)
+
+
+def make(maxconn=4):
+    database = WADatabase({}, maxconn=maxconn, listen_for_changes=False)
+    database.pool = FakePool()
+    return database
+
+
+def commit(conn):
+    conn.commits += 1
+
+
+def test_commits_and_returns_the_connection(monkeypatch):
+    database = make()
+    monkeypatch.setattr(FakeConnection, "commit", commit, raising=False)
+    with database.connection() as conn:
+        pass
+    assert conn.commits == 1 and conn.rollbacks == 0
+    with database.connection() as again:
+        pass
+    assert again is conn and database.pool.created == 1
+
+
+def test_rolls_back_on_error():
+    database = make()
+    with pytest.raises(ValueError):
+        with database.connection() as conn:
+            raise ValueError("bad data")
+    assert conn.rollbacks == 1
+    assert database.pool.idle == [conn]
+
+
+def test_dropped_connection_is_discarded():
+    database = make()
+    with pytest.raises(ConnectionDropped):
+        with database.connection() as conn:
+            conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    assert database.pool.closed == [conn] and database.pool.idle == []
+
+
+def test_closed_connection_is_replaced_at_checkout(monkeypatch):
+    database = make()
+    monkeypatch.setattr(FakeConnection, "commit", commit, raising=False)
+    stale = FakeConnection("stale")
+    stale.closed = 1
+    database.pool.idle.append(stale)
+    with database.connection() as conn:
+        assert conn is not stale
+    assert database.pool.closed == [stale]
+
+
+def test_waits_for_a_free_connection(monkeypatch):
+    # ThreadedConnectionPool raises when exhausted, the semaphore makes callers wait instead
+    database = make(maxconn=1)
+    monkeypatch.setattr(FakeConnection, "commit", commit, raising=False)
+    entered = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def hold():
+        with database.connection():
+            entered.set()
+            release.wait(5)
+            order.append("first")
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    entered.wait(5)
+
+    def wait():
+        with database.connection():
+            order.append("second")
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.1)
+    assert order == []
+    release.set()
+    holder.join(5)
+    waiter.join(5)
+    assert order == ["first", "second"]
+    assert database.pool.created == 1
+
+
+def backend_pid(database):
+    with database.cursor() as cur:
+        cur.execute("SELECT pg_backend_pid()")
+        return cur.fetchone()[0]
+
+
+def test_retries_once_after_a_dropped_connection(postgres):
+    pid = backend_pid(postgres)
+    # the server ends the pooled session, e.g. a restart or an idle timeout
+    admin = psycopg2.connect(os.environ["TEST_DATABASE_URL"])
+    with admin, admin.cursor() as cur:
+        cur.execute("SELECT pg_terminate_backend(%s)", (pid,))
+    admin.close()
+    postgres.create_users(["77010000001"])
+    assert [phone for _, phone, _ in postgres.get_users_page()] == ["77010000001"]
+    assert backend_pid(postgres) != pid
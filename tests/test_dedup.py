@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+from app.utils.dedup import MessageDeduplicator, get_message_id
+
+
+class FakeDatabase:
+    def __init__(self, fail=False):
+        self.claimed = set()
+        self.fail = fail
+        self.purges = 0
+
+    def claim_message(self, message_id, ttl):
+        if self.fail:
+            raise RuntimeError("database down")
+        if message_id in self.claimed:
+            return False
+        self.claimed.add(message_id)
+        return True
+
+    def release_message(self, message_id):
+        self.claimed.discard(message_id)
+
+    def purge_processed_messages(self, ttl):
+        self.purges += 1
+
+
+def make(backend="memory", database=None, max_size=100, ttl=3600):
+    deduplicator = MessageDeduplicator()
+    deduplicator.init_app(SimpleNamespace(config={
+        "DEDUP_BACKEND": backend, "DEDUP_MAX_SIZE": max_size, "DEDUP_TTL": ttl,
+    }), database or FakeDatabase())
+    return deduplicator
+
+
+def test_second_delivery_is_a_duplicate():
+    deduplicator = make()
+    assert not deduplicator.is_duplicate("wamid.1")
+    assert deduplicator.is_duplicate("wamid.1")
+    assert not deduplicator.is_duplicate("wamid.2")
+    assert not deduplicator.is_duplicate(None)
+    assert deduplicator.stats()["duplicates"] == 1
+
+
+def test_expired_and_evicted_ids_pass_again():
+    assert not make(ttl=0).is_duplicate("wamid.1")
+    deduplicator = make(max_size=2)
+    for message_id in ("wamid.1", "wamid.2", "wamid.3"):
+        deduplicator.is_duplicate(message_id)
+    assert not deduplicator.is_duplicate("wamid.1")
+
+
+def test_forget_lets_a_redelivery_through():
+    database = FakeDatabase()
+    deduplicator = make("postgres", database)
+    deduplicator.is_duplicate("wamid.1")
+    deduplicator.forget("wamid.1")
+    assert not deduplicator.is_duplicate("wamid.1")
+
+
+def test_database_catches_ids_seen_by_other_processes():
+    database = FakeDatabase()
+    other_process = make("postgres", database)
+    assert not other_process.is_duplicate("wamid.1")
+    deduplicator = make("postgres", database)
+    assert deduplicator.is_duplicate("wamid.1")
+    assert deduplicator.stats()["database_duplicates"] == 1
+
+
+def test_database_errors_let_the_message_through():
+    deduplicator = make("postgres", FakeDatabase(fail=True))
+    assert not deduplicator.is_duplicate("wamid.1")
+
+
+def test_purges_expired_ids_periodically():
+    database = FakeDatabase()
+    deduplicator = make("postgres", database)
+    for i in range(MessageDeduplicator.PURGE_EVERY):
+        deduplicator.is_duplicate(f"wamid.{i}")
+    assert database.purges == 1
+
+
+def test_get_message_id():
+    body = {"entry": [{"changes": [{"value": {"messages": [{"id": "wamid.1"}]}}]}]}
+    assert get_message_id(body) == "wamid.1"
+    assert get_message_id({"entry": [{"changes": [{"value": {"statuses": []}}]}]}) is None
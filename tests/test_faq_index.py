@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.faq import FaqResponder, is_greeting
+from app.utils.faq_index import FaqIndex, build_index, extract_pairs, read_pdf_text, strip_notes, tokenize
+
+DOCUMENT = """Информация по компании
+1 Q: Здравствуйте, как называется ваша компания?
+A: Я виртуальный ассистент компании «Шар-Құрылыс». Чем я могу Вам помочь?
+(создать шаблон “greeting” , добавить в этом шаблоне кнопки 1) помощь 2) вакансии 3) Отправить резюме ) Процесс найма
+2 Q: Как происходит процесс найма?
+A: Наш процесс найма включает следующие этапы: 1. Предварительный отбор резюме 2. Телефонное интервью
+3 Q: Я хочу отправить резюме (прикладывает резюме в PDF/Word формате)
+A: Спасибо! Ваше резюме успешно загружено!
+4 Q: Я хочу связаться с рекрутером
+A: Оставьте ваше имя и контактный номер. (Возможно, сделать шаблон с анкетой «survey»)
+5 Q: Мне нужна помощь
+A: Вы можете задать вопросы по следующим темам: 1. О компании 2. Обучение и развитие сотрудников
+6 Q: Какие социальные льготы предоставляются?
+A: **Перечень соц. Льгот**
+7 Q: Какие документы нужны для устройства?
+A: Список документов: 1) копия удостоверения 2) Резюме 3) …
+Информация по вакансиям
+8 Q: Расскажи мне о компании {{Название нашей компании}}
+A: **Описание компании**
+"""
+
+
+@pytest.fixture
+def pairs():
+    return extract_pairs(DOCUMENT)
+
+
+@pytest.fixture
+def responder(tmp_path, pairs):
+    path = tmp_path / "faq.idx"
+    path.write_bytes(build_index(pairs))
+    responder = FaqResponder()
+    responder.init_app(SimpleNamespace(config={
+        "FAQ_INDEX_PATH": str(path), "FAQ_MIN_CONFIDENCE": 0.5, "FAQ_MIN_SCORE": 3.0, "FAQ_MIN_TERMS": 2,
+    }))
+    yield responder
+    responder.index.close()
+
+
+def test_tokenize_stems_and_drops_stop_words():
+    assert tokenize("Какие вакансии у вас есть? Вакансию!") == ["какие", "ваканс", "ваканс"]
+
+
+def test_strip_notes_keeps_list_markers():
+    assert strip_notes("Помочь? (кнопки 1) помощь 2) вакансии ) Дальше") == "Помочь?  Дальше"
+    assert strip_notes("1) копия 2) резюме") == "1) копия 2) резюме"
+    assert strip_notes("без (закрывающей скобки") == "без (закрывающей скобки"
+
+
+def test_extract_pairs_drops_notes_headings_and_drafts(pairs):
+    assert [question for question, _ in pairs] == [
+        "Здравствуйте, как называется ваша компания?",
+        "Как происходит процесс найма?",
+        "Я хочу связаться с рекрутером",
+        "Мне нужна помощь",
+    ]
+    answers = dict(pairs)
+    assert answers["Здравствуйте, как называется ваша компания?"] == \
+        "Я виртуальный ассистент компании «Шар-Құрылыс». Чем я могу Вам помочь?"
+    assert answers["Я хочу связаться с рекрутером"] == "Оставьте ваше имя и контактный номер."
+    # a numbered list item at the end is not a heading
+    assert answers["Мне нужна помощь"].endswith("2. Обучение и развитие сотрудников")
+
+
+def test_search_reports_score_and_matched_terms(responder):
+    match = responder.index.search("Как происходит процесс найма?")[0]
+    assert match.question == "Как происходит процесс найма?"
+    assert match.matched_terms == 3
+    assert 0 < match.confidence <= 1 and match.score > 0
+
+
+def test_answers_questions(responder):
+    assert responder.answer("как происходит процесс найма").startswith("Наш процесс найма")
+    assert responder.answer("Здравствуйте, как называется ваша компания?").startswith("Я виртуальный ассистент")
+
+
+def test_single_words_and_unknown_questions_are_not_answered(responder):
+    assert responder.answer("Здравствуйте") is None
+    assert responder.answer("резюме") is None
+    assert responder.answer("what is the pin code") is None
+    assert responder.stats()["answered"] == 0
+
+
+def test_is_greeting():
+    assert is_greeting("Здравствуйте")
+    assert is_greeting("Добрый день!")
+    assert not is_greeting("Здравствуйте, как называется ваша компания?")
+    assert not is_greeting("")
+
+
+def test_shipped_hr_faq_has_no_editor_notes():
+    pytest.importorskip("pypdf")
+    pairs = extract_pairs(read_pdf_text("data/HR_information.pdf"))
+    assert pairs
+    for question, answer in pairs:
+        assert "(" not in answer and "{{" not in answer and "…" not in answer
+        assert not answer.endswith(("Процесс найма", "Информация по вакансиям"))
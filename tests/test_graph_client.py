@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.utils.graph_client import GraphClient, RateLimitTimeout
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def json(self):
+        if self.body is None:
+            raise ValueError("no JSON")
+        return self.body
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.posts = 0
+
+    def post(self, *args, **kwargs):
+        self.posts += 1
+        return self.responses.pop(0)
+
+
+class FakeLimiter:
+    def __init__(self, grant=True):
+        self.grant = grant
+        self.pauses = []
+        self.timeouts = []
+
+    def acquire(self, lane, timeout=None):
+        self.timeouts.append(timeout)
+        return self.grant
+
+    def pause(self, seconds):
+        self.pauses.append(seconds)
+
+
+def make(responses, limiter=None, **kwargs):
+    client = GraphClient("token", "v20.0", "123", **kwargs)
+    client.session = FakeSession(responses)
+    client.limiter = limiter or FakeLimiter()
+    return client
+
+
+def test_retry_after_is_clamped_to_backoff_max():
+    client = make([FakeResponse(429, headers={"Retry-After": "3600"}), FakeResponse(200, {})], backoff_max=5)
+    assert client.post_message(json={}).status_code == 200
+    assert client.limiter.pauses == [5]
+
+
+def test_acquire_timeout_fails_the_send():
+    limiter = FakeLimiter(grant=False)
+    client = make([], limiter=limiter, acquire_timeout=2)
+    with pytest.raises(RateLimitTimeout):
+        client.post_message(json={})
+    assert limiter.timeouts == [2]
+    assert client.session.posts == 0
+
+
+def test_rate_limit_error_code_pauses_the_limiter():
+    client = make([FakeResponse(400, {"error": {"code": 130429}}), FakeResponse(200, {})], backoff_max=1)
+    assert client.post_message(json={}).status_code == 200
+    assert len(client.limiter.pauses) == 1
+
+
+@pytest.mark.parametrize("body", [None, [], "error", {"error": "text"}, {"error": None}])
+def test_error_code_of_unexpected_bodies(body):
+    assert GraphClient._error_code(FakeResponse(400, body)) is None
+
+
+def test_error_code():
+    assert GraphClient._error_code(SimpleNamespace(json=lambda: {"error": {"code": 4}})) == 4
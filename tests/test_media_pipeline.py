@@ -0,0 +1,154 @@
+import hashlib
+import time
+from contextlib import nullcontext
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import media_pipeline as media_pipeline_module
+from app.services.media_pipeline import MediaPipeline
+from app.utils.media_store import MediaStore, MediaTooLarge
+
+PDF = b"%PDF-1.4 resume" * 100
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.media_files = []
+        self.answers = {}
+
+    def save_media_file(self, phone, sha256, filename, mime_type, size, path):
+        self.media_files.append((phone, sha256, filename, size, path))
+        return len(self.media_files)
+
+    def save_survey_results(self, phone, key, value):
+        self.answers[(phone, key)] = value
+
+
+class FakeDownload:
+    def __init__(self, content):
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+def make(tmp_path, monkeypatch, info, max_bytes=1024 * 1024, content=PDF):
+    fetched = []
+    notified = []
+
+    def fetch_info(media_id):
+        fetched.append(media_id)
+        return dict(info)
+
+    downloads = []
+
+    def download(url):
+        downloads.append(url)
+        return FakeDownload(content)
+
+    monkeypatch.setattr(media_pipeline_module, "get_graph_client", lambda: SimpleNamespace(download=download))
+    pipeline = MediaPipeline()
+    app = SimpleNamespace(app_context=nullcontext, config={
+        "MEDIA_ROOT": str(tmp_path), "MEDIA_MAX_BYTES": max_bytes, "MEDIA_WORKERS": 1, "MEDIA_QUEUE_SIZE": 10,
+    })
+    pipeline.init_app(app, FakeDatabase(), fetch_info, lambda wa_id, text: notified.append((wa_id, text)))
+    return pipeline, fetched, downloads, notified
+
+
+def test_store_rejects_files_over_the_cap(tmp_path):
+    store = MediaStore(str(tmp_path), max_bytes=10)
+    with pytest.raises(MediaTooLarge):
+        store.save([b"12345", b"678901"], ".pdf")
+    # nothing is left behind, not even the temporary file
+    assert list((tmp_path / "tmp").iterdir()) == []
+    sha256, path, size = store.save([b"12345", b"67890"], ".pdf")
+    assert size == 10 and path == store.path_for(sha256, ".pdf")
+
+
+def test_download_saves_the_path_as_the_survey_answer(tmp_path, monkeypatch):
+    info = {"url": "https://lookaside.example/x", "mime_type": "application/pdf"}
+    pipeline, _, downloads, _ = make(tmp_path, monkeypatch, info)
+    path = pipeline.download("77010000001", "media-1", "cv.pdf", survey_key="resume")
+    with open(path, "rb") as file:
+        assert file.read() == PDF
+    assert path.endswith(hashlib.sha256(PDF).hexdigest() + ".pdf")
+    assert pipeline.database.answers[("77010000001", "resume")] == path
+
+    # the same file again is recognised by the sha256 of the metadata and not downloaded
+    pipeline._info.clear()
+    info["sha256"] = hashlib.sha256(PDF).hexdigest()
+    pipeline.fetch_info = lambda media_id: info
+    assert pipeline.download("77010000001", "media-2", "cv (1).pdf") == path
+    assert len(downloads) == 1
+    assert pipeline.stats()["deduplicated"] == 1
+
+
+def test_too_large_by_metadata_is_not_downloaded(tmp_path, monkeypatch):
+    info = {"url": "https://lookaside.example/x", "mime_type": "application/pdf", "file_size": 2048}
+    pipeline, _, downloads, _ = make(tmp_path, monkeypatch, info, max_bytes=1024)
+    with pytest.raises(MediaTooLarge):
+        pipeline.download("77010000001", "media-1")
+    assert downloads == []
+
+
+def run_worker(pipeline, item):
+    pipeline.queue.put(item)
+    pipeline.queue.put(None)
+    pipeline._work()
+
+
+def test_too_large_while_streaming_tells_the_user_the_limit(tmp_path, monkeypatch):
+    info = {"url": "https://lookaside.example/x", "mime_type": "application/pdf"}
+    pipeline, _, _, notified = make(tmp_path, monkeypatch, info, max_bytes=1024 * 1024, content=b"x" * (1024 * 1024 + 1))
+    run_worker(pipeline, ("77010000001", "media-1", "cv.pdf", "resume"))
+    assert pipeline.stats()["too_large"] == 1
+    assert notified == [("77010000001", "Файл слишком большой, максимальный размер 1 МБ.")]
+    assert pipeline.database.answers == {}
+
+
+def test_errors_are_not_shown_to_the_user(tmp_path, monkeypatch):
+    pipeline, _, _, notified = make(tmp_path, monkeypatch, {})
+
+    def fetch_info(media_id):
+        raise RuntimeError("GET https://graph.facebook.com/v20.0/x?access_token=secret failed")
+
+    pipeline.fetch_info = fetch_info
+    run_worker(pipeline, ("77010000001", "media-1", None, None))
+    assert pipeline.stats()["failed"] == 1
+    [(wa_id, text)] = notified
+    assert "secret" not in text and "graph.facebook.com" not in text
+
+
+def test_metadata_is_cached_until_the_url_expires(tmp_path, monkeypatch):
+    now = time.time()
+    info = {"url": f"https://lookaside.example/x?ext={int(now + 60)}&hash=abc"}
+    pipeline, fetched, _, _ = make(tmp_path, monkeypatch, info)
+    pipeline.media_info("media-1")
+    pipeline.media_info("media-1")
+    assert fetched == ["media-1"]
+    expires_at = pipeline._info["media-1"][0]
+    assert now + 40 < expires_at <= now + 50
+
+    # an expired entry is fetched again
+    pipeline._info["media-1"] = (now - 1, info)
+    pipeline.media_info("media-1")
+    assert fetched == ["media-1", "media-1"]
+
+
+def test_url_expiry_is_capped():
+    pipeline = MediaPipeline()
+    now = 1000.0
+    assert pipeline._url_expiry(f"https://x/?ext={int(now + 3600)}", now) == now + MediaPipeline.URL_TTL - 10
+    assert pipeline._url_expiry("https://x/?ext=soon", now) == now + MediaPipeline.URL_TTL - 10
+    assert pipeline._url_expiry("", now) == now + MediaPipeline.URL_TTL - 10
@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+
+from app.utils.migrations import MIGRATIONS, migrate
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.row = None
+
+    def execute(self, query, params=None):
+        self.database.executed.append(query)
+        self.row = None
+        if query.startswith("SELECT 1 FROM schema_migrations"):
+            self.row = (1,) if params[0] in self.database.versions else None
+        elif query.startswith("INSERT INTO schema_migrations"):
+            self.database.versions.add(params[0])
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeDatabase:
+    def __init__(self, versions=()):
+        self.versions = set(versions)
+        self.executed = []
+
+    @contextmanager
+    def cursor(self):
+        yield FakeCursor(self)
+
+
+def test_versions_are_unique_and_increasing():
+    versions = [migration.version for migration in MIGRATIONS]
+    assert versions == sorted(set(versions))
+    assert versions[0] == 1
+
+
+def test_applies_every_migration_once():
+    database = FakeDatabase()
+    applied = migrate(database)
+    assert [migration.version for migration in applied] == [migration.version for migration in MIGRATIONS]
+    assert database.versions == {migration.version for migration in MIGRATIONS}
+
+    database.executed.clear()
+    assert migrate(database) == []
+    assert not any(statement in database.executed for migration in MIGRATIONS for statement in migration.statements)
+
+
+def test_applies_only_up_to_the_target():
+    database = FakeDatabase()
+    assert [migration.version for migration in migrate(database, target=1)] == [1]
+    assert [migration.version for migration in migrate(database)] == [m.version for m in MIGRATIONS[1:]]
+
+
+def test_skips_migrations_already_applied():
+    database = FakeDatabase(versions={1, 2})
+    applied = migrate(database)
+    assert [migration.version for migration in applied] == [m.version for m in MIGRATIONS if m.version > 2]
+    for statement in MIGRATIONS[0].statements:
+        assert statement not in database.executed
+
+
+def test_every_migration_takes_the_lock_first():
+    database = FakeDatabase()
+    migrate(database)
+    locks = [i for i, query in enumerate(database.executed) if "pg_advisory_xact_lock" in query]
+    checks = [i for i, query in enumerate(database.executed) if query.startswith("SELECT 1 FROM schema_migrations")]
+    assert len(locks) == len(checks) == len(MIGRATIONS)
+    assert all(lock + 1 == check for lock, check in zip(locks, checks))
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from app.utils.rate_limiter import BROADCAST, INTERACTIVE, RateLimiter, get_rate_limiter
+
+
+def test_burst_then_rate():
+    limiter = RateLimiter(rate=50, burst=5)
+    started = time.monotonic()
+    for _ in range(5):
+        assert limiter.acquire(timeout=0)
+    assert not limiter.acquire(timeout=0)
+    assert limiter.acquire(timeout=1)
+    assert time.monotonic() - started < 0.5
+
+
+def test_broadcast_is_capped_at_its_share():
+    limiter = RateLimiter(rate=10, burst=10, broadcast_share=0.5)
+    granted = sum(limiter.acquire(BROADCAST, timeout=0) for _ in range(10))
+    assert granted == 5
+    # the rest of the burst is left for interactive replies
+    assert sum(limiter.acquire(INTERACTIVE, timeout=0) for _ in range(10)) == 5
+
+
+def test_broadcast_waits_while_an_interactive_send_waits():
+    limiter = RateLimiter(rate=20, burst=1)
+    assert limiter.acquire(timeout=0)
+    order = []
+
+    def send(lane):
+        limiter.acquire(lane, timeout=2)
+        order.append(lane)
+
+    interactive = threading.Thread(target=send, args=(INTERACTIVE,))
+    interactive.start()
+    time.sleep(0.01)  # the interactive send is waiting now
+    broadcast = threading.Thread(target=send, args=(BROADCAST,))
+    broadcast.start()
+    interactive.join()
+    broadcast.join()
+    assert order == [INTERACTIVE, BROADCAST]
+
+
+def test_pause_holds_every_lane():
+    limiter = RateLimiter(rate=100, burst=10)
+    limiter.pause(0.2)
+    assert not limiter.acquire(timeout=0.05)
+    assert not limiter.acquire(BROADCAST, timeout=0.05)
+    assert limiter.acquire(timeout=1)
+
+
+def test_one_limiter_per_phone_number():
+    assert get_rate_limiter("test-phone-1", 10) is get_rate_limiter("test-phone-1", 99)
+    assert get_rate_limiter("test-phone-1", 10) is not get_rate_limiter("test-phone-2", 10)
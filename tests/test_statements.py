@@ -0,0 +1,131 @@
+from types import SimpleNamespace
+
+import psycopg2.errors
+import psycopg2.extensions
+import pytest
+
+from app.utils.statements import StalePlan, StatementRegistry
+
+IDLE = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+INTRANS = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+
+class FakeConnection:
+    def __init__(self, prepared=True, status=IDLE):
+        if prepared:
+            self.prepared = set()
+            self.stale = set()
+        self.info = SimpleNamespace(transaction_status=status)
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeCursor:
+    def __init__(self, connection, stale=()):
+        self.connection = connection
+        self.executed = []
+        self.stale = set(stale)  # names whose next EXECUTE fails as after a column type change
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        name = query.split()[1]
+        if query.startswith("EXECUTE") and name in self.stale:
+            self.stale.discard(name)
+            raise psycopg2.errors.FeatureNotSupported("cached plan must not change result type")
+
+
+def test_prepares_once_per_connection():
+    registry = StatementRegistry()
+    first, second = FakeCursor(FakeConnection()), FakeCursor(FakeConnection())
+    query = "SELECT phone FROM users WHERE phone = $1 AND id > $2"
+    registry.execute(first, "get_user", query, ("77001", 5))
+    registry.execute(first, "get_user", query, ("77002", 6))
+    registry.execute(second, "get_user", query, ("77003", 7))
+    assert first.executed == [
+        (f"PREPARE get_user AS {query}", None),
+        ("EXECUTE get_user (%s, %s)", ("77001", 5)),
+        ("EXECUTE get_user (%s, %s)", ("77002", 6)),
+    ]
+    assert second.executed[0] == (f"PREPARE get_user AS {query}", None)
+    stats = registry.stats()["get_user"]
+    assert stats["calls"] == 3 and stats["prepares"] == 2
+
+
+def test_statement_without_parameters():
+    cur = FakeCursor(FakeConnection())
+    StatementRegistry().execute(cur, "count_users", "SELECT count(*) FROM users")
+    assert cur.executed[-1] == ("EXECUTE count_users", None)
+
+
+QUERY = "SELECT 1 FROM users WHERE phone = $1 AND name LIKE '%a' AND id = $2"
+PLAIN = ("SELECT 1 FROM users WHERE phone = %(p1)s AND name LIKE '%%a' AND id = %(p2)s", {"p1": "77", "p2": 3})
+
+
+def test_plain_queries_with_prepare_off():
+    # pgbouncer in transaction mode
+    cur = FakeCursor(FakeConnection())
+    StatementRegistry(prepare=False).execute(cur, "find", QUERY, ("77", 3))
+    assert cur.executed == [PLAIN]
+
+
+def test_plain_queries_on_other_connections():
+    cur = FakeCursor(FakeConnection(prepared=False))
+    StatementRegistry().execute(cur, "find", QUERY, ("77", 3))
+    assert cur.executed == [PLAIN]
+
+
+def test_rejects_bad_names_and_conflicting_queries():
+    registry = StatementRegistry()
+    cur = FakeCursor(FakeConnection())
+    with pytest.raises(ValueError):
+        registry.execute(cur, "drop table; --", "SELECT 1")
+    registry.execute(cur, "one", "SELECT 1")
+    with pytest.raises(ValueError):
+        registry.execute(cur, "one", "SELECT 2")
+
+
+def test_stale_plan_is_prepared_again_and_retried():
+    connection = FakeConnection()
+    connection.prepared.add("get_user")
+    cur = FakeCursor(connection, stale={"get_user"})
+    registry = StatementRegistry()
+    registry.execute(cur, "get_user", "SELECT phone FROM users WHERE phone = $1", ("77",))
+    assert connection.rollbacks == 1
+    assert [query for query, _ in cur.executed] == [
+        "EXECUTE get_user (%s)",
+        "DEALLOCATE get_user",
+        "PREPARE get_user AS SELECT phone FROM users WHERE phone = $1",
+        "EXECUTE get_user (%s)",
+    ]
+    assert connection.prepared == {"get_user"} and not connection.stale
+
+
+def test_stale_plan_inside_a_transaction_is_left_to_the_caller():
+    connection = FakeConnection(status=INTRANS)
+    connection.prepared.add("get_user")
+    cur = FakeCursor(connection, stale={"get_user"})
+    registry = StatementRegistry()
+    query = "SELECT phone FROM users WHERE phone = $1"
+    with pytest.raises(StalePlan):
+        registry.execute(cur, "get_user", query, ("77",))
+    assert connection.rollbacks == 0
+    # the repeated transaction deallocates and prepares it again
+    registry.execute(cur, "get_user", query, ("77",))
+    assert [query for query, _ in cur.executed[1:3]] == ["DEALLOCATE get_user", f"PREPARE get_user AS {query}"]
+    assert connection.prepared == {"get_user"} and not connection.stale
+
+
+def test_other_unsupported_features_are_raised():
+    connection = FakeConnection()
+    cur = FakeCursor(connection)
+
+    def execute(query, params=None):
+        if query.startswith("EXECUTE"):
+            raise psycopg2.errors.FeatureNotSupported("something else")
+
+    cur.execute = execute
+    with pytest.raises(psycopg2.errors.FeatureNotSupported):
+        StatementRegistry().execute(cur, "one", "SELECT 1")
+    assert connection.rollbacks == 0
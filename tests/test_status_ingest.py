@@ -0,0 +1,108 @@
+import threading
+from types import SimpleNamespace
+
+import psycopg2
+
+from app.services import status_ingest as status_ingest_module
+from app.services.status_ingest import StatusIngest
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.statuses = []
+        self.outbound = []
+        self.batches = []
+        self.down = False
+        self.saved = threading.Event()
+
+    def save_outbound_messages(self, rows):
+        self._check(rows)
+        self.outbound.extend(rows)
+
+    def save_message_statuses(self, rows):
+        self._check(rows)
+        self.batches.append(len(rows))
+        self.statuses.extend(rows)
+        self.saved.set()
+
+    def _check(self, rows):
+        if self.down:
+            raise psycopg2.OperationalError("database down")
+        if any(row[0] == "bad" for row in rows):
+            raise psycopg2.DataError("value too long")
+
+
+def make(database, batch_size=100, flush_interval=60):
+    ingest = StatusIngest()
+    ingest.init_app(SimpleNamespace(config={
+        "STATUS_BATCH_SIZE": batch_size, "STATUS_FLUSH_INTERVAL": flush_interval, "STATUS_BUFFER_MAX": 1000,
+    }), database)
+    return ingest
+
+
+def status(message_id, **fields):
+    return dict({"id": message_id, "recipient_id": "77010000001", "status": "delivered", "timestamp": "1700000000"}, **fields)
+
+
+def test_a_full_batch_is_written_by_the_background_thread():
+    database = FakeDatabase()
+    ingest = make(database, batch_size=3)
+    ingest.add_statuses([status("wamid.1"), status("wamid.2")])
+    assert not database.saved.wait(0.2)
+    ingest.add_statuses([status("wamid.3")])
+    assert database.saved.wait(5)
+    assert database.batches == [3]
+    assert ingest.stats()["flushed"] == 3 and ingest.stats()["buffered"] == 0
+
+
+def test_flush_writes_outbound_before_statuses():
+    database = FakeDatabase()
+    ingest = make(database)
+    ingest.add_outbound("wamid.1", "77010000001", "greeting", "job-1")
+    ingest.add_statuses([status("wamid.1", errors=[{"code": 131026}])])
+    ingest.flush()
+    assert database.outbound == [("wamid.1", "77010000001", "greeting", "job-1")]
+    assert database.statuses == [("wamid.1", "77010000001", "delivered", 1700000000, 131026)]
+    stats = ingest.stats()
+    assert (stats["flushed"], stats["batches"], stats["buffered"]) == (2, 1, 0)
+
+
+def test_malformed_statuses_are_skipped_or_stored_as_null():
+    database = FakeDatabase()
+    ingest = make(database)
+    ingest.add_statuses([
+        "not a status", {"status": "read"}, status(None),
+        status("wamid.1", timestamp="yesterday", errors="oops"),
+        status("wamid.2", timestamp=None, errors=[{"code": "x"}]),
+    ])
+    ingest.add_statuses({"id": "not a list"})
+    ingest.flush()
+    assert database.statuses == [
+        ("wamid.1", "77010000001", "delivered", None, None),
+        ("wamid.2", "77010000001", "delivered", None, None),
+    ]
+
+
+def test_a_rejected_row_does_not_hold_back_the_batch(monkeypatch):
+    monkeypatch.setattr(status_ingest_module.time, "sleep", lambda seconds: None)
+    database = FakeDatabase()
+    ingest = make(database)
+    ingest.add_statuses([status("wamid.1"), status("bad"), status("wamid.2")])
+    ingest.flush()
+    assert [row[0] for row in database.statuses] == ["wamid.1", "wamid.2"]
+    stats = ingest.stats()
+    assert (stats["flushed"], stats["dropped"], stats["failures"], stats["buffered"]) == (2, 1, 1, 0)
+
+
+def test_rows_are_kept_while_the_database_is_down(monkeypatch):
+    monkeypatch.setattr(status_ingest_module.time, "sleep", lambda seconds: None)
+    database = FakeDatabase()
+    ingest = make(database)
+    ingest.add_statuses([status("wamid.1"), status("wamid.2")])
+    database.down = True
+    ingest.flush()
+    assert database.statuses == [] and ingest.stats()["buffered"] == 2
+    database.down = False
+    ingest.add_statuses([status("wamid.3")])
+    ingest.flush()
+    assert [row[0] for row in database.statuses] == ["wamid.1", "wamid.2", "wamid.3"]
@@ -0,0 +1,137 @@
+from types import SimpleNamespace
+
+import psycopg2
+
+from app.services.survey_sessions import SurveySessions
+from app.utils.db import UserState
+
+NEW = UserState(survey_mode=False, current_step=0, vacancy_filled=False, wants_notifications=True)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.reads = 0
+        self.batches = []
+        self.down = False
+        self.rejected = set()
+
+    def touch_user(self, phone):
+        self.reads += 1
+        return NEW
+
+    def apply_survey_transitions(self, transitions):
+        if self.down:
+            raise psycopg2.OperationalError("database down")
+        if any(phone in self.rejected for phone, _ in transitions):
+            raise psycopg2.DataError("value too long for type character varying(255)")
+        self.batches.append(list(transitions))
+
+
+def make(ttl=60, write_behind=False, max_size=100):
+    sessions = SurveySessions()
+    sessions.init_app(SimpleNamespace(config={
+        "SESSION_CACHE_TTL": ttl, "SESSION_CACHE_SIZE": max_size,
+        "SESSION_WRITE_BEHIND": write_behind, "SESSION_FLUSH_INTERVAL": 3600,
+    }), FakeDatabase())
+    return sessions
+
+
+def test_without_cache_every_read_and_write_goes_to_the_database():
+    sessions = make(ttl=0, write_behind=True)
+    assert not sessions.write_behind  # needs the cache
+    sessions.get("77010000001")
+    sessions.get("77010000001")
+    sessions.transition("77010000001", survey_mode=True, current_step=1)
+    assert sessions.database.reads == 2
+    assert sessions.database.batches == [[("77010000001", {"survey_mode": True, "current_step": 1})]]
+
+
+def test_cache_follows_the_transitions():
+    sessions = make()
+    sessions.get("77010000001")
+    sessions.transition("77010000001", survey_mode=True, current_step=2, survey={"vacancy": "Оператор"})
+    assert sessions.get("77010000001") == NEW._replace(survey_mode=True, current_step=2, vacancy_filled=True)
+    assert sessions.database.reads == 1
+    assert len(sessions.database.batches) == 1  # written through
+
+
+def test_failed_write_through_forgets_the_cached_state():
+    sessions = make()
+    sessions.get("77010000001")
+    sessions.database.down = True
+    try:
+        sessions.transition("77010000001", current_step=1)
+    except psycopg2.OperationalError:
+        pass
+    sessions.database.down = False
+    assert sessions.get("77010000001") == NEW
+    assert sessions.database.reads == 2
+
+
+def test_write_behind_merges_the_transitions_of_a_user():
+    sessions = make(write_behind=True)
+    sessions.get("77010000001")
+    sessions.transition("77010000001", survey_mode=True, current_step=1, survey={"name": "Асель"})
+    sessions.transition("77010000001", current_step=2, survey={"age": "25"})
+    sessions.transition("77010000002", wants_notifications=False)
+    assert sessions.database.batches == []
+    assert sessions.get("77010000001").current_step == 2
+    sessions.flush()
+    assert sessions.database.batches == [[
+        ("77010000001", {"survey_mode": True, "current_step": 2, "survey": {"name": "Асель", "age": "25"}}),
+        ("77010000002", {"wants_notifications": False}),
+    ]]
+    stats = sessions.stats()
+    assert (stats["writes"], stats["batches"], stats["pending"]) == (2, 1, 0)
+
+
+def test_write_behind_keeps_transitions_while_the_database_is_down():
+    sessions = make(write_behind=True)
+    sessions.transition("77010000001", current_step=1)
+    sessions.database.down = True
+    sessions.flush()
+    sessions.transition("77010000001", current_step=2)
+    sessions.database.down = False
+    sessions.flush()
+    # the newer step wins over the failed one
+    assert sessions.database.batches == [[("77010000001", {"current_step": 2})]]
+    assert sessions.stats()["failures"] == 1
+
+
+def test_rejected_transition_is_dropped_and_its_state_forgotten():
+    sessions = make(write_behind=True)
+    for phone in ("77010000001", "77010000002"):
+        sessions.get(phone)
+    sessions.transition("77010000001", current_step=1)
+    sessions.transition("77010000002", survey={"vacancy": "x" * 300})
+    sessions.database.rejected.add("77010000002")
+    sessions.flush()
+    assert sessions.database.batches == [[("77010000001", {"current_step": 1})]]
+    stats = sessions.stats()
+    assert (stats["dropped"], stats["writes"], stats["pending"]) == (1, 1, 0)
+    # the cache had the rejected change, the state is read again
+    sessions.get("77010000002")
+    assert sessions.database.reads == 3
+
+
+def test_evicted_user_with_pending_transitions_is_flushed_before_reading():
+    sessions = make(write_behind=True, max_size=1)
+    sessions.get("77010000001")
+    sessions.transition("77010000001", current_step=3)
+    sessions.get("77010000002")  # evicts the first user
+    sessions.get("77010000001")
+    assert sessions.database.batches == [[("77010000001", {"current_step": 3})]]
+
+
+def test_transitions_in_postgres(postgres):
+    postgres.touch_user("77010000001")
+    postgres.apply_survey_transitions([
+        ("77010000001", {"survey_mode": False, "current_step": 4, "completed": True,
+                         "survey": {"name": "Асель", "vacancy": "Оператор"}}),
+    ])
+    assert postgres.touch_user("77010000001") == NEW._replace(current_step=4, vacancy_filled=True)
+    with postgres.cursor() as cur:
+        cur.execute("SELECT name, vacancy, completed_survey FROM surveys WHERE phone = %s", ("77010000001",))
+        assert cur.fetchone() == ("Асель", "Оператор", True)
+        cur.execute("SELECT has_completed_survey FROM users WHERE phone = %s", ("77010000001",))
+        assert cur.fetchone() == (True,)
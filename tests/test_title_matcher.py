@@ -0,0 +1,41 @@
+from app.utils.title_matcher import TitleMatcher, normalize
+
+TITLES = [
+    (1, "Инженер-строитель"),
+    (2, "Инженер"),
+    (3, "Электрик"),
+    (4, "Главный  инженер"),
+    (5, ""),
+    (6, None),
+]
+
+
+def test_normalize():
+    assert normalize("  Ёлка \n  Инженер ") == "елка инженер"
+
+
+def test_finds_titles_in_order_of_appearance():
+    matcher = TitleMatcher(TITLES)
+    assert matcher.find_all("Нужен электрик и инженер-строитель") == [3, 1, 2]
+
+
+def test_longer_title_first_at_the_same_position():
+    matcher = TitleMatcher(TITLES)
+    assert matcher.find_all("инженер-строитель") == [1, 2]
+
+
+def test_overlapping_titles_through_failure_links():
+    matcher = TitleMatcher(TITLES)
+    assert matcher.find_all("ГЛАВНЫЙ ИНЖЕНЕР") == [4, 2]
+
+
+def test_case_and_whitespace_insensitive():
+    matcher = TitleMatcher([(7, "Оператор линии")])
+    assert matcher.find_all("оператор\nЛИНИИ") == [7]
+
+
+def test_each_vacancy_once_and_no_empty_titles():
+    matcher = TitleMatcher(TITLES)
+    assert matcher.find_all("электрик, ещё электрик") == [3]
+    assert matcher.find_all("ничего подходящего") == []
+    assert TitleMatcher([]).find_all("инженер") == []
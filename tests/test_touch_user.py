@@ -0,0 +1,37 @@
+from app.utils.db import UserState
+
+
+def test_new_user_gets_a_user_and_an_empty_survey(postgres):
+    assert postgres.touch_user("77010000001") == UserState(
+        survey_mode=False, current_step=0, vacancy_filled=False, wants_notifications=True
+    )
+    assert postgres.get_user("77010000001")
+    with postgres.cursor() as cur:
+        cur.execute("SELECT completed_survey FROM surveys WHERE phone = %s", ("77010000001",))
+        assert cur.fetchall() == [(False,)]
+
+
+def test_existing_user_state_in_one_statement(postgres):
+    postgres.touch_user("77010000001")
+    postgres.set_survey_mode("77010000001", True)
+    postgres.set_step("77010000001")
+    postgres.save_vacancy("77010000001", "Оператор линии")
+    postgres.set_notification_preference(False, "77010000001")
+    assert postgres.touch_user("77010000001") == UserState(
+        survey_mode=True, current_step=1, vacancy_filled=True, wants_notifications=False
+    )
+    # nothing is inserted twice
+    with postgres.cursor() as cur:
+        cur.execute("SELECT (SELECT count(*) FROM users), (SELECT count(*) FROM surveys)")
+        assert cur.fetchone() == (1, 1)
+    assert postgres.statements.stats()["touch_user"]["calls"] == 2
+    assert "get_user_state" not in postgres.statements.stats()
+
+
+def test_user_without_a_survey_row(postgres):
+    # users created before surveys rows were added together with them
+    with postgres.cursor() as cur:
+        cur.execute("INSERT INTO users (phone, current_step) VALUES (%s, 3)", ("77010000002",))
+    assert postgres.touch_user("77010000002") == UserState(
+        survey_mode=False, current_step=3, vacancy_filled=False, wants_notifications=True
+    )
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+from flask import Flask
+
+from app.views import webhook_blueprint
+
+USERS = [(i, f"7701000{i:04d}", i % 2 == 0) for i in range(1, 1201)]
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.limits = []
+
+    def get_users_page(self, after_id=0, limit=100):
+        self.limits.append(limit)
+        return [user for user in USERS if user[0] > after_id][:limit]
+
+    def iter_users(self):
+        yield from USERS
+
+
+@pytest.fixture
+def database():
+    return FakeDatabase()
+
+
+@pytest.fixture
+def client(database):
+    app = Flask(__name__)
+    app.config["VERIFY_TOKEN"] = "secret"
+    app.register_blueprint(webhook_blueprint)
+    app.extensions["database"] = database
+    return app.test_client()
+
+
+def get(client, query=""):
+    return client.get(f"/users{query}", headers={"token": "secret"})
+
+
+def test_pages_follow_next_after_id(client):
+    seen = []
+    after_id = 0
+    while after_id is not None:
+        body = get(client, f"?after_id={after_id}&limit=500").get_json()
+        seen.extend(user["id"] for user in body["users"])
+        after_id = body["next_after_id"]
+    assert seen == [user[0] for user in USERS]
+
+
+def test_last_full_page_points_to_an_empty_one(client):
+    body = get(client, "?after_id=1100&limit=100").get_json()
+    assert body["next_after_id"] == 1200
+    assert get(client, "?after_id=1200&limit=100").get_json() == {"users": [], "next_after_id": None}
+
+
+@pytest.mark.parametrize("limit, expected", [("0", 1), ("-5", 1), ("5000", 1000), ("20", 20)])
+def test_limit_is_clamped(client, database, limit, expected):
+    assert len(get(client, f"?limit={limit}").get_json()["users"]) == expected
+    assert database.limits == [expected]
+
+
+def test_invalid_parameters(client):
+    assert get(client, "?limit=ten").status_code == 400
+    assert get(client, "?after_id=x").status_code == 400
+    assert client.get("/users").status_code == 400  # no token
+
+
+def test_streams_every_user_as_ndjson(client):
+    response = get(client, "?format=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)["id"] for line in lines] == [user[0] for user in USERS]
+
+
+def test_streams_every_user_as_csv(client):
+    lines = get(client, "?format=csv").get_data(as_text=True).splitlines()
+    assert lines[0] == "id,phone,want_notifications"
+    assert lines[1] == "1,77010000001,False"
+    assert len(lines) == len(USERS) + 1
+
+
+def test_pages_from_postgres(postgres):
+    postgres.create_users([f"7701000{i:04d}" for i in range(1, 6)])
+    first = postgres.get_users_page(limit=3)
+    assert [phone for _, phone, _ in first] == ["77010000001", "77010000002", "77010000003"]
+    rest = postgres.get_users_page(after_id=first[-1][0], limit=3)
+    assert [phone for _, phone, _ in rest] == ["77010000004", "77010000005"]
+    assert [row for row in postgres.iter_users(itersize=2)] == first + rest
@@ -0,0 +1,53 @@
+import pytest
+
+from app.utils.vacancy_catalog import VacancyCatalog
+
+ROWS = [(1, "Оператор линии", "", "", "", "300 000")]
+
+
+class FakeLoad:
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("database down")
+        return ROWS
+
+
+def test_loads_once_until_invalidated():
+    load = FakeLoad()
+    catalog = VacancyCatalog(load, {}, listen=False)
+    assert catalog.snapshot() is catalog.snapshot()
+    assert load.calls == 1
+    catalog.invalidate()
+    assert catalog.snapshot().version == 2
+
+
+def test_failed_reload_serves_the_previous_snapshot():
+    load = FakeLoad()
+    catalog = VacancyCatalog(load, {}, listen=False)
+    first = catalog.snapshot()
+    load.fail = True
+    catalog.invalidate()
+    assert catalog.snapshot() is first
+    # not retried on every call while the database is down
+    assert catalog.snapshot() is first
+    assert load.calls == 2
+    assert catalog.stats()["refresh_failures"] == 1
+
+    load.fail = False
+    catalog._retry_at = 0
+    assert catalog.snapshot().version == 2
+
+
+def test_raises_without_any_snapshot():
+    load = FakeLoad()
+    load.fail = True
+    catalog = VacancyCatalog(load, {}, listen=False)
+    with pytest.raises(RuntimeError):
+        catalog.snapshot()
+    load.fail = False
+    assert catalog.snapshot().version == 1
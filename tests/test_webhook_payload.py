@@ -0,0 +1,28 @@
+import pytest
+from flask import Flask, g, jsonify
+
+from app.decorators.security import webhook_payload
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.config["VERIFY_WEBHOOK_SIGNATURE"] = False
+
+    @app.route("/webhook", methods=["POST"])
+    @webhook_payload
+    def webhook():
+        return jsonify({"entries": len(g.webhook_body.get("entry", []))}), 200
+
+    return app.test_client()
+
+
+def test_object_is_passed_on(client):
+    response = client.post("/webhook", data=b'{"entry": [{}]}', content_type="application/json")
+    assert response.status_code == 200 and response.get_json() == {"entries": 1}
+
+
+@pytest.mark.parametrize("body", [b"{not json", b'{"entry": "\xff\xfe"}', b"[]", b'"text"', b"null", b""])
+def test_invalid_bodies_are_rejected(client, body):
+    response = client.post("/webhook", data=body, content_type="application/json")
+    assert response.status_code == 400